@@ -10,6 +10,17 @@ this is being deployed.
 @var updater_port: The Tor control port for the updater to use. This port
     must be configured in the torrc file.
 @var base_url: The root URL for the Tor Weather web application.
+@var checker_workers: The number of threads checking subscriptions after each
+    consensus. With 1, the checkers run one after another.
+@var full_check_cycles: Every this many update cycles all subscriptions are
+    checked; in the others only those of the routers that changed.
+@var digest_emails: Whether the notifications to the same email address in
+    an update cycle are combined into one digest email, for the subscribers
+    who didn't opt out.
+@var history_full_days: The days for which the relay history keeps the state
+    of every consensus.
+@var history_bucket_hours: The hours older relay history is merged into.
+@var history_keep_days: The days after which relay history is dropped.
 """
 
 import os
@@ -22,3 +33,19 @@ control_port = 9051
 
 #The base URL for the Tor Weather web application:
 base_url = 'https://weather.dev'
+
+#The number of threads checking subscriptions after each consensus
+checker_workers = 1
+
+#Every how many cycles all subscriptions are checked, not only those of the
+#routers that changed
+full_check_cycles = 24
+
+#Whether to combine the notifications to the same address into digests
+digest_emails = True
+
+#How long the relay history keeps each consensus, how coarse it gets after
+#that, and when it is dropped
+history_full_days = 30
+history_bucket_hours = 24
+history_keep_days = 400
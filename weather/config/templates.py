@@ -13,6 +13,8 @@ by the controllers (see views.py).
     fingerprint isn't found.
 @type home: str
 @var home: The template for the Tor Weather home page.
+@type not_found: str
+@var not_found: The template for the 404 Page Not Found page.
 @type notification_info: str
 @var notification_info: The template for the page with notification 
     specifications.
@@ -25,6 +27,8 @@ by the controllers (see views.py).
 @type resend_conf: str
 @var resend_conf: The template for the page displayed after the
     confirmation email is resent upon user request.
+@type server_error: str
+@var server_error: The template for the 500 Server Error page.
 @type subscribe: str
 @var subscribe: The template for the page displaying the subscribe form.
 @type unsubscribe: str
@@ -36,9 +40,11 @@ confirm_pref = 'confirm_pref.html'
 error = 'error.html'
 fingerprint_not_found = 'fingerprint_not_found.html'
 home = 'home.html'
+not_found = '404.html'
 notification_info = 'notification_info.html'
 pending = 'pending.html'
 preferences = 'preferences.html'
 resend_conf = 'resend_conf.html'
+server_error = '500.html'
 subscribe = 'subscribe.html'
 unsubscribe = 'unsubscribe.html'
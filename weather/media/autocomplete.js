@@ -14,12 +14,15 @@
 var acListTotal   =  0;
 var acListCurrent = -1;
 var acDelay		  = 500;
+var acTimer		  = null;
 var acURL		  = null;
 var acSearchId	  = null;
 var acResultsId	  = null;
 var acSearchField = null;
 var acResultsDiv  = null;
 
+// get_url may also be a function(part, callback) that finds the results
+// itself and passes them to callback
 function setAutoComplete(field_id, results_id, get_url){
 
 	// initialize vars
@@ -58,8 +61,9 @@ function setAutoComplete(field_id, results_id, get_url){
 			return;
 		}
 
-		// if is text, call with delay
-		setTimeout(function () {autoComplete(lastVal)}, acDelay);
+		// if is text, call once the user stops typing
+		clearTimeout(acTimer);
+		acTimer = setTimeout(function () {autoComplete(lastVal)}, acDelay);
 	});
 }
 
@@ -80,8 +84,8 @@ function autoComplete(lastValue)
 		return;
 	}
 
-	// get remote data as JSON
-	$.getJSON(acURL + part, function(json){
+	// show the results of the search
+	var showResults = function(json){
 
 		// get the total of results
 		var ansLength = acListTotal = json.length;
@@ -118,7 +122,14 @@ function autoComplete(lastValue)
 		} else {
 			clearAutoComplete();
 		}
-	});
+	};
+
+	// get local results, or remote data as JSON
+	if(typeof acURL == "function"){
+		acURL(part, showResults);
+	} else {
+		$.getJSON(acURL + part, showResults);
+	}
 }
 
 // clear auto complete box
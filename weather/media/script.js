@@ -32,6 +32,73 @@ function showDefault(row, defVal) {
 	}
 }
 
+// The running relays as [name, fingerprint] pairs ordered by name, once the
+// relay directory has been loaded.
+var relayDirectory = null;
+
+// Loads the relay directory published after each consensus. Its URL changes
+// with its contents, so the browser may cache it.
+function loadRelayDirectory(url) {
+	if (!url) {
+		return;
+	}
+
+	$.ajax({url: url, dataType: "json", cache: true, success: function(json) {
+		relayDirectory = json;
+	}});
+}
+
+// Passes up to 20 relay names containing part to callback, asking the
+// server until the relay directory is loaded.
+function searchRelayNames(part, callback) {
+	if (part.length < 3) {
+		callback([]);
+		return;
+	}
+
+	if (relayDirectory === null) {
+		$.getJSON("/router_name_lookup/?query=" + encodeURIComponent(part),
+			callback);
+		return;
+	}
+
+	var needle = part.toLowerCase();
+	var names = [];
+	for (var i = 0; i < relayDirectory.length && names.length < 20; i++) {
+		var name = relayDirectory[i][0];
+		if (name.toLowerCase().indexOf(needle) != -1 &&
+				names[names.length - 1] != name) {
+			names.push(name);
+		}
+	}
+	callback(names);
+}
+
+// Passes the spaced fingerprint of the relay called name to callback, or
+// "nonunique_name" or "no_router" like the fingerprint lookup on the server.
+function lookupFingerprint(name, callback) {
+	if (relayDirectory !== null) {
+		var found = [];
+		for (var i = 0; i < relayDirectory.length; i++) {
+			if (relayDirectory[i][0] == name) {
+				found.push(relayDirectory[i][1]);
+			}
+		}
+
+		if (found.length > 1) {
+			callback("nonunique_name");
+			return;
+		} else if (found.length == 1) {
+			callback(found[0].match(/.{4}/g).join(" "));
+			return;
+		}
+	}
+
+	// Relays that aren't running aren't in the directory, ask the server.
+	$.getJSON("/router_fingerprint_lookup/?query=" + encodeURIComponent(name),
+		callback);
+}
+
 $(document).ready(function() {
 	// Expands/collapses sections.
 	showOrHideSect("input#id_get_node_down", "div#node-down-section");
@@ -59,7 +126,11 @@ $(document).ready(function() {
 	// Autocomplete setup, which seems to only work if the field is visible
 	// when it's set up.
 	searchContainer.show();
-	setAutoComplete("router_search", "search-results", "/router_name_lookup/?query=");
+	if (typeof relayDirectoryURL != "undefined") {
+		loadRelayDirectory(relayDirectoryURL);
+	}
+	acDelay = 150;
+	setAutoComplete("router_search", "search-results", searchRelayNames);
 	searchContainer.hide();
 
 	// Expands/collapses search field area.
@@ -91,7 +162,7 @@ $(document).ready(function() {
 		var noRouterError = "Please enter a valid router name:";
 		var defaultLabel = "Enter router name, then click the arrow:";
 
-		$.getJSON("/router_fingerprint_lookup/?query=" + searchField.val(), function(json) {
+		lookupFingerprint(searchField.val(), function(json) {
 			if (json == "nonunique_name") {
 				fingerprintField.val("");
 				searchLabel.html(nonuniqueError);
@@ -24,6 +24,13 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        # Seconds a statement waits for another connection's write lock
+        # before failing with "database is locked". The updater writes in
+        # short transactions (see weatherapp/database.py), so waits are
+        # normally much shorter than this.
+        'OPTIONS': {
+            'timeout': 10,
+        },
     }
 }
 
@@ -68,13 +75,21 @@ ADMIN_MEDIA_PREFIX = '/admin_media/'
 SECRET_KEY = 'f3d-wd6=2ajeik(ane)ynxp(ho-h4=_=g=l$rg8d=5$kff-w6l'
 
 # List of callables that know how to import templates from various sources.
+# The cached loader compiles each template once per process.
 TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.Loader',
-    'django.template.loaders.app_directories.Loader',
-#     'django.template.loaders.eggs.Loader',
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+#         'django.template.loaders.eggs.Loader',
+    )),
 )
 
+# Per-process cache for the pages that only depend on their URL.
+CACHE_BACKEND = 'locmem://'
+CACHE_MIDDLEWARE_KEY_PREFIX = 'weather'
+
 MIDDLEWARE_CLASSES = (
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -91,10 +106,6 @@ TEMPLATE_DIRS = (
     os.path.join(PROJECT_PATH, 'templates'),
 )
 
-OPTIONS = {
-    "timeout": 60,
-}
-
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
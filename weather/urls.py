@@ -3,10 +3,15 @@ corresponding controllers (see views).
 
 @var urlpatterns: A set of tuples mapping url patterns to the controller they
     should call.
+@var handler404: The controller for pages that don't exist.
+@var handler500: The controller for server errors.
 """
 
 from django.conf.urls.defaults import *
 
+handler404 = 'weatherapp.views.page_not_found'
+handler500 = 'weatherapp.views.server_error'
+
 urlpatterns = patterns('',
     (r'^$', 'weatherapp.views.home'),
     (r'^subscribe/$', 'weatherapp.views.subscribe'),
@@ -31,7 +36,9 @@ urlpatterns = patterns('',
                         'weatherapp.views.router_fingerprint_lookup'),
     
     # This is for serving static files for the development server, mainly for
-    # getting the CSS file and jquery file.
+    # getting the CSS file and jquery file. It never serves the compressed
+    # copies of the bundles; in production the web server serves /media/
+    # (see doc/INSTALL).
     (r'^media/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': 'media'}),
 )
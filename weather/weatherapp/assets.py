@@ -0,0 +1,273 @@
+"""
+This module builds the JavaScript and CSS files in the media directory into
+bundles: each bundle's source files are concatenated, minified, named after a
+hash of the result and stored next to gzip (and, if the brotli module is
+installed, brotli) compressed copies. Because a bundle's name changes
+whenever its contents do, the web server can let browsers cache bundles for
+good. The compressed copies are only served by a web server configured to
+pick them, see step 7a of doc/INSTALL; Django's development server serves
+the uncompressed bundles. The templates ask L{bundle_urls} for the URLs to include, which falls
+back to the separate source files as long as no bundles have been built.
+
+@var media_dir: The directory holding the source files.
+@var build_dir: The directory the bundles are written to.
+@var build_url: The URL L{build_dir} is served under.
+@var manifest_file: The file mapping bundle names to built file names.
+@var BUNDLES: The source files of each bundle, in the order they are
+    concatenated.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.utils import simplejson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+media_dir = os.path.join(settings.PROJECT_PATH, 'media')
+build_dir = os.path.join(media_dir, 'build')
+build_url = '/media/build/'
+manifest_file = os.path.join(build_dir, 'manifest.json')
+
+BUNDLES = {
+    'base.css': ['style.css'],
+    'form.js': ['jquery-1.4.2.js', 'script.js'],
+    'subscribe.js': ['dimensions.js', 'autocomplete.js'],
+    'subscribe.css': ['autocomplete.css'],
+}
+
+#Source files that are minified already
+_MINIFIED = set(['jquery-1.4.2.js'])
+
+_manifest = None
+_manifest_mtime = None
+_manifest_version = ''
+
+def minify_js(source):
+    """
+    Remove the indentation, trailing whitespace and blank lines from the
+    JavaScript C{source}, and the comments that take up whole lines. The
+    rest of each line is left as it is: telling a regular expression
+    literal from a division takes a parser, and gzip compresses what is
+    left anyway. Line breaks are kept, since the scripts rely on them to end
+    statements. Comments starting with '/*!' are kept as well, they hold
+    license notices.
+
+    @type source: str
+    @param source: The script.
+    @rtype: str
+    @return: The minified script.
+    """
+
+    lines = []
+    #None outside a comment block, else whether the block is kept
+    keep_comment = None
+    #Whether a line may have opened a comment block, in which case the lines
+    #up to the next '*/' are only stripped
+    maybe_comment = False
+    continued = False
+
+    for line in source.split('\n'):
+        if continued:
+            #The line continues a string literal
+            lines.append(line)
+            continued = line.endswith('\\')
+            continue
+
+        line = line.strip()
+        if maybe_comment:
+            lines.append(line)
+            continued = line.endswith('\\')
+            if '*/' in line:
+                maybe_comment = _opens_comment(line)
+            continue
+
+        if keep_comment is None and line.startswith('/*'):
+            keep_comment = line.startswith('/*!')
+            start = 2
+        else:
+            start = 0
+
+        if keep_comment is not None:
+            end = line.find('*/', start)
+            if end == -1:
+                if keep_comment:
+                    lines.append(line)
+                continue
+            rest = line[end + 2:].strip()
+            if keep_comment:
+                line = (line[:end + 2] + ' ' + rest).strip()
+            else:
+                line = rest
+            keep_comment = None
+
+        if line and not line.startswith('//'):
+            lines.append(line)
+            continued = line.endswith('\\')
+            maybe_comment = _opens_comment(line)
+
+    return '\n'.join([line for line in lines if line]) + '\n'
+
+def _opens_comment(line):
+    """Check if C{line} may leave a comment block open: it has a '/*' after
+    its last '*/'. The '/*' may be part of a literal instead."""
+
+    end = line.rfind('*/')
+    if end != -1:
+        line = line[end + 2:]
+    return '/*' in line
+
+def minify_css(source):
+    """
+    Remove the comments and needless whitespace from the stylesheet
+    C{source}.
+
+    @type source: str
+    @param source: The stylesheet.
+    @rtype: str
+    @return: The minified stylesheet.
+    """
+
+    source = re.sub(r'/\*.*?\*/', '', source, flags = re.DOTALL)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r' ?([{};,]) ?', r'\1', source)
+    #Only inside declaration blocks, in selectors 'a :hover' isn't 'a:hover'
+    source = re.sub(r'\{[^{}]*\}',
+                    lambda block: re.sub(r' ?: ?', ':', block.group()), source)
+    return source.replace(';}', '}').strip() + '\n'
+
+def build_bundle(name):
+    """
+    Build the bundle C{name} and write it and its compressed copies to
+    L{build_dir}.
+
+    @type name: str
+    @param name: The name of the bundle, a key of L{BUNDLES}.
+    @rtype: tuple (str, int, int)
+    @return: The built file name, the size of the sources and the size of
+        the gzipped bundle.
+    """
+
+    minify = name.endswith('.js') and minify_js or minify_css
+    parts = []
+    source_size = 0
+    for filename in BUNDLES[name]:
+        source = open(os.path.join(media_dir, filename)).read()
+        source_size += len(source)
+        if filename not in _MINIFIED:
+            source = minify(source)
+        parts.append(source.rstrip('\n') + (name.endswith('.js') and
+                                            ';\n' or '\n'))
+    data = ''.join(parts)
+
+    base, extension = os.path.splitext(name)
+    built = '%s.%s%s' % (base, hashlib.sha1(data).hexdigest()[:12], extension)
+    path = os.path.join(build_dir, built)
+
+    _write(path, data)
+    zipped = open(path + '.gz', 'wb')
+    try:
+        #A fixed mtime keeps the output the same for the same input
+        archive = gzip.GzipFile(filename = '', mode = 'wb', compresslevel = 9,
+                                fileobj = zipped, mtime = 0)
+        archive.write(data)
+        archive.close()
+    finally:
+        zipped.close()
+    if brotli is not None:
+        _write(path + '.br', brotli.compress(data))
+
+    return built, source_size, os.path.getsize(path + '.gz')
+
+def build_all():
+    """
+    Build all bundles and write the manifest.
+
+    @rtype: dict {str: tuple (str, int, int)}
+    @return: What L{build_bundle} returned for each bundle.
+    """
+
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+
+    results = {}
+    for name in sorted(BUNDLES):
+        results[name] = build_bundle(name)
+
+    manifest = dict([(name, result[0]) for name, result in results.items()])
+    _write(manifest_file, simplejson.dumps(manifest, indent = 2,
+                                           sort_keys = True))
+    return results
+
+def _write(path, data):
+    """Write C{data} to C{path}, replacing the file in one step."""
+
+    temp = open(path + '.tmp', 'wb')
+    try:
+        temp.write(data)
+    finally:
+        temp.close()
+    os.rename(path + '.tmp', path)
+
+def get_manifest():
+    """
+    Get the built file name of each bundle, reading L{manifest_file} again
+    whenever it changed.
+
+    @rtype: dict {str: str}
+    @return: The built file names keyed by bundle name, empty if no bundles
+        have been built.
+    """
+
+    global _manifest, _manifest_mtime, _manifest_version
+
+    try:
+        mtime = os.stat(manifest_file).st_mtime
+    except OSError:
+        return {}
+
+    if _manifest is None or mtime != _manifest_mtime:
+        manifest = open(manifest_file)
+        try:
+            data = manifest.read()
+        finally:
+            manifest.close()
+        _manifest = simplejson.loads(data)
+        _manifest_mtime = mtime
+        _manifest_version = hashlib.sha1(data).hexdigest()[:12]
+    return _manifest
+
+def manifest_version():
+    """
+    Get a short hash of the current manifest, which changes whenever a
+    bundle does.
+
+    @rtype: str
+    @return: The hash, or the empty string if no bundles have been built.
+    """
+
+    if not get_manifest():
+        return ''
+    return _manifest_version
+
+def bundle_urls(name):
+    """
+    Get the URLs to include for the bundle C{name}.
+
+    @type name: str
+    @param name: The name of the bundle, a key of L{BUNDLES}.
+    @rtype: list [str]
+    @return: The URL of the built bundle, or of each of its source files if
+        it hasn't been built.
+    """
+
+    built = get_manifest().get(name)
+    if built:
+        return [build_url + built]
+    return ['/media/' + filename for filename in BUNDLES[name]]
@@ -1,14 +1,21 @@
 """
 This module contains the CtlUtil class. CtlUtil objects set up a connection to
 Stem and handle communication concerning consensus documents and descriptor
-files.
+files. The documents are fetched in bulk once per consensus and held in a
+L{ConsensusSnapshot}, which answers all per-relay queries from memory.
 
 @var unparsable_email_file: A log file for contacts with unparsable emails.
+@var contact_cache_file: The file the parsed contact lines are stored in
+    between runs.
 """
 
+import cPickle
 import logging
+import os
 import re
 import string
+import threading
+from collections import OrderedDict
 
 import stem.version
 
@@ -16,8 +23,367 @@ from stem import Flag
 from stem.control import Controller
 from config import config
 
+from django.conf import settings
+
 #for unparsable emails
 unparsable_email_file = 'log/unparsable_emails.txt'
+contact_cache_file = os.path.join(settings.PROJECT_PATH, '..', 'var',
+                                  'contacts.cache')
+
+#Patterns for digging obscured email addresses out of contact lines
+_PUNCT = re.escape(string.punctuation)
+_EMAIL_RE = re.compile('[^\s]+(?:@|['+_PUNCT+'\s]+at['+_PUNCT+'\s]+).+(?:\.'+
+                       '|['+_PUNCT+'\s]+dot['+_PUNCT+'\s]+)[^\n\s\)\(]+',
+                       re.IGNORECASE)
+_AT_RE = re.compile('['+_PUNCT+'\s]+at['+_PUNCT+'\s]+')
+_DOT_RE = re.compile('['+_PUNCT+'\s]+dot['+_PUNCT+'\s]+')
+
+class ConsensusSnapshot:
+    """
+    An in-memory copy of the router status entries of the current consensus,
+    the server descriptors tor knows about, and the recommended versions list,
+    indexed by fingerprint.
+
+    @type statuses: dict {str: RouterStatusEntryV3}
+    @ivar statuses: Router status entries from the consensus, keyed by
+        fingerprint.
+    @type descriptors: dict {str: RelayDescriptor}
+    @ivar descriptors: Server descriptors, keyed by fingerprint.
+    @type descriptor_order: list [str]
+    @ivar descriptor_order: The fingerprints of L{descriptors} in the order
+        tor listed them.
+    @type rec_versions: list [str]
+    @ivar rec_versions: The currently recommended Tor versions.
+    @type version_classifier: L{VersionClassifier}
+    @ivar version_classifier: Classifies versions against L{rec_versions}.
+    """
+
+    def __init__(self, statuses, descriptors, rec_versions):
+        """
+        Index the router status entries C{statuses} and the server
+        descriptors C{descriptors} by fingerprint.
+
+        @type statuses: iterable
+        @param statuses: The router status entries of the consensus.
+        @type descriptors: iterable
+        @param descriptors: The server descriptors.
+        @type rec_versions: list [str]
+        @param rec_versions: The currently recommended Tor versions.
+        """
+
+        self.statuses = {}
+        for status in statuses:
+            self.statuses[status.fingerprint] = status
+
+        self.descriptors = {}
+        self.descriptor_order = []
+        for desc in descriptors:
+            if desc.fingerprint:
+                if desc.fingerprint not in self.descriptors:
+                    self.descriptor_order.append(desc.fingerprint)
+                self.descriptors[desc.fingerprint] = desc
+
+        self.rec_versions = rec_versions
+        self.version_classifier = VersionClassifier(rec_versions)
+
+    def get_status(self, fingerprint):
+        """
+        Get the router status entry for the relay with fingerprint
+        C{fingerprint}.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the Tor relay.
+        @rtype: RouterStatusEntryV3
+        @return: The relay's router status entry, or C{None} if the relay
+            isn't in the consensus.
+        """
+
+        return self.statuses.get(fingerprint)
+
+    def get_descriptor(self, fingerprint):
+        """
+        Get the server descriptor for the relay with fingerprint
+        C{fingerprint}.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the Tor relay.
+        @rtype: RelayDescriptor
+        @return: The relay's server descriptor, or C{None} if tor doesn't
+            have one.
+        """
+
+        return self.descriptors.get(fingerprint)
+
+class VersionClassifier:
+    """
+    Sorts Tor versions into RECOMMENDED and OBSOLETE according to one
+    recommended versions list. The list is parsed once, and the verdict for
+    each version string is remembered, since only a few dozen different
+    versions run on the network at any time.
+
+    @type rec_versions: list [str]
+    @ivar rec_versions: The recommended versions.
+    @type highest: stem.version.Version
+    @ivar highest: The highest recommended version, or C{None} if the list is
+        empty.
+    @type verdicts: dict {str: str}
+    @ivar verdicts: The version types found so far, keyed by version string.
+    """
+
+    def __init__(self, rec_versions):
+        """
+        Parse the recommended versions C{rec_versions}.
+
+        @type rec_versions: list [str]
+        @param rec_versions: The currently recommended Tor versions.
+        """
+
+        self.rec_versions = set([v for v in rec_versions if v])
+        self.highest = None
+        for v in self.rec_versions:
+            try:
+                parsed = stem.version.Version(v)
+            except ValueError:
+                logging.error("Can't parse recommended version '%s'" % v)
+                continue
+            if self.highest is None or parsed > self.highest:
+                self.highest = parsed
+        self.verdicts = {}
+
+    def classify(self, version):
+        """
+        Get the type of the Tor version C{version}, see
+        L{CtlUtil.get_version_type}.
+
+        @type version: str
+        @param version: The version string to classify.
+        @rtype: str
+        @return: RECOMMENDED or OBSOLETE.
+        """
+
+        verdict = self.verdicts.get(version)
+        if verdict is None:
+            verdict = self._classify(version)
+            self.verdicts[version] = verdict
+        return verdict
+
+    def _classify(self, version):
+        # Special case when the dirauth can't agree on recommended versions,
+        # the list is empty. In that case we play along as if everything was
+        # fine
+        if not self.rec_versions:
+            return 'RECOMMENDED'
+
+        if version in self.rec_versions:
+            return 'RECOMMENDED'
+
+        # Check if the user is running a more recent dev version than is found
+        # in the `recommended' list
+        if version.endswith("-dev"):
+            try:
+                parsed = stem.version.Version(version)
+            except ValueError:
+                return 'OBSOLETE'
+            if self.highest is None or \
+               str(max(self.highest, parsed)) == version:
+                return 'RECOMMENDED'
+
+            # If 0.2.1.34 is stable, that means 0.2.1.34-dev is fine, too.
+            if version.replace("-dev", "") in self.rec_versions:
+                return 'RECOMMENDED'
+
+        return 'OBSOLETE'
+
+class ContactCache:
+    """
+    Parses email addresses out of descriptor contact lines, remembering the
+    results for the most recently used L{_MAX_SIZE} contact lines. Contact
+    lines an address can't be parsed from are collected until
+    L{report_unparsable} writes them out. If the cache has a file, it is
+    read before the first lookup and L{store} writes it back, so the
+    results outlive the process.
+
+    @type _MAX_SIZE: int
+    @cvar _MAX_SIZE: The most contact lines whose results are kept.
+    @type max_size: int
+    @ivar max_size: The most contact lines whose results this cache keeps.
+    @type filename: str
+    @ivar filename: The file the cache is stored in, or C{None}.
+    @type cache: OrderedDict {str: str}
+    @ivar cache: Parsed email addresses keyed by contact line, least recently
+        used first.
+    @type unparsable: list [str]
+    @ivar unparsable: Unparsable contact lines that haven't been reported.
+    """
+
+    _MAX_SIZE = 20000
+
+    def __init__(self, max_size = _MAX_SIZE, filename = None):
+        self.max_size = max_size
+        self.filename = filename
+        self.cache = OrderedDict()
+        self.unparsable = []
+        self._lock = threading.Lock()
+        self._loaded = filename is None
+
+    def _load(self):
+        """Read the cache from L{filename}, starting empty if it can't be
+        read. Must be called with the lock held."""
+
+        self._loaded = True
+        try:
+            stored = open(self.filename, 'rb')
+            try:
+                items = cPickle.load(stored)
+            finally:
+                stored.close()
+        except IOError:
+            #Nothing was stored yet
+            return
+        except (EOFError, cPickle.UnpicklingError, ValueError,
+                TypeError), e:
+            logging.error('Could not read %s: %s' % (self.filename, e))
+            return
+        for contact, email in items[-self.max_size:]:
+            self.cache[contact] = email
+
+    def store(self):
+        """
+        Write the cache to L{filename}, if it has one. The file is replaced
+        in one step, so a crash never leaves half of it.
+
+        @rtype: int
+        @return: The number of contact lines written.
+        """
+
+        if self.filename is None:
+            return 0
+
+        self._lock.acquire()
+        try:
+            #Don't replace the stored lines with an empty cache after a
+            #restart without lookups
+            if not self._loaded:
+                self._load()
+            items = self.cache.items()
+        finally:
+            self._lock.release()
+
+        try:
+            temp = open(self.filename + '.tmp', 'wb')
+            try:
+                cPickle.dump(items, temp, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                temp.close()
+            os.rename(self.filename + '.tmp', self.filename)
+        except EnvironmentError, e:
+            logging.error('Could not write %s: %s' % (self.filename, e))
+            return 0
+        return len(items)
+
+    def get_email(self, contact):
+        """
+        Get the email address in the contact line C{contact}.
+
+        @type contact: str
+        @param contact: The contact line from a server descriptor.
+        @rtype: str
+        @return: The email address, or the empty string if it can't be
+            parsed.
+        """
+
+        if not contact:
+            return ''
+
+        self._lock.acquire()
+        try:
+            if not self._loaded:
+                self._load()
+            if contact in self.cache:
+                #Move it to the most recently used end
+                email = self.cache.pop(contact)
+            else:
+                email = _parse_email(contact)
+                if email == '':
+                    logging.info("Couldn't parse an email address from " \
+                                 "line:\n%s" % contact)
+                    self.unparsable.append(contact)
+                if len(self.cache) >= self.max_size:
+                    self.cache.popitem(last = False)
+            self.cache[contact] = email
+            return email
+        finally:
+            self._lock.release()
+
+    def report_unparsable(self, filename):
+        """
+        Append the unreported unparsable contact lines to C{filename}, one
+        per line.
+
+        @type filename: str
+        @param filename: The file to append to.
+        @rtype: int
+        @return: The number of contact lines written.
+        """
+
+        self._lock.acquire()
+        try:
+            contacts, self.unparsable = self.unparsable, []
+        finally:
+            self._lock.release()
+
+        if contacts:
+            try:
+                report = open(filename, 'a')
+                try:
+                    report.write(''.join([contact.replace('\n', ' ') + '\n'
+                                          for contact in contacts]))
+                finally:
+                    report.close()
+            except IOError, e:
+                logging.error('Could not write unparsable contacts: %s' % e)
+        return len(contacts)
+
+def _parse_email(contact):
+    """
+    Parse the email address from the contact line C{contact}.
+
+    @type contact: str
+    @param contact: The contact line from a server descriptor.
+    @rtype: str
+    @return: The email address, or the empty string if it can't be parsed.
+    """
+
+    clean_line = contact.replace('<', ' ').replace('>', ' ')
+    email = _EMAIL_RE.search(clean_line)
+    if email == None:
+        return ''
+
+    email = email.group().lower()
+    email = _AT_RE.sub('@', email)
+    email = _DOT_RE.sub('.', email)
+    return email.replace(' d0t ', '.').replace(' hyphen ', '-').\
+           replace(' ', '')
+
+def new_avg_bandwidth(avg_bandwidth, hours_up, obs_bandwidth):
+    """
+    Calculate the new average bandwidth of a router in kB/s, rounding rather
+    than truncating.
+
+    @type avg_bandwidth: int
+    @param avg_bandwidth: The current average bandwidth of the router in
+        kB/s.
+    @type hours_up: int
+    @param hours_up: The number of hours the router has been up.
+    @type obs_bandwidth: int
+    @param obs_bandwidth: The observed bandwidth in kB/s from the router's
+        most recent descriptor.
+    @rtype: int
+    @return: The new average bandwidth in kB/s.
+    """
+
+    return int(round(float(hours_up * avg_bandwidth + obs_bandwidth) /
+                     (hours_up + 1)))
 
 class CtlUtil:
     """
@@ -30,6 +396,10 @@ class CtlUtil:
     @type _AUTHENTICATOR: str
     @cvar _AUTHENTICATOR: Constant for the authenticator string of the Stem
         connection.
+    @type _contacts: L{ContactCache}
+    @cvar _contacts: The parsed contact lines, shared by all instances so
+        they outlive a connection, and stored in L{contact_cache_file} so
+        they outlive the process.
 
     @type control_host: str
     @ivar control_host: Control host of the Stem connection.
@@ -41,22 +411,39 @@ class CtlUtil:
     @ivar authenticator: Authenticator string of the Stem connection.
     @type control: Stem Connection
     @ivar control: Connection to Stem.
+    @type snapshot: L{ConsensusSnapshot}
+    @ivar snapshot: The documents of the current consensus, or C{None} until
+        they are first requested.
+    @type stem_calls: int
+    @ivar stem_calls: The number of requests sent to tor since the connection
+        was opened.
     """
 
     _CONTROL_HOST = '127.0.0.1'
     _CONTROL_PORT = config.control_port
     _AUTHENTICATOR = config.authenticator
+    _contacts = ContactCache(filename = contact_cache_file)
 
     def __init__(self, control_host = _CONTROL_HOST,
                 control_port = _CONTROL_PORT, sock = None,
-                authenticator = _AUTHENTICATOR):
+                authenticator = _AUTHENTICATOR, controller = None):
         """
         Initialize the CtlUtil object, connect to Stem.
+
+        @type controller: stem.control.Controller
+        @param controller: An already authenticated controller to use instead
+            of opening a new connection.
         """
 
         self.control_host = control_host
         self.control_port = control_port
         self.authenticator = authenticator
+        self.snapshot = None
+        self.stem_calls = 0
+
+        if controller is not None:
+            self.control = controller
+            return
 
         try:
             self.control = Controller.from_port(port = self.control_port)
@@ -65,7 +452,7 @@ class CtlUtil:
             raise exc
 
         # Authenticate connection
-        self.control.authenticate(config.authenticator)
+        self.control.authenticate(self.authenticator)
 
     def __del__(self):
         """
@@ -75,13 +462,65 @@ class CtlUtil:
 
         self.control.close()
 
+    def is_alive(self):
+        """
+        Check if the connection to tor is still open.
+
+        @rtype: bool
+        @return: C{True} if the connection is open, C{False} otherwise.
+        """
+
+        return self.control.is_alive()
+
+    def reconnect(self):
+        """
+        Reopen and authenticate the connection to tor after it was lost.
+        Event listeners added to L{control} are attached again by Stem.
+        """
+
+        self.control.connect()
+        self.control.authenticate(self.authenticator)
+        self.stem_calls += 2
+
+    def refresh_snapshot(self):
+        """
+        Fetch the current consensus, all server descriptors and the
+        recommended versions list from tor and replace L{snapshot} with them.
+        This should be called once per new consensus.
+
+        @rtype: L{ConsensusSnapshot}
+        @return: The new snapshot.
+        """
+
+        statuses = self.control.get_network_statuses([])
+        descriptors = self.control.get_server_descriptors([])
+        rec_versions = self.control.get_info("status/version/recommended",
+                                             "").split(',')
+        self.stem_calls += 3
+
+        self.snapshot = ConsensusSnapshot(statuses, descriptors, rec_versions)
+        return self.snapshot
+
+    def get_snapshot(self):
+        """
+        Get the current L{ConsensusSnapshot}, fetching it from tor if this
+        hasn't been done yet.
+
+        @rtype: L{ConsensusSnapshot}
+        @return: The current snapshot.
+        """
+
+        if self.snapshot is None:
+            self.refresh_snapshot()
+        return self.snapshot
+
     def get_rec_version_list(self):
         """
         Get a list of currently recommended versions sorted in ascending
         order.
         """
 
-        return self.control.get_info("status/version/recommended", "").split(',')
+        return list(self.get_snapshot().rec_versions)
 
     def get_version(self, fingerprint):
         """
@@ -96,11 +535,10 @@ class CtlUtil:
                  '' if the version cannot be retrieved.
         """
 
-        try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return str(desc.tor_version)
-        except stem.ControllerError:
+        desc = self.get_snapshot().get_descriptor(fingerprint)
+        if desc is None:
             return ''
+        return str(desc.tor_version)
 
     def get_highest_version(self, versionlist):
         """
@@ -137,43 +575,19 @@ class CtlUtil:
         If the version cannot be determined, return ERROR.
         """
 
-        version_list = self.get_rec_version_list()
         client_version = self.get_version(fingerprint)
 
         if client_version == '':
             return 'ERROR'
 
-        # Special case when the dirauth can't agree on recommended versions,
-        # the list is empty. In that case we play along as if everything was
-        # fine
-
-        if not version_list:
-            return 'RECOMMENDED'
-
-        if client_version in version_list:
-            return 'RECOMMENDED'
-
-        # Check if the user is running a more recent dev version than is found
-        # in the `recommended' list
-
-        if client_version.endswith("-dev"):
-            version_list.append(client_version)
-            if self.get_highest_version(version_list) == client_version:
-                return 'RECOMMENDED'
-
-            # If 0.2.1.34 is stable, that means 0.2.1.34-dev is fine, too.
-            nondev_name = client_version.replace("-dev", "")
-            if nondev_name in version_list:
-                return 'RECOMMENDED'
-
-        return 'OBSOLETE'
+        return self.get_snapshot().version_classifier.classify(client_version)
 
     def is_up(self, fingerprint):
         """
-        Check if this node is up (actively running) by requesting a consensus
-        document for node C{fingerprint}. If a document is received
-        successfully, then the node is up; if a document is not received, then
-        the router is down. If a node is hiberanating, it will return C{False}.
+        Check if this node is up (actively running) by looking for a consensus
+        entry for node C{fingerprint}. If there is one, then the node is up;
+        if there isn't, then the router is down. If a node is hibernating, it
+        will return C{False}.
 
         @type fingerprint: str
         @param fingerprint: Fingerprint of the node in question.
@@ -181,11 +595,7 @@ class CtlUtil:
         @return: C{True} if the node is up, C{False} if it's down.
         """
 
-        try:
-            self.control.get_network_status(fingerprint)
-            return True
-        except:
-            return False
+        return self.get_snapshot().get_status(fingerprint) is not None
 
     def is_exit(self, fingerprint):
         """
@@ -198,12 +608,11 @@ class CtlUtil:
             or if the descriptor file can't be accessed for this router.
         """
 
-        try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return desc.exit_policy.can_exit_to(port = 80)
-        except stem.ControllerError, exc:
-            logging.error("Unable to get server descriptor for '%s': %s" % (fingerprint, exc))
+        desc = self.get_snapshot().get_descriptor(fingerprint)
+        if desc is None:
+            logging.error("No server descriptor for '%s'" % fingerprint)
             return False
+        return desc.exit_policy.can_exit_to(port = 80)
 
     def get_finger_name_list(self):
         """
@@ -215,18 +624,19 @@ class CtlUtil:
                  current descriptor file.
         """
 
+        snapshot = self.get_snapshot()
         router_list= []
 
-        for desc in self.control.get_server_descriptors([]):
-            if desc.fingerprint:
-                router_list.append((desc.fingerprint, desc.nickname))
+        for fingerprint in snapshot.descriptor_order:
+            desc = snapshot.get_descriptor(fingerprint)
+            router_list.append((fingerprint, desc.nickname))
 
         return router_list
 
     def get_new_avg_bandwidth(self, avg_bandwidth, hours_up, obs_bandwidth):
         """
-        Calculates the new average bandwidth for a router in kB/s. The average
-        is calculated by rounding rather than truncating.
+        Calculates the new average bandwidth for a router in kB/s, see
+        L{new_avg_bandwidth}.
 
         @type avg_bandwidth: int
         @param avg_bandwidth: The current average bandwidth for the router in
@@ -240,9 +650,7 @@ class CtlUtil:
         @return: The average bandwidth for this router in KB/s
         """
 
-        new_avg = float((hours_up*avg_bandwidth) + obs_bandwidth)/(hours_up + 1)
-        new_avg = int(round(new_avg))
-        return new_avg
+        return new_avg_bandwidth(avg_bandwidth, hours_up, obs_bandwidth)
 
     def get_email(self, fingerprint):
         """
@@ -256,11 +664,10 @@ class CtlUtil:
                 the email address is unable to be parsed.
         """
 
-        try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return self._unobscure_email(desc.contact)
-        except stem.ControllerError:
+        desc = self.get_snapshot().get_descriptor(fingerprint)
+        if desc is None:
             return ''
+        return self._unobscure_email(desc.contact)
 
     def is_stable(self, fingerprint):
         """
@@ -274,12 +681,11 @@ class CtlUtil:
         flag, false otherwise.
         """
 
-        try:
-            desc = self.control.get_network_status(fingerprint)
-            return Flag.Stable in desc.flags
-        except stem.ControllerError, e:
-            logging.error("Unable to get router status entry for '%s': %s" % (fingerprint, e))
+        status = self.get_snapshot().get_status(fingerprint)
+        if status is None:
+            logging.error("No router status entry for '%s'" % fingerprint)
             return False
+        return Flag.Stable in status.flags
 
     def is_hibernating(self, fingerprint):
         """
@@ -292,11 +698,10 @@ class CtlUtil:
         @return: True if the Tor relay has a current descriptor file with
         the hibernating flag, False otherwise."""
 
-        try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return desc.hibernating
-        except stem.ControllerError:
+        desc = self.get_snapshot().get_descriptor(fingerprint)
+        if desc is None:
             return False
+        return desc.hibernating
 
     def is_up_or_hibernating(self, fingerprint):
         """
@@ -323,15 +728,16 @@ class CtlUtil:
         @return: The observed bandwidth for this Tor relay.
         """
 
-        try:
-            desc = self.control.get_server_descriptor(fingerprint)
-            return desc.observed_bandwidth / 1000
-        except stem.ControllerError:
+        desc = self.get_snapshot().get_descriptor(fingerprint)
+        if desc is None:
             return 0
+        return desc.observed_bandwidth / 1000
 
     def _unobscure_email(self, contact):
         """
         Parse the email address from an individual router descriptor string.
+        Results are cached in L{_contacts}, so a contact line is only parsed
+        the first time it is seen.
 
         @type contact: str
         @param contact: Email address from the server descriptor.
@@ -340,27 +746,27 @@ class CtlUtil:
                 parsed, the empty string.
         """
 
-        punct = string.punctuation
-        clean_line = contact.replace('<', ' ').replace('>', ' ')
+        return CtlUtil._contacts.get_email(contact)
+
+    def report_unparsable_contacts(self):
+        """
+        Append the contact lines found unparsable since the last call to
+        L{unparsable_email_file}. This should be called once per consensus.
 
-        email = re.search('[^\s]+(?:@|['+punct+'\s]+at['+punct+'\s]+).+(?:\.'+
-                          '|['+punct+'\s]+dot['+punct+'\s]+)[^\n\s\)\(]+',
-                          clean_line, re.IGNORECASE)
+        @rtype: int
+        @return: The number of contact lines written.
+        """
 
-        if email == None:
-            logging.info("Couldn't parse an email address from line:\n%s" %
-                         contact)
-            unparsable = open(unparsable_email_file, 'w')
-            unparsable.write(contact + '\n')
-            unparsable.close()
-            email = ""
+        return CtlUtil._contacts.report_unparsable(unparsable_email_file)
 
-        else:
-            email = email.group()
-            email = email.lower()
-            email = re.sub('['+punct+'\s]+at['+punct+'\s]+', '@', email)
-            email = re.sub('['+punct+'\s]+dot['+punct+'\s]+', '.', email)
-            email = email.replace(' d0t ', '.').replace(' hyphen ', '-').\
-                    replace(' ', '')
+    def store_contacts(self):
+        """
+        Write the parsed contact lines to L{contact_cache_file}, so the next
+        run doesn't parse them again. This should be called once per
+        consensus.
+
+        @rtype: int
+        @return: The number of contact lines written.
+        """
 
-        return email
+        return CtlUtil._contacts.store()
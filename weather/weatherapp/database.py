@@ -0,0 +1,100 @@
+"""
+This module keeps the web pages and the updater from stalling each other on
+the SQLite database they share.
+
+Every new connection is switched to write-ahead logging, in which readers
+never wait for a writer and a writer never waits for readers; only writers
+wait for each other. The updater therefore writes in short transactions of
+a few hundred rows (see L{short_transaction}), so a web page that writes
+waits for at most one of them. How long SQLite waits for a lock before
+giving up is the 'timeout' in the database OPTIONS in settings.py. A
+transaction that still finds the database locked, or that can't upgrade
+its read snapshot to a write, is rolled back and run again up to
+L{LOCK_RETRIES} times.
+
+@var PRAGMAS: The statements run on every new SQLite connection.
+@var LOCK_RETRIES: How often a transaction is run again after it found the
+    database locked.
+@var RETRY_DELAY: The seconds to wait before the first retry. The delay
+    doubles with every further retry.
+"""
+
+import logging
+import time
+from functools import wraps
+
+from django.db import DatabaseError, transaction
+from django.db.backends.signals import connection_created
+from django.db.backends.sqlite3.base import Database
+
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    #Safe with WAL: a power loss can only lose the last commits, never
+    #corrupt the database
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    #In KiB
+    'PRAGMA cache_size = -16000',
+    #Truncate the write-ahead log to 64 MB after a checkpoint
+    'PRAGMA journal_size_limit = 67108864',
+]
+
+LOCK_RETRIES = 5
+RETRY_DELAY = 0.05
+
+def configure_connection(sender, connection, **kwargs):
+    """Run L{PRAGMAS} on a newly opened SQLite connection. Connected to
+    Django's C{connection_created} signal."""
+
+    if not connection.settings_dict['ENGINE'].endswith('sqlite3'):
+        return
+    for pragma in PRAGMAS:
+        connection.connection.execute(pragma)
+
+connection_created.connect(configure_connection,
+                           dispatch_uid = 'weatherapp.database')
+
+def is_locked(error):
+    """Check if the database error C{error} means another connection held a
+    lock the statement needed."""
+
+    return 'is locked' in str(error)
+
+def short_transaction(func):
+    """
+    Decorate C{func} to run in a transaction of its own, which is committed
+    when C{func} returns and rolled back if it raises. If it is rolled back
+    because the database was locked, C{func} is run again after a growing
+    delay, at most L{LOCK_RETRIES} times. C{func} must not have effects
+    outside the database that a retry would repeat.
+
+    @type func: callable
+    @param func: The function to decorate.
+    @rtype: callable
+    @return: The decorated function.
+    """
+
+    transactional = transaction.commit_on_success(func)
+
+    def run(*args, **kwargs):
+        for attempt in range(LOCK_RETRIES + 1):
+            try:
+                return transactional(*args, **kwargs)
+            #Django doesn't wrap the errors of COMMIT
+            except (DatabaseError, Database.DatabaseError), e:
+                if attempt == LOCK_RETRIES or not is_locked(e):
+                    raise
+                delay = RETRY_DELAY * 2 ** attempt
+                logging.warning('%s: %s, retrying in %.2f s.' %
+                                (getattr(func, '__name__', func), e, delay))
+                time.sleep(delay)
+
+    return wraps(func)(run)
+
+def atomically(func, *args, **kwargs):
+    """Call C{func} with C{args} and C{kwargs} in a L{short_transaction}.
+
+    @return: What C{func} returned.
+    """
+
+    return short_transaction(func)(*args, **kwargs)
@@ -1,5 +1,7 @@
-"""The emails module contains methods to send individual confirmation and confirmed emails as well as methods to return tuples needed by Django's 
-send_mass_mail() method. Emails are sent after all database checks/updates. 
+"""The emails module contains methods to return tuples in the format of
+Django's send_mass_mail() method for the confirmation and confirmed emails as
+well as for all notifications. The tuples are handed to the mailqueue module,
+notifications after all database checks/updates. 
 
 @type _SENDER: str
 @var _SENDER: The email address for the Tor Weather emailer
@@ -48,14 +50,22 @@ send_mass_mail() method. Emails are sent after all database checks/updates.
 @type _GENERIC_FOOTER: str
 @var _GENERIC_FOOTER: A footer containing unsubscribe and preferences page
     links.
+@type _REPORT_INTRO: str
+@var _REPORT_INTRO: The first line of all notification emails, which is left
+    out of the parts of a digest.
+@type _DIGEST_SUBJ: str
+@var _DIGEST_SUBJ: The subject line for a digest of several notifications.
+@type _DIGEST_MAIL: str
+@var _DIGEST_MAIL: The start of a digest email, followed by the
+    notifications it combines.
+@type _DIGEST_SEPARATOR: str
+@var _DIGEST_SEPARATOR: The line between two notifications in a digest.
 """
 import re
 
 from config import url_helper
 from weatherapp.models import insert_fingerprint_spaces
 
-from django.core.mail import send_mail
-
 _SENDER = 'tor-ops@torproject.org'
 _SUBJECT_HEADER = '[Tor Weather] '
 
@@ -139,6 +149,14 @@ _GENERIC_FOOTER = "\n\nYou can unsubscribe from these reports at any time "+\
     "by visiting the following url:\n\n%s\n\nor change your Tor Weather "+\
     "notification preferences here: \n\n%s"
 
+_REPORT_INTRO = "This is a Tor Weather Report.\n\n"
+
+_DIGEST_SUBJ = '%d Reports About Your Nodes'
+_DIGEST_MAIL = _REPORT_INTRO +\
+    "Here are %d reports about the Tor nodes you've been observing, " +\
+    "collected into one email.\n\n"
+_DIGEST_SEPARATOR = "\n\n" + "-" * 72 + "\n\n"
+
 
 def _get_router_name(fingerprint, name):
     """Returns a string representation of the name and fingerprint of
@@ -183,12 +201,10 @@ def _add_generic_footer(msg, unsubs_auth, pref_auth):
     
     return msg + footer
 
-def send_confirmation(recipient, fingerprint, name, confirm_auth):
-    """This method sends a confirmation email to the user. The email 
-    contains a complete link to the confirmation page, which the user 
-    must follow in order to subscribe. The Django method send_mail is
-    called with fail_silently=True so that an error is not thrown if the
-    mail isn't successfully delivered.
+def confirmation_tuple(recipient, fingerprint, name, confirm_auth):
+    """Returns the tuple for the confirmation email sent to the user after
+    subscribing. The email contains a complete link to the confirmation
+    page, which the user must follow in order to subscribe.
     
     @type recipient: str
     @param recipient: The user's email address
@@ -197,18 +213,21 @@ def send_confirmation(recipient, fingerprint, name, confirm_auth):
         monitor.
     @type confirm_auth: str
     @param confirm_auth: The user's unique confirmation authorization key.
+    @rtype: tuple
+    @return: A tuple listing information about the email to be sent, which is
+        queued by the mailqueue module in views.
     """
     router = _get_router_name(fingerprint, name)
     confirm_url = url_helper.get_confirm_url(confirm_auth)
     msg = _CONFIRMATION_MAIL % (router, confirm_url)
     sender = _SENDER
     subj = _SUBJECT_HEADER + _CONFIRMATION_SUBJ
-    send_mail(subj, msg, sender, [recipient], fail_silently=True)
+    return (subj, msg, sender, [recipient])
 
-def send_confirmed(recipient, fingerprint, name, unsubs_auth, pref_auth):
-    """Sends an email to the user after their subscription is successfully
-    confirmed. The email contains links to change preferences and 
-    unsubscribe.
+def confirmed_tuple(recipient, fingerprint, name, unsubs_auth, pref_auth):
+    """Returns the tuple for the email sent to the user after their
+    subscription is successfully confirmed. The email contains links to
+    change preferences and unsubscribe.
     
     @type recipient: str
     @param recipient: The user's email address
@@ -219,13 +238,16 @@ def send_confirmed(recipient, fingerprint, name, unsubs_auth, pref_auth):
     @param unsubs_auth: The user's unique unsubscribe auth key
     @type pref_auth: str
     @param pref_auth: The user's unique preferences auth key
+    @rtype: tuple
+    @return: A tuple listing information about the email to be sent, which is
+        queued by the mailqueue module in views.
     """
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _CONFIRMED_SUBJ
     sender = _SENDER
     msg = _CONFIRMED_MAIL % router
     msg = _add_generic_footer(msg, unsubs_auth, pref_auth)
-    send_mail(subj, msg, sender, [recipient], fail_silently=False)
+    return (subj, msg, sender, [recipient])
 
 def bandwidth_tuple(recipient, fingerprint, name,  observed, threshold,
                     unsubs_auth, pref_auth):
@@ -269,7 +291,7 @@ def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth,
     @param pref_auth: The user's unique preferences auth key
     @rtype: tuple
     @return: A tuple listing information about the email to be sent, which is
-        used by the send_mass_mail method in updaters.
+        queued by the mailqueue module in updaters.
     """
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _NODE_DOWN_SUBJ
@@ -302,7 +324,7 @@ def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth,
     @param pref_auth: The user's unique preferences auth key
     @rtype: tuple
     @return: A tuple listing information about the email to be sent, which is
-        used by the send_mass_mail method in updaters.
+        queued by the mailqueue module in updaters.
     """
     router = _get_router_name(fingerprint, name)
     stable_message = 'running'
@@ -330,7 +352,7 @@ def welcome_tuple(recipient, fingerprint, name, exit):
     @param exit: C{True} if the router is an exit node, C{False} if not.
     @rtype: tuple
     @return: A tuple listing information about the email to be sent, which is
-        used by the send_mass_mail method in updaters.
+        queued by the mailqueue module in updaters.
     """
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _WELCOME_SUBJ
@@ -357,7 +379,7 @@ def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth,
 
     @rtype: tuple
     @return: A tuple containing information about the email to be sent in
-             an appropriate format for the C{send_mass_mail()} function in
+             an appropriate format for the C{mailqueue.enqueue()} function in
              C{updaters}.
     """
     router = _get_router_name(fingerprint, name)
@@ -369,3 +391,69 @@ def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth,
     msg = _add_generic_footer(msg, unsubs_auth, pref_auth)
                            
     return (subj, msg, sender, [recipient])
+
+class DigestPart(tuple):
+    """A notification email tuple that may be combined with the other
+    notifications to the same recipient into a digest by L{make_digests}.
+    It is used just like the tuple it wraps."""
+
+def make_digests(email_list):
+    """Combine the L{DigestPart}s in C{email_list} that go to the same
+    recipient into one digest email each. All other emails, and the
+    L{DigestPart}s that are the only one to their recipient, are kept as
+    they are. Each notification in a digest keeps its own unsubscribe and
+    preferences links, since they belong to different subscriptions.
+
+    @type email_list: list [tuple]
+    @param email_list: The tuples of the emails to send, in the format of
+        Django's send_mass_mail() method.
+    @rtype: list [tuple]
+    @return: The tuples of the emails to send, with every digest in place of
+        the first notification it combines.
+    """
+    parts = {}
+    for email in email_list:
+        if isinstance(email, DigestPart):
+            parts.setdefault(email[3][0].lower(), []).append(email)
+
+    digests = []
+    for email in email_list:
+        if not isinstance(email, DigestPart):
+            digests.append(tuple(email))
+            continue
+        group = parts.pop(email[3][0].lower(), None)
+        if group is None:
+            #Already combined into the digest for this recipient
+            continue
+        if len(group) == 1:
+            digests.append(tuple(email))
+        else:
+            digests.append(digest_tuple(email[3][0], group))
+    return digests
+
+def digest_tuple(recipient, notifications):
+    """Returns the tuple for a digest combining several notifications to the
+    same recipient. Each notification becomes a section headed by its
+    subject.
+
+    @type recipient: str
+    @param recipient: The user's email address.
+    @type notifications: list [tuple]
+    @param notifications: The tuples of the notification emails, as returned
+        by L{node_down_tuple}, L{version_tuple}, L{bandwidth_tuple} and
+        L{t_shirt_tuple}.
+    @rtype: tuple
+    @return: A tuple listing information about the email to be sent, which is
+        queued by the mailqueue module in updaters.
+    """
+    subj = _SUBJECT_HEADER + _DIGEST_SUBJ % len(notifications)
+    sender = _SENDER
+    sections = []
+    for part_subj, part_msg, part_sender, part_recipients in notifications:
+        heading = part_subj.replace(_SUBJECT_HEADER, '', 1)
+        if part_msg.startswith(_REPORT_INTRO):
+            part_msg = part_msg[len(_REPORT_INTRO):]
+        sections.append(heading + '\n' + '=' * len(heading) + '\n\n' +
+                        part_msg)
+    msg = _DIGEST_MAIL % len(notifications) + _DIGEST_SEPARATOR.join(sections)
+    return (subj, msg, sender, [recipient])
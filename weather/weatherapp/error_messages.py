@@ -10,6 +10,8 @@ the user via the web pages and the method to access the correct message.
     contains a link to the user's preferences page.
 @var _NEED_CONFIRMATION: The error message displayed when the user attempts to
     change his/her preferences before confirming the subscription.
+@var _MAIL_BACKLOG: The error message displayed when a page would send an
+    email but too many emails are already waiting to be sent.
 @var _DEFAULT: This message is displayed if the url pattern following /error/ 
     is not recognized by the get_error_message method.
 """
@@ -30,6 +32,9 @@ _NEED_CONFIRMATION ="<p>You have not yet confirmed your subscription to Tor "+\
     "with a link to your confirmation page.</p><p>If you would like us "+\
     "to resend the email with a link to your confirmation page, "+\
     "<a href=%s>click here</a>.</p>"
+_MAIL_BACKLOG = "<p>Tor Weather is receiving an unusually large number of "+\
+    "requests right now and can't send you an email at the moment.</p>"+\
+    "<p>Please try again in a few minutes.</p>"
 _DEFAULT = "Tor Weather has encountered an error in trying to redirect "+\
     "to this page."
 
@@ -65,6 +70,10 @@ def get_error_message(error_type, key):
         url_extension = url_helper.get_resend_ext(confirm_auth)
         message = _NEED_CONFIRMATION % (user.email, url_extension)
         return message
+    elif error_type == 'mail_backlog':
+        # the key is not used
+        message = _MAIL_BACKLOG
+        return message
     else:
         # the error type wasn't recognized, just return a default msg
         message = _DEFAULT
@@ -0,0 +1,566 @@
+"""
+This module keeps an append-only history of the state of every relay in each
+consensus: whether it was running or hibernating, its observed bandwidth, its
+flags and its Tor version. Questions like "how many hours was this relay up
+in the last two months, and at what average bandwidth" can be answered from
+the history with a pass over a memory-mapped file instead of from state kept
+in database rows. Nothing asks them yet: the T-shirt check still keeps its
+progress in L{models.TShirtSub} rows, so the updater doesn't call L{record}.
+It should once something reads the history.
+
+The history lives in L{history_dir}, in three files:
+
+  - C{relays.txt} lists the fingerprints, one per line. The line number of a
+    fingerprint, counting from 0, is its slot. A line of L{_FREE} is a slot
+    no frame refers to any more, which the next new relay gets.
+  - C{versions.txt} lists the Tor versions seen, one per line. Version id 0
+    means unknown, the first line has id 1.
+  - C{frames.bin} starts with L{_MAGIC} and holds one frame per consensus.
+    A frame is a header (start time, hours covered, number of records)
+    followed by one fixed-size record per relay seen (slot, bandwidth,
+    consensuses up, consensuses hibernating, flags, version id) ordered by
+    slot, all little-endian unsigned integers. A frame is as large as the
+    consensus it records, however many relays were seen before.
+
+Frames older than L{config.history_full_days} days are merged into frames
+covering L{config.history_bucket_hours} hours each, and frames older than
+L{config.history_keep_days} days are dropped. A merged record counts the
+consensuses the relay was up and hibernating in, and its bandwidth is the
+average over the consensuses it was up. When frames are dropped, the slots
+of the relays that aren't in any remaining frame are freed.
+
+@var history_dir: The directory holding the history files.
+@var FLAGS: The relay flags recorded, in the order of their bits. New flags
+    may only be added at the end.
+"""
+
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+from config import config
+
+from django.conf import settings
+
+history_dir = os.path.join(settings.PROJECT_PATH, '..', 'var', 'history')
+
+FLAGS = ['Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir', 'Running',
+         'Stable', 'V2Dir', 'Valid']
+
+_MAGIC = 'TWHIST\x00\x02'
+
+#start, hours, records
+_HEADER = struct.Struct('<III')
+#slot, bandwidth (kB/s), consensuses up, consensuses hibernating, flags,
+#version id
+_RECORD = struct.Struct('<IIHHHH')
+
+_FLAG_BITS = dict([(flag, 1 << bit) for bit, flag in enumerate(FLAGS)])
+
+#The relays.txt line of a free slot
+_FREE = '-'
+
+class RelayHistory:
+    """The history files in one directory.
+
+    @type directory: str
+    @ivar directory: The directory holding the history files.
+    @type relays: list [str]
+    @ivar relays: The fingerprints, indexed by slot.
+    @type slots: dict {str: int}
+    @ivar slots: The slot of each fingerprint.
+    @type free: list [int]
+    @ivar free: The free slots, ascending.
+    @type versions: list [str]
+    @ivar versions: The Tor versions, indexed by version id.
+    @type version_ids: dict {str: int}
+    @ivar version_ids: The id of each Tor version.
+    """
+
+    def __init__(self, directory = None):
+        """Read the fingerprint and version lists of the history in
+        C{directory}, L{history_dir} by default."""
+
+        self.directory = directory or history_dir
+        self.relays = self._read_lines('relays.txt')
+        self.slots = dict([(fingerprint, slot) for slot, fingerprint in
+                           enumerate(self.relays) if fingerprint != _FREE])
+        self.free = [slot for slot, fingerprint in enumerate(self.relays)
+                     if fingerprint == _FREE]
+        self.versions = [''] + self._read_lines('versions.txt')
+        self.version_ids = dict([(version, version_id) for version_id, version
+                                 in enumerate(self.versions) if version_id])
+        self._map = None
+        self._map_id = None
+        self._frames = []
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_lines(self, name):
+        try:
+            lines = open(self._path(name))
+        except IOError:
+            return []
+        try:
+            return [line.strip() for line in lines if line.strip()]
+        finally:
+            lines.close()
+
+    def _add(self, name, values):
+        """Append the new fingerprints or versions C{values} to the list
+        file C{name}."""
+
+        if not values:
+            return
+        listing = open(self._path(name), 'a')
+        try:
+            listing.write(''.join([value + '\n' for value in values]))
+        finally:
+            listing.close()
+
+    def _replace(self, name, values):
+        """Replace the list file C{name} with the lines C{values} in one
+        step."""
+
+        path = self._path(name)
+        listing = open(path + '.tmp', 'w')
+        try:
+            listing.write(''.join([value + '\n' for value in values]))
+        finally:
+            listing.close()
+        os.rename(path + '.tmp', path)
+
+    def append(self, start, states, hours = 1):
+        """
+        Append a frame with the states of the relays in one consensus.
+
+        @type start: int
+        @param start: The time of the consensus, in seconds since the epoch.
+        @type states: iterable
+        @param states: (fingerprint, up, hibernating, bandwidth, flags,
+            version) tuples, see L{snapshot_states}.
+        @type hours: int
+        @param hours: The hours the frame covers.
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        new_relays = []
+        reused = False
+        new_versions = []
+        records = {}
+        for fingerprint, up, hibernating, bandwidth, flags, version in states:
+            if fingerprint not in self.slots:
+                if self.free:
+                    self.slots[fingerprint] = self.free.pop(0)
+                    self.relays[self.slots[fingerprint]] = fingerprint
+                    reused = True
+                else:
+                    self.slots[fingerprint] = len(self.relays)
+                    self.relays.append(fingerprint)
+                    new_relays.append(fingerprint)
+            if version and version not in self.version_ids:
+                self.version_ids[version] = len(self.versions)
+                self.versions.append(version)
+                new_versions.append(version)
+
+            flag_bits = 0
+            for flag in flags:
+                flag_bits |= _FLAG_BITS.get(flag, 0)
+            records[self.slots[fingerprint]] = (up and bandwidth or 0,
+                                                up and 1 or 0,
+                                                hibernating and 1 or 0,
+                                                flag_bits,
+                                                self.version_ids.get(version,
+                                                                     0))
+
+        #The lists have to name every slot before a frame refers to it
+        if reused:
+            self._replace('relays.txt', self.relays)
+        else:
+            self._add('relays.txt', new_relays)
+        self._add('versions.txt', new_versions)
+
+        path = self._path('frames.bin')
+        if self._magic(path) not in (None, _MAGIC):
+            logging.warning('Starting a new relay history, %s has an older '
+                            'format.' % path)
+            os.rename(path, path + '.old')
+        frames_file = open(path, 'ab')
+        try:
+            if frames_file.tell() == 0:
+                frames_file.write(_MAGIC)
+            frames_file.write(_HEADER.pack(start, hours, len(records)))
+            frames_file.write(_pack_records(records))
+        finally:
+            frames_file.close()
+
+    def _magic(self, path):
+        """Get the start of the frames file C{path}, or C{None} if it is
+        empty or missing."""
+
+        try:
+            frames_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            return frames_file.read(len(_MAGIC)) or None
+        finally:
+            frames_file.close()
+
+    def _mapped(self):
+        """Map the frames file, again if it grew or was replaced, and index
+        the complete frames in it.
+
+        @rtype: list [tuple (int, int, int, int)]
+        @return: The (start, hours, number of records, offset of the first
+            record) of every frame, oldest first.
+        """
+
+        try:
+            stat = os.stat(self._path('frames.bin'))
+        except OSError:
+            return []
+        if (stat.st_size, stat.st_ino) == self._map_id:
+            return self._frames
+
+        frames_file = open(self._path('frames.bin'), 'rb')
+        try:
+            if stat.st_size <= len(_MAGIC):
+                return []
+            self._map = mmap.mmap(frames_file.fileno(), 0,
+                                  access = mmap.ACCESS_READ)
+        finally:
+            frames_file.close()
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            raise IOError('%s is not a relay history' %
+                          self._path('frames.bin'))
+
+        self._map_id = (stat.st_size, stat.st_ino)
+        self._frames = []
+        offset = len(_MAGIC)
+        while offset + _HEADER.size <= len(self._map):
+            start, hours, count = _HEADER.unpack_from(self._map, offset)
+            end = offset + _HEADER.size + count * _RECORD.size
+            if end > len(self._map):
+                #Only part of the last frame was written yet
+                break
+            self._frames.append((start, hours, count, offset + _HEADER.size))
+            offset = end
+        return self._frames
+
+    def frame_times(self):
+        """
+        Get the start times and lengths of the frames.
+
+        @rtype: list [tuple (int, int)]
+        @return: The (start, hours) of every frame, oldest first.
+        """
+
+        return [(start, hours) for start, hours, count, offset in
+                self._mapped()]
+
+    def _find(self, offset, count, slot):
+        """Find the record of C{slot} among the C{count} records of a frame
+        starting at C{offset}, or return C{None} if the relay wasn't seen."""
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            record = _RECORD.unpack_from(self._map,
+                                         offset + middle * _RECORD.size)
+            if record[0] < slot:
+                low = middle + 1
+            elif record[0] > slot:
+                high = middle
+            else:
+                return record[1:]
+        return None
+
+    def relay_records(self, fingerprint, since = 0, until = None):
+        """
+        Get the records of one relay.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the relay.
+        @type since: int
+        @param since: Only frames starting at or after this time are read.
+        @type until: int
+        @param until: Only frames starting before this time are read.
+        @rtype: list [tuple]
+        @return: (start, hours, bandwidth, up, hibernating, flags, version)
+            tuples of the frames in which the relay was seen, oldest first.
+            C{up} and C{hibernating} are the numbers of consensuses, and
+            C{flags} is a list of flag names.
+        """
+
+        slot = self.slots.get(fingerprint)
+        if slot is None:
+            return []
+
+        records = []
+        for start, hours, count, offset in self._mapped():
+            if start < since:
+                continue
+            if until is not None and start >= until:
+                break
+            record = self._find(offset, count, slot)
+            if record is None:
+                continue
+            bandwidth, up, hibernating, flag_bits, version_id = record
+            flags = [flag for flag in FLAGS if flag_bits & _FLAG_BITS[flag]]
+            records.append((start, hours, bandwidth, up, hibernating, flags,
+                            self.versions[version_id]))
+        return records
+
+    def uptime(self, fingerprint, since = 0, until = None):
+        """
+        Count the consensuses in which a relay was up.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the relay.
+        @type since: int
+        @param since: The start of the period, in seconds since the epoch.
+        @type until: int
+        @param until: The end of the period, now by default.
+        @rtype: int
+        @return: The number of consensuses, about the hours the relay was up.
+        """
+
+        return sum([record[3] for record in
+                    self.relay_records(fingerprint, since, until)])
+
+    def average_bandwidth(self, fingerprint, since = 0, until = None):
+        """
+        Get the average observed bandwidth of a relay over the consensuses in
+        which it was up.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint of the relay.
+        @type since: int
+        @param since: The start of the period, in seconds since the epoch.
+        @type until: int
+        @param until: The end of the period, now by default.
+        @rtype: int
+        @return: The average bandwidth in kB/s, rounded, or 0 if the relay
+            wasn't up.
+        """
+
+        total = 0
+        up = 0
+        for record in self.relay_records(fingerprint, since, until):
+            total += record[2] * record[3]
+            up += record[3]
+        if not up:
+            return 0
+        return int(round(float(total) / up))
+
+    def compact(self, now = None, full_days = None, bucket_hours = None,
+                keep_days = None):
+        """
+        Merge the old frames into longer ones and drop the oldest, replacing
+        the frames file. Nothing is written if no frame needs to change.
+
+        @type now: int
+        @param now: The current time, in seconds since the epoch.
+        @type full_days: int
+        @param full_days: The days for which every frame is kept,
+            L{config.history_full_days} by default.
+        @type bucket_hours: int
+        @param bucket_hours: The hours older frames are merged into,
+            L{config.history_bucket_hours} by default.
+        @type keep_days: int
+        @param keep_days: The days after which frames are dropped,
+            L{config.history_keep_days} by default.
+        @rtype: int
+        @return: The number of frames that were merged or dropped.
+        """
+
+        if now is None:
+            now = int(time.time())
+        if full_days is None:
+            full_days = config.history_full_days
+        if bucket_hours is None:
+            bucket_hours = config.history_bucket_hours
+        if keep_days is None:
+            keep_days = config.history_keep_days
+
+        drop_before = now - keep_days * 86400
+        merge_before = now - full_days * 86400
+        bucket_seconds = bucket_hours * 3600
+        #Only buckets that can't get more frames are merged
+        merge_before -= merge_before % bucket_seconds
+
+        frames = self._mapped()
+        buckets = []
+        changed = 0
+        dropped = 0
+        for frame in frames:
+            start = frame[0]
+            if start < drop_before:
+                changed += 1
+                dropped += 1
+                continue
+            if start >= merge_before:
+                bucket = start
+            else:
+                bucket = start - start % bucket_seconds
+            if buckets and buckets[-1][0] == bucket:
+                buckets[-1][1].append(frame)
+                changed += 1
+            else:
+                buckets.append((bucket, [frame]))
+
+        if not changed:
+            return 0
+
+        path = self._path('frames.bin')
+        used = set()
+        target = open(path + '.tmp', 'wb')
+        try:
+            target.write(_MAGIC)
+            for bucket, parts in buckets:
+                hours = sum([part[1] for part in parts])
+                if len(parts) == 1:
+                    count, offset = parts[0][2:]
+                    data = self._map[offset:offset + count * _RECORD.size]
+                    target.write(_HEADER.pack(bucket, hours, count))
+                    target.write(data)
+                    if dropped:
+                        used.update(_record_slots(data))
+                else:
+                    records = self._merge(parts)
+                    target.write(_HEADER.pack(bucket, hours, len(records)))
+                    target.write(_pack_records(records))
+                    used.update(records)
+        finally:
+            target.close()
+        os.rename(path + '.tmp', path)
+
+        logging.info('Compacted the relay history from %d to %d frames.' %
+                     (len(frames), len(buckets)))
+        if dropped:
+            self._free_slots(used)
+        return changed
+
+    def _free_slots(self, used):
+        """Free the slots of the relays whose slots aren't in C{used}. The
+        frames no longer refer to them, so a crash before relays.txt is
+        replaced only keeps them taken a while longer."""
+
+        freed = [slot for fingerprint, slot in self.slots.items()
+                 if slot not in used]
+        if not freed:
+            return
+        for slot in freed:
+            del self.slots[self.relays[slot]]
+            self.relays[slot] = _FREE
+        self.free = sorted(self.free + freed)
+        self._replace('relays.txt', self.relays)
+        logging.info('Freed the history slots of %d relays.' % len(freed))
+
+    def _merge(self, parts):
+        """Merge the records of the frames C{parts} into one {slot: record}
+        dictionary."""
+
+        totals = {}
+        for start, hours, count, offset in parts:
+            for index in range(count):
+                slot, bandwidth, up, hibernating, flag_bits, version_id = \
+                    _RECORD.unpack_from(self._map,
+                                        offset + index * _RECORD.size)
+                total = totals.setdefault(slot, [0, 0, 0, 0, 0])
+                total[0] += bandwidth * up
+                total[1] += up
+                total[2] += hibernating
+                total[3] |= flag_bits
+                total[4] = version_id or total[4]
+
+        records = {}
+        for slot, (bandwidth, up, hibernating, flag_bits, version_id) in \
+                totals.items():
+            if up:
+                bandwidth = int(round(float(bandwidth) / up))
+            records[slot] = (bandwidth, min(up, 0xffff),
+                             min(hibernating, 0xffff), flag_bits, version_id)
+        return records
+
+def _record_slots(data):
+    """Get the slots of the packed records C{data}."""
+
+    values = array.array('I', data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values[::_RECORD.size / values.itemsize]
+
+def _pack_records(records):
+    """Pack the {slot: record} dictionary C{records} into the records of a
+    frame, ordered by slot."""
+
+    return ''.join([_RECORD.pack(slot, *records[slot])
+                    for slot in sorted(records)])
+
+def snapshot_states(snapshot):
+    """
+    Get the state of every relay in a consensus, for L{RelayHistory.append}.
+    Relays with a server descriptor that aren't in the consensus are down.
+
+    @type snapshot: L{ctlutil.ConsensusSnapshot}
+    @param snapshot: The consensus and server descriptors.
+    @rtype: list [tuple (str, bool, bool, int, list [str], str)]
+    @return: The (fingerprint, up, hibernating, bandwidth in kB/s, flags,
+        version) of each relay.
+    """
+
+    states = []
+    fingerprints = list(snapshot.descriptor_order)
+    fingerprints.extend([fingerprint for fingerprint in snapshot.statuses
+                         if fingerprint not in snapshot.descriptors])
+    for fingerprint in fingerprints:
+        status = snapshot.get_status(fingerprint)
+        desc = snapshot.get_descriptor(fingerprint)
+        bandwidth = 0
+        hibernating = False
+        version = ''
+        if desc is not None:
+            bandwidth = desc.observed_bandwidth / 1000
+            hibernating = desc.hibernating
+            version = desc.tor_version and str(desc.tor_version) or ''
+        flags = status is not None and status.flags or []
+        states.append((fingerprint, status is not None, hibernating,
+                       bandwidth, flags, version))
+    return states
+
+def record(snapshot, now = None):
+    """
+    Append the relay states in C{snapshot} to the history in L{history_dir}
+    and compact it.
+
+    @type snapshot: L{ctlutil.ConsensusSnapshot}
+    @param snapshot: The consensus and server descriptors.
+    @type now: int
+    @param now: The time of the consensus, the current hour by default.
+    @rtype: int
+    @return: The number of relays recorded, 0 if the history couldn't be
+        written.
+    """
+
+    if now is None:
+        now = int(time.time())
+        now -= now % 3600
+
+    states = snapshot_states(snapshot)
+    try:
+        history = RelayHistory()
+        history.append(now, states)
+        history.compact(now)
+    except (IOError, OSError), e:
+        logging.error('Could not record the relay history: %s' % e)
+        return 0
+    return len(states)
@@ -1,36 +1,126 @@
 """
-A module for listening to Tor for new consensus events. When one occurs,
-initializes the checker/updater cascade in the updaters module.
+A module for listening to Tor for new consensus events. When one occurs, the
+event is handed to a L{ConsensusWorker}, which runs the checker/updater
+cascade in the updaters module on its own thread, so that Stem's event thread
+is never blocked by an update cycle.
 """
 
 import logging
+import threading
 
-from config import config
 from weatherapp import updaters
-from stem.control import EventType, Controller
+from weatherapp.ctlutil import CtlUtil
+
+from stem.control import EventType
 
 #very basic log setup
 
 logging.basicConfig(format = '%(asctime) - 15s (%(process)d) %(message)s',
                     level = logging.DEBUG, filename = 'log/weather.log')
 
-def newconsensus_listener(event):
+class ConsensusWorker(threading.Thread):
     """
-    Call C{updaters.run_all()} when a NEWCONSENSUS event is received.
+    A thread that calls C{updaters.run_all()} for NEWCONSENSUS events. Events
+    that arrive while an update cycle is running are coalesced: only the
+    newest of them is processed once the cycle is done, since it supersedes
+    the others.
 
-    @param event: The NEWCONSENSUS event. Not used by the function.
+    @type ctl_util: CtlUtil
+    @ivar ctl_util: The long-lived connection to tor used by every cycle.
+    @type pending: NEWCONSENSUS event
+    @ivar pending: The newest event that hasn't been processed yet, or
+        C{None}.
+    @type condition: threading.Condition
+    @ivar condition: Guards L{pending}.
     """
 
-    logging.info('Got a new consensus. Updating router table and ' + \
-                     'checking all subscriptions.')
-    updaters.run_all()
+    def __init__(self, ctl_util):
+        """
+        @type ctl_util: CtlUtil
+        @param ctl_util: The connection to tor to use for all cycles.
+        """
+
+        threading.Thread.__init__(self, name = 'ConsensusWorker')
+        self.setDaemon(True)
+        self.ctl_util = ctl_util
+        self.pending = None
+        self.condition = threading.Condition()
+
+    def submit(self, event):
+        """
+        Schedule C{event} for processing, replacing any event that is still
+        waiting. Called on Stem's event thread, so this returns immediately.
+
+        @param event: The NEWCONSENSUS event.
+        """
+
+        self.condition.acquire()
+        try:
+            if self.pending is not None:
+                logging.info('Skipping a consensus, a newer one arrived ' + \
+                             'before it was processed.')
+            self.pending = event
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def next_event(self):
+        """
+        Wait for an event to be submitted and take it.
+
+        @return: The newest submitted event.
+        """
+
+        self.condition.acquire()
+        try:
+            while self.pending is None:
+                self.condition.wait(60)
+            event = self.pending
+            self.pending = None
+            return event
+        finally:
+            self.condition.release()
+
+    def process(self, event):
+        """
+        Run one update cycle, reconnecting to tor first if the connection
+        was lost.
+
+        @param event: The NEWCONSENSUS event. Not used by the function.
+        """
+
+        if not self.ctl_util.is_alive():
+            logging.info('Lost the connection to tor, reconnecting.')
+            self.ctl_util.reconnect()
+
+        logging.info('Got a new consensus. Updating router table and ' + \
+                         'checking all subscriptions.')
+        updaters.run_all(self.ctl_util)
+
+    def run(self):
+        """
+        Process submitted events until the program exits.
+        """
+
+        while True:
+            event = self.next_event()
+            try:
+                self.process(event)
+            except Exception:
+                logging.exception('Processing a consensus failed.')
 
 def listen():
     """Sets up a connection to Tor and initializes a controller to listen for
-    new consensus events.
+    new consensus events. The same connection is used by the
+    L{ConsensusWorker} that processes the events. Does not return.
     """
-    ctrl = Controller.from_port(port = config.control_port)
-    ctrl.authenticate(config.authenticator)
-    ctrl.add_event_listener(newconsensus_listener, EventType.NEWCONSENSUS)
+    ctl_util = CtlUtil()
+    worker = ConsensusWorker(ctl_util)
+    worker.start()
+    ctl_util.control.add_event_listener(worker.submit, EventType.NEWCONSENSUS)
     print 'Listening for new consensus events.'
     logging.info('Listening for new consensus events.')
+
+    # Stem's threads and the worker are daemons, so keep the process alive.
+    while worker.isAlive():
+        worker.join(60)
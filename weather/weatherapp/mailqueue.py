@@ -0,0 +1,332 @@
+"""
+The mailqueue module holds the notification emails generated by L{updaters}
+until they are sent. L{enqueue} stores the email tuples in the L{QueuedEmail}
+table, so that processing a consensus never waits on the SMTP server, and
+L{drain} (run by the runmailer command) sends the due emails from a small pool
+of worker threads, each reusing one SMTP connection. An email that can't be
+sent is retried with exponential backoff until L{MAX_ATTEMPTS} attempts
+failed, after which it is logged to L{failed_email_file} and dropped.
+
+Before sending, L{drain} claims its emails by storing its owner name and the
+time in them, so two drains running at once (the runmailer command and the
+updater, say) never send the same email. A claim older than
+L{CLAIM_TIMEOUT} belongs to a drain that died, and the email is sent again.
+
+The confirmation emails of the web pages go through the same queue with a
+higher priority, so they don't wait behind a backlog of notifications. When
+too many of them are waiting, L{is_backlogged} tells the pages to turn new
+requests away instead of piling up more.
+
+Every drain touches L{drain_stamp_file}. If the runmailer command isn't
+running, the stamp gets old, and the updater drains the queue itself at the
+end of every cycle (see L{mailer_is_running}). Emails then still go out,
+but only once per consensus.
+
+@var failed_email_file: A log file for emails that could not be sent.
+@var drain_stamp_file: The file whose modification time tells when the
+    queue was last drained.
+@type MAX_ATTEMPTS: int
+@var MAX_ATTEMPTS: How often an email is tried before it is given up on.
+@type RETRY_DELAY: int
+@var RETRY_DELAY: Seconds to wait before the first retry; the delay doubles
+    with every failed attempt.
+@type WORKERS: int
+@var WORKERS: The number of worker threads (and SMTP connections) used by
+    L{drain}.
+@type BATCH_SIZE: int
+@var BATCH_SIZE: The most emails L{drain} takes off the queue at a time,
+    and L{enqueue} stores in one transaction.
+@type PRIORITY_NOTIFICATION: int
+@var PRIORITY_NOTIFICATION: The priority of notifications from L{updaters}.
+@type PRIORITY_CONFIRMATION: int
+@var PRIORITY_CONFIRMATION: The priority of emails sent by the web pages.
+@type MAX_PENDING_CONFIRMATIONS: int
+@var MAX_PENDING_CONFIRMATIONS: The number of queued web page emails at
+    which L{is_backlogged} starts returning C{True}.
+@type MAILER_TIMEOUT: int
+@var MAILER_TIMEOUT: Seconds after the last drain at which the mailer is
+    taken to be stopped.
+@type CLAIM_TIMEOUT: int
+@var CLAIM_TIMEOUT: Seconds after which a claimed email that is still queued
+    may be claimed by another drain.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+import threading
+import time
+
+from weatherapp import database
+from weatherapp.models import QueuedEmail
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+
+failed_email_file = 'log/failed_emails.txt'
+drain_stamp_file = 'log/mailer.stamp'
+
+MAX_ATTEMPTS = 6
+RETRY_DELAY = 60
+WORKERS = 4
+BATCH_SIZE = 200
+
+PRIORITY_NOTIFICATION = 0
+PRIORITY_CONFIRMATION = 1
+MAX_PENDING_CONFIRMATIONS = 500
+MAILER_TIMEOUT = 300
+CLAIM_TIMEOUT = 3600
+
+def enqueue(email_list, priority = PRIORITY_NOTIFICATION):
+    """Store the emails in C{email_list} in the mail queue. Every
+    L{BATCH_SIZE} emails are stored in a short transaction of their own, so
+    the web pages don't wait for all of a cycle's emails to be written.
+
+    @type email_list: list
+    @param email_list: (subject, message, sender, recipient list) tuples, as
+        returned by the C{*_tuple} functions in L{emails}. One L{QueuedEmail}
+        is stored per recipient.
+    @type priority: int
+    @param priority: L{PRIORITY_NOTIFICATION} or L{PRIORITY_CONFIRMATION}.
+    @rtype: int
+    @return: The number of queued emails.
+    """
+
+    rows = [(subject, message, sender, recipient) for
+            subject, message, sender, recipients in email_list for
+            recipient in recipients]
+    for start in range(0, len(rows), BATCH_SIZE):
+        _store(rows[start:start + BATCH_SIZE], priority)
+    return len(rows)
+
+@database.short_transaction
+def _store(rows, priority):
+    """Store one batch of L{enqueue}'s emails.
+
+    @type rows: list [tuple (str, str, str, str)]
+    @param rows: The subject, message, sender and recipient of each email.
+    @type priority: int
+    @param priority: L{PRIORITY_NOTIFICATION} or L{PRIORITY_CONFIRMATION}.
+    """
+
+    for subject, message, sender, recipient in rows:
+        QueuedEmail(subject = subject, message = message, sender = sender,
+                    recipient = recipient, priority = priority).save()
+
+def queue_length(priority = None):
+    """Get the number of emails waiting in the mail queue.
+
+    @type priority: int
+    @param priority: Only count emails with this priority, if given.
+    @rtype: int
+    @return: The number of L{QueuedEmail} rows.
+    """
+
+    queued = QueuedEmail.objects.all()
+    if priority is not None:
+        queued = queued.filter(priority = priority)
+    return queued.count()
+
+def is_backlogged():
+    """Check whether the web pages have queued so many emails that they
+    should stop accepting requests which send one.
+
+    @rtype: bool
+    @return: C{True} if L{MAX_PENDING_CONFIRMATIONS} or more web page emails
+        are waiting, C{False} otherwise.
+    """
+
+    return queue_length(PRIORITY_CONFIRMATION) >= MAX_PENDING_CONFIRMATIONS
+
+def mailer_is_running():
+    """Check whether the queue was drained in the last L{MAILER_TIMEOUT}
+    seconds, which the runmailer command does every few seconds while it
+    runs.
+
+    @rtype: bool
+    @return: C{True} if L{drain_stamp_file} is recent, C{False} if it is
+        older or missing.
+    """
+
+    try:
+        return time.time() - os.path.getmtime(drain_stamp_file) < \
+               MAILER_TIMEOUT
+    except OSError:
+        return False
+
+def _touch_stamp():
+    """Set the modification time of L{drain_stamp_file} to now."""
+
+    try:
+        open(drain_stamp_file, 'a').close()
+        os.utime(drain_stamp_file, None)
+    except EnvironmentError, e:
+        logging.error('Could not touch %s: %s' % (drain_stamp_file, e))
+
+def _send_batch(emails, results):
+    """Send C{emails} over a single SMTP connection, reconnecting after a
+    failure. Runs in a worker thread and doesn't touch the database.
+
+    @type emails: list [L{QueuedEmail}]
+    @param emails: The emails to send.
+    @type results: list
+    @param results: (L{QueuedEmail}, error) pairs are appended to it, where
+        error is C{None} if the email was sent.
+    """
+
+    connection = get_connection(fail_silently = False)
+    try:
+        for email in emails:
+            msg = EmailMessage(email.subject, email.message, email.sender,
+                               [email.recipient], connection = connection)
+            try:
+                connection.open()
+                msg.send()
+            except Exception, e:
+                results.append((email, str(e) or e.__class__.__name__))
+                # The connection may be broken, start a new one for the next
+                # email.
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            else:
+                results.append((email, None))
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+def _owner():
+    """Get the name with which the current drain claims its emails.
+
+    @rtype: str
+    @return: The process and thread ids, unique among running drains.
+    """
+
+    return '%d:%d' % (os.getpid(), threading.current_thread().ident)
+
+@database.short_transaction
+def _claim(owner):
+    """Claim up to L{BATCH_SIZE} due emails that no other drain is sending.
+
+    @type owner: str
+    @param owner: The name of the claiming drain, from L{_owner}.
+    @rtype: list [L{QueuedEmail}]
+    @return: The claimed emails, in the order they should be sent.
+    """
+
+    now = datetime.now()
+    claimable = QueuedEmail.objects.filter(next_attempt__lte = now).filter(
+            Q(claimed_at__isnull = True) |
+            Q(claimed_at__lte = now - timedelta(seconds = CLAIM_TIMEOUT)))
+    order = ('-priority', 'next_attempt', 'id')
+    pks = list(claimable.order_by(*order).values_list('pk', flat = True)
+               [:BATCH_SIZE])
+    if not pks:
+        return []
+    #The conditions are checked again by the update, so a row another drain
+    #claimed in the meantime is left alone
+    claimable.filter(pk__in = pks).update(claimed_by = owner,
+                                          claimed_at = now)
+    return list(QueuedEmail.objects.filter(pk__in = pks,
+                claimed_by = owner).order_by(*order))
+
+@transaction.commit_on_success
+def _record_results(emails, results, stats):
+    """Remove sent and abandoned emails from the queue and reschedule the
+    ones that failed. An email without a result, because its worker thread
+    died, counts as failed.
+
+    @type emails: list [L{QueuedEmail}]
+    @param emails: The emails handed to the worker threads.
+    @type results: list
+    @param results: (L{QueuedEmail}, error) pairs from L{_send_batch}.
+    @type stats: dict {str: int}
+    @param stats: The counters of L{drain}, updated in place.
+    """
+
+    done = []
+    given_up = []
+    now = datetime.now()
+
+    reported = set(email.pk for email, error in results)
+    results = results + [(email, 'The sending thread stopped') for
+                         email in emails if email.pk not in reported]
+
+    for email, error in results:
+        if error is None:
+            done.append(email.pk)
+            stats['sent'] += 1
+        elif email.attempts + 1 >= MAX_ATTEMPTS:
+            done.append(email.pk)
+            given_up.append((email, error))
+            stats['failed'] += 1
+        else:
+            delay = RETRY_DELAY * 2 ** email.attempts
+            QueuedEmail.objects.filter(pk = email.pk).update(
+                attempts = email.attempts + 1,
+                next_attempt = now + timedelta(seconds = delay),
+                last_error = error, claimed_by = '', claimed_at = None)
+            stats['retried'] += 1
+
+    for start in range(0, len(done), BATCH_SIZE):
+        QueuedEmail.objects.filter(pk__in = done[start:start + BATCH_SIZE]) \
+                .delete()
+
+    if given_up:
+        failed = open(failed_email_file, 'a')
+        for email, error in given_up:
+            failed.write('%s %s %r: %s\n' % (now, email.recipient,
+                                             email.subject, error))
+        failed.close()
+
+def drain(workers = WORKERS):
+    """Send all emails in the queue that are due, splitting them between
+    C{workers} worker threads.
+
+    @type workers: int
+    @param workers: The number of worker threads and SMTP connections.
+    @rtype: dict {str: various}
+    @return: The number of emails 'sent', 'retried' and 'failed' (given up
+        on), the 'seconds' it took, the resulting 'per_second' rate and the
+        number of emails still 'queued' afterwards.
+    """
+
+    stats = {'sent': 0, 'retried': 0, 'failed': 0}
+    start = time.time()
+    owner = _owner()
+
+    while True:
+        #Keep the stamp fresh through a long drain, so the updater doesn't
+        #start sending the same emails
+        _touch_stamp()
+        due = _claim(owner)
+        if not due:
+            break
+
+        results = []
+        threads = []
+        for i in range(min(workers, len(due))):
+            thread = threading.Thread(target = _send_batch,
+                                      args = [due[i::workers], results])
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        _record_results(due, results, stats)
+
+    stats['seconds'] = time.time() - start
+    stats['per_second'] = stats['sent'] / max(stats['seconds'], 0.001)
+    stats['queued'] = queue_length()
+
+    if stats['sent'] or stats['retried'] or stats['failed']:
+        logging.info('Mail queue: sent %(sent)d, retried %(retried)d, ' \
+                     'gave up on %(failed)d emails in %(seconds).1f s ' \
+                     '(%(per_second).1f emails/s), %(queued)d still ' \
+                     'queued.' % stats)
+    return stats
@@ -0,0 +1,79 @@
+"""A Django command module to add the columns newer versions of the models
+declare to the tables of a database created before they were declared, using
+$ python manage.py addcolumns
+Databases created by syncdb already have them. Existing rows get each
+field's default value."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to add missing columns.
+
+    @type help: str
+    @cvar help: Help text for the command"""
+
+    help = 'Add the columns missing from the Tor Weather tables'
+
+    def handle(self, *args, **options):
+        """Called when addcolumns is called from the command line."""
+        added = self.add_columns()
+        for table, column in added:
+            print 'Added %s.%s.' % (table, column)
+        print 'Added %d columns.' % len(added)
+
+    @transaction.commit_on_success
+    def add_columns(self):
+        """Add a column for every field of the weatherapp models whose table
+        lacks it.
+
+        @rtype: list [tuple (str, str)]
+        @return: The (table, column) pairs that were added.
+        """
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+        tables = connection.introspection.table_names()
+        added = []
+
+        for model in models.get_models(models.get_app('weatherapp')):
+            table = model._meta.db_table
+            if table not in tables:
+                #syncdb creates the whole table
+                continue
+            columns = [row[0] for row in
+                       connection.introspection.get_table_description(cursor,
+                                                                      table)]
+            for field in model._meta.local_fields:
+                if field.column in columns:
+                    continue
+                cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                               (qn(table), qn(field.column),
+                                self.column_definition(field)))
+                added.append((table, field.column))
+
+        transaction.commit_unless_managed()
+        return added
+
+    def column_definition(self, field):
+        """Get the type and constraints of the column for C{field}.
+
+        @type field: Field
+        @param field: A model field.
+        @rtype: str
+        @return: The column type, followed by C{NOT NULL} and the default
+            value unless the field is nullable.
+        """
+        definition = field.db_type(connection = connection)
+        if field.null:
+            return definition
+
+        if not field.has_default() or callable(field.default):
+            raise CommandError('Cannot add %s.%s, it has no fixed default.' %
+                               (field.model._meta.db_table, field.column))
+        default = field.get_db_prep_value(field.default,
+                                          connection = connection)
+        if isinstance(default, (bool, int, long)):
+            default = str(int(default))
+        else:
+            default = "'%s'" % unicode(default).replace("'", "''")
+        return '%s NOT NULL DEFAULT %s' % (definition, default)
@@ -0,0 +1,86 @@
+"""A Django command module to add the indexes on L{Router.fingerprint}, the
+L{Subscriber} authorization keys, L{Subscriber.changed_at} and
+L{NodeDownSub.notify_at} to a database created before they were declared,
+using
+$ python manage.py addindexes
+Run addcolumns first, so the indexed columns exist. Databases created by
+syncdb already have them. Routers stored more than once under the same
+fingerprint are merged into the most recently seen one before the unique
+index is created."""
+
+from weatherapp.models import NodeDownSub, Router, Subscriber
+
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to add missing indexes.
+
+    @type help: str
+    @cvar help: Help text for the command"""
+
+    help = 'Merge duplicate routers and add the lookup indexes'
+
+    def handle(self, *args, **options):
+        """Called when addindexes is called from the command line."""
+        merged = self.merge_duplicate_routers()
+        print 'Merged %d duplicate routers.' % merged
+        self.create_indexes()
+        print 'Indexes are in place.'
+
+    @transaction.commit_on_success
+    def merge_duplicate_routers(self):
+        """Keep the most recently seen L{Router} for every fingerprint that
+        is stored more than once, move the L{Subscriber}s of the others to it
+        and delete the others.
+
+        @rtype: int
+        @return: The number of deleted routers.
+        """
+        merged = 0
+        duplicates = Router.objects.values('fingerprint').annotate(
+                        count = Count('id')).filter(count__gt = 1)
+
+        for duplicate in duplicates:
+            routers = list(Router.objects.filter(
+                         fingerprint = duplicate['fingerprint']).order_by(
+                         '-last_seen', 'id'))
+            keep = routers[0]
+            others = [router.id for router in routers[1:]]
+
+            if [router for router in routers if router.welcomed]:
+                keep.welcomed = True
+                keep.save()
+
+            Subscriber.objects.filter(router__in = others).update(router = keep)
+            Router.objects.filter(id__in = others).delete()
+            merged += len(others)
+
+        return merged
+
+    @transaction.commit_on_success
+    def create_indexes(self):
+        """Create the unique index on L{Router.fingerprint}, the indexes on
+        the L{Subscriber} authorization keys and L{Subscriber.changed_at}
+        and the index on L{NodeDownSub.notify_at} unless they already
+        exist."""
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+
+        table = Router._meta.db_table
+        column = Router._meta.get_field('fingerprint').column
+        indexes = connection.introspection.get_indexes(cursor, table)
+        if not indexes[column]['unique']:
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)' %
+                           (qn('%s_%s_uniq' % (table, column)), qn(table),
+                            qn(column)))
+
+        for model in (Subscriber, NodeDownSub):
+            for sql in connection.creation.sql_indexes_for_model(model,
+                                                                 no_style()):
+                cursor.execute(sql.replace('CREATE INDEX',
+                                           'CREATE INDEX IF NOT EXISTS', 1))
+
+        transaction.commit_unless_managed()
@@ -0,0 +1,54 @@
+"""A Django command module to measure the updater on recorded consensuses,
+using
+$ python manage.py benchmark <replay directory>
+The layout of the replay directory is described in L{replay}. The results
+are written as JSON to the file given with --output, so runs before and
+after a change can be compared."""
+
+from optparse import make_option
+
+from weatherapp import metrics, replay
+
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to run the replay benchmark.
+
+    @type help: str
+    @cvar help: Help text for the command"""
+
+    help = 'Replay recorded consensuses through the updater and time it'
+    args = '<replay directory>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--subscribers', type='int', dest='subscribers',
+            default=replay.SUBSCRIBERS,
+            help='Number of subscribers to seed the database with.'),
+        make_option('--seed', type='int', dest='seed', default=replay.SEED,
+            help='Seed for choosing the subscribers and subscriptions.'),
+        make_option('--output', dest='output',
+            default='log/benchmark.json',
+            help='File to write the results to.'),
+        make_option('--label', dest='label', default='',
+            help='Name stored with the results, such as the revision.'),
+    )
+
+    def handle(self, *args, **options):
+        """Called when benchmark is called from the command line."""
+        if len(args) != 1:
+            raise CommandError('Give the replay directory.')
+        try:
+            results = replay.run_benchmark(args[0], options['subscribers'],
+                                           options['seed'])
+        except (OSError, ValueError), e:
+            raise CommandError(str(e))
+        results['label'] = options['label']
+        metrics.write_json(results, options['output'])
+
+        for cycle in results['cycles']:
+            print '%s: %.3f s, %d queries, %d stem calls, %d emails, ' \
+                  '%d kB peak' % (cycle['consensus'], cycle['seconds'],
+                                  cycle['queries'], cycle['stem_calls'],
+                                  cycle['emails'], cycle['peak_memory_kb'])
+        print 'Replayed %d consensuses in %.3f s, results in %s.' % \
+              (len(results['cycles']), results['seconds'], options['output'])
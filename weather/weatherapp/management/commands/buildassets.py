@@ -0,0 +1,27 @@
+"""A Django command module to build the JavaScript and CSS bundles the
+templates include, using
+$ python manage.py buildassets
+It should be run after every change to the files in the media directory."""
+
+from weatherapp import assets
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to build the asset bundles.
+
+    @type help: str
+    @cvar help: Help text for the command"""
+
+    help = 'Concatenate, minify, compress and hash the JavaScript and CSS'
+
+    def handle(self, *args, **options):
+        """Called when buildassets is called from the command line."""
+        results = assets.build_all()
+        for name in sorted(results):
+            built, source_size, gzip_size = results[name]
+            print '%s: %d bytes from %d source files -> %s, %d bytes gzipped' \
+                  % (name, source_size, len(assets.BUNDLES[name]), built,
+                     gzip_size)
+        if assets.brotli is None:
+            print 'The brotli module is not installed, skipped .br files.'
@@ -0,0 +1,68 @@
+"""A Django command module to generate a synthetic network and subscriber
+base for the benchmark, using
+$ python manage.py generatenetwork <replay directory>
+With --load, the subscribers are also inserted into the database."""
+
+import os
+from optparse import make_option
+
+from weatherapp import replay, synthetic
+
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to generate synthetic data.
+
+    @type help: str
+    @cvar help: Help text for the command"""
+
+    help = 'Write synthetic consensuses and subscribers to a replay directory'
+    args = '<replay directory>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--relays', type='int', dest='relays', default=10000,
+            help='Number of relays at the first consensus.'),
+        make_option('--subscribers', type='int', dest='subscribers',
+            default=100000, help='Number of subscribers.'),
+        make_option('--consensuses', type='int', dest='consensuses',
+            default=24, help='Number of consensuses, one hour apart.'),
+        make_option('--mix', dest='mix',
+            default=','.join([str(share) for share in synthetic.MIX]),
+            help='Probabilities of a subscriber having a node down, ' \
+                 'version, bandwidth and T-shirt subscription.'),
+        make_option('--churn', type='float', dest='churn',
+            default=synthetic.CHURN,
+            help='Share of the relays changing between two consensuses.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help='Seed for all random choices.'),
+        make_option('--load', action='store_true', dest='load',
+            default=False,
+            help='Insert the subscribers into the database too.'),
+    )
+
+    def handle(self, *args, **options):
+        """Called when generatenetwork is called from the command line."""
+        if len(args) != 1:
+            raise CommandError('Give the replay directory.')
+        try:
+            mix = tuple([float(share) for share in
+                         options['mix'].split(',')])
+        except ValueError:
+            mix = ()
+        if len(mix) != 4:
+            raise CommandError('--mix takes four comma separated numbers.')
+
+        relays, subscriptions = synthetic.generate(args[0], options['relays'],
+                                                   options['subscribers'],
+                                                   options['consensuses'],
+                                                   mix, options['churn'],
+                                                   options['seed'])
+        print 'Wrote %d consensuses of %d relays and %d subscribers with ' \
+              '%d subscriptions.' % (options['consensuses'], relays,
+                                     options['subscribers'], subscriptions)
+
+        if options['load']:
+            subscribers, subscriptions = replay.load_subscribers(
+                os.path.join(args[0], replay.SUBSCRIBER_FILE))
+            print 'Loaded %d subscribers with %d subscriptions.' % \
+                  (subscribers, subscriptions)
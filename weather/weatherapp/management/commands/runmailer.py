@@ -0,0 +1,51 @@
+"""A Django command module to send the emails in the mail queue using
+$ python manage.py runmailer
+The command keeps polling the queue until it is stopped, unless --once is
+given. The statistics of the last drain are written to
+L{metrics.mailer_metrics_file}."""
+
+import logging
+import time
+from optparse import make_option
+
+from weatherapp import mailqueue, metrics
+
+from django.core.management.base import BaseCommand
+
+logging.basicConfig(format = '%(asctime) - 15s (%(process)d) %(message)s',
+                    level = logging.DEBUG, filename = 'log/weather.log')
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to run the mail queue workers.
+
+    @type help: str
+    @cvar help: Help text for the command
+    @type _POLL_INTERVAL: int
+    @cvar _POLL_INTERVAL: Seconds to wait between looking at the queue."""
+
+    help = 'Send the emails waiting in the mail queue'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+            default=False, help='Send the due emails once, then exit.'),
+        make_option('--workers', type='int', dest='workers',
+            default=mailqueue.WORKERS,
+            help='Number of worker threads and SMTP connections.'),
+    )
+
+    _POLL_INTERVAL = 5
+
+    def handle(self, *args, **options):
+        """Called when runmailer is called from the command line. Drains the
+        mail queue, forever unless --once was given."""
+        while True:
+            try:
+                stats = mailqueue.drain(options['workers'])
+                metrics.write_json(stats, metrics.mailer_metrics_file)
+            except Exception, e:
+                logging.error('Mail queue drain failed: %s' % e)
+                if options['once']:
+                    raise
+            if options['once']:
+                break
+            time.sleep(Command._POLL_INTERVAL)
@@ -0,0 +1,208 @@
+"""
+This module times the phases of an update cycle and counts the work each
+phase did: relays processed, database queries, calls to tor through Stem and
+emails generated. After every cycle the numbers are written to a JSON file
+so that monitoring can alert when a cycle gets close to the consensus
+interval.
+
+@var metrics_file: The JSON file the last update cycle's metrics are written
+    to.
+@var mailer_metrics_file: The JSON file the mail queue's last drain
+    statistics are written to.
+@var CONSENSUS_INTERVAL: The seconds between two consensuses.
+@var WARN_FRACTION: The fraction of L{CONSENSUS_INTERVAL} after which a
+    cycle is logged as too slow.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.utils import simplejson
+
+metrics_file = 'log/cycle_metrics.json'
+mailer_metrics_file = 'log/mailer_metrics.json'
+
+CONSENSUS_INTERVAL = 3600
+WARN_FRACTION = 0.75
+
+_query_lock = threading.Lock()
+_query_count = 0
+
+class _CountingCursor:
+    """A database cursor wrapper that counts the statements it executes.
+
+    @type cursor: cursor
+    @ivar cursor: The wrapped cursor.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _count(self):
+        global _query_count
+        _query_lock.acquire()
+        try:
+            _query_count += 1
+        finally:
+            _query_lock.release()
+
+    def execute(self, sql, params = ()):
+        self._count()
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self._count()
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+@contextmanager
+def counting_queries():
+    """
+    Count the statements executed on the database connection while the
+    block runs, for L{query_count}. Django keeps one connection per thread,
+    so only the calling thread's statements are counted; threads working
+    for a counted cycle enter the block themselves. The connection's
+    C{cursor} method is wrapped on the instance and restored when the block
+    ends. Entering the block again in a thread that is counting already
+    does nothing.
+    """
+
+    if 'cursor' in connection.__dict__:
+        yield
+        return
+
+    plain_cursor = connection.cursor
+    connection.cursor = lambda: _CountingCursor(plain_cursor())
+    try:
+        yield
+    finally:
+        del connection.cursor
+
+def query_count():
+    """Get the number of database statements counted in all threads
+    while they were in a L{counting_queries} block.
+
+    @rtype: int
+    @return: The number of statements.
+    """
+
+    return _query_count
+
+def write_json(data, filename):
+    """Write C{data} to C{filename} as JSON. The file is replaced in one
+    step, so readers never see half of it.
+
+    @type data: dict
+    @param data: The metrics to write.
+    @type filename: str
+    @param filename: The file to write to.
+    """
+
+    temp_name = filename + '.tmp'
+    temp_file = open(temp_name, 'w')
+    try:
+        simplejson.dump(data, temp_file, indent = 2, sort_keys = True)
+    finally:
+        temp_file.close()
+    os.rename(temp_name, filename)
+
+class CycleMetrics:
+    """The timings and counters of one update cycle.
+
+    @type ctl_util: CtlUtil
+    @ivar ctl_util: The CtlUtil whose Stem calls are counted.
+    @type started: float
+    @ivar started: When the cycle started, in seconds since the epoch.
+    @type phases: list [dict]
+    @ivar phases: The finished phases in the order they ran. Each has a
+        'name', its duration in 'seconds', the 'queries' and 'stem_calls'
+        it issued, and the counters passed to L{end}.
+    """
+
+    def __init__(self, ctl_util):
+        self.ctl_util = ctl_util
+        self.started = time.time()
+        self.phases = []
+        self._running = {}
+
+    def _stem_calls(self):
+        return getattr(self.ctl_util, 'stem_calls', 0)
+
+    def begin(self, name):
+        """Start timing the phase C{name}.
+
+        @type name: str
+        @param name: The name of the phase.
+        """
+
+        self._running[name] = (time.time(), query_count(), self._stem_calls())
+
+    def end(self, name, **counters):
+        """Stop timing the phase C{name} and record it.
+
+        @type name: str
+        @param name: The name of the phase, as passed to L{begin}.
+        @param counters: Additional numbers describing the phase, such as
+            'relays' or 'emails'.
+        """
+
+        start, queries, stem_calls = self._running.pop(name)
+        phase = {'name': name,
+                 'seconds': round(time.time() - start, 3),
+                 'queries': query_count() - queries,
+                 'stem_calls': self._stem_calls() - stem_calls}
+        phase.update(counters)
+        self.phases.append(phase)
+
+    def as_dict(self):
+        """Get the metrics of the cycle, with totals over all phases.
+
+        @rtype: dict
+        @return: The 'started' and 'seconds' of the whole cycle, the
+            'consensus_interval', the 'phases' and the summed 'queries',
+            'stem_calls', 'relays' and 'emails'.
+        """
+
+        data = {'started': time.strftime('%Y-%m-%d %H:%M:%S',
+                                         time.localtime(self.started)),
+                'seconds': round(time.time() - self.started, 3),
+                'consensus_interval': CONSENSUS_INTERVAL,
+                'phases': self.phases}
+        for counter in ('queries', 'stem_calls', 'relays', 'emails'):
+            data[counter] = sum([phase.get(counter, 0)
+                                 for phase in self.phases])
+        return data
+
+    def write(self, filename = None):
+        """Log a summary of the cycle, warn if it took longer than
+        L{WARN_FRACTION} of the consensus interval, and write the metrics to
+        C{filename}.
+
+        @type filename: str
+        @param filename: The file to write to, L{metrics_file} by default.
+        @rtype: dict
+        @return: The metrics that were written.
+        """
+
+        data = self.as_dict()
+        logging.info('Update cycle took %.1f s: ' % data['seconds'] +
+                     ', '.join(['%s %.1f s' % (phase['name'], phase['seconds'])
+                                for phase in self.phases]))
+        if data['seconds'] > CONSENSUS_INTERVAL * WARN_FRACTION:
+            logging.warning('Update cycle took %.1f s, more than %d%% of ' \
+                            'the consensus interval.' %
+                            (data['seconds'], WARN_FRACTION * 100))
+        try:
+            write_json(data, filename or metrics_file)
+        except IOError, e:
+            logging.error('Could not write the cycle metrics: %s' % e)
+        return data
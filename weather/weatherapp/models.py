@@ -15,13 +15,15 @@ the work of the forms displayed on the sign-up and preferences pages.
 @group Custom Fields: PrefixedIntegerField
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
 import os
 import re
 from copy import copy
 
 from config import url_helper
+#Tunes every database connection the models open
+from weatherapp import database, relaysnapshot
 
 from django.db import models
 from django import forms
@@ -99,8 +101,8 @@ class Router(models.Model):
         if they are not specified in the model's construction.
 
     @type fingerprint: CharField (str)
-    @ivar fingerprint: The L{Router}'s fingerprint. Required constructor
-        argument.
+    @ivar fingerprint: The L{Router}'s fingerprint. Unique. Required
+        constructor argument.
     @type name: CharField (str)
     @ivar name: The L{Router}'s name. Default value is C{'Unnamed'}.
     @type welcomed: BooleanField (bool)
@@ -126,7 +128,7 @@ class Router(models.Model):
                   'exit': False }
 
     fingerprint = models.CharField(max_length=_FINGERPRINT_MAX_LEN,
-            default=None, blank=False)
+            default=None, blank=False, unique=True)
     name = models.CharField(max_length=_NAME_MAX_LEN,
             default=_DEFAULTS['name'])
     welcomed = models.BooleanField(default=_DEFAULTS['welcomed'])
@@ -197,6 +199,16 @@ class Subscriber(models.Model):
     @type sub_date: DateTimeField (datetime)
     @ivar sub_date: Datetime at which the L{Subscriber} subscribed. Default 
         value is the current time, evaluated by a call to C{datetime.now}.
+    @type digest: BooleanField (bool)
+    @ivar digest: Whether notifications for this L{Subscriber} may be combined
+        with the other notifications to the same email address in an update
+        cycle into one digest email; C{True} if they may, C{False} if each
+        should be sent on its own. Default value is C{True}.
+    @type changed_at: DateTimeField (datetime)
+    @ivar changed_at: Datetime at which the L{Subscriber} last confirmed
+        their subscription or changed their preferences, so the updater
+        checks their subscriptions in its next cycle. C{None} if they did
+        neither. Set by L{mark_changed}.
     """
 
     _EMAIL_MAX_LEN = 75
@@ -205,19 +217,22 @@ class Subscriber(models.Model):
                   'confirm_auth': get_rand_string,
                   'unsubs_auth': get_rand_string,
                   'pref_auth': get_rand_string,
-                  'sub_date': datetime.now }
+                  'sub_date': datetime.now,
+                  'digest': True }
 
     email = models.EmailField(max_length=_EMAIL_MAX_LEN, 
             default=None, blank=False)
     router = models.ForeignKey(Router, default=None, blank=False)
     confirmed = models.BooleanField(default=_DEFAULTS['confirmed'])
     confirm_auth = models.CharField(max_length=_AUTH_MAX_LEN,
-            default=_DEFAULTS['confirm_auth'])
+            default=_DEFAULTS['confirm_auth'], db_index=True)
     unsubs_auth = models.CharField(max_length=_AUTH_MAX_LEN,
-            default=_DEFAULTS['unsubs_auth'])
+            default=_DEFAULTS['unsubs_auth'], db_index=True)
     pref_auth = models.CharField(max_length=_AUTH_MAX_LEN,
-            default=_DEFAULTS['pref_auth'])
+            default=_DEFAULTS['pref_auth'], db_index=True)
     sub_date = models.DateTimeField(default=_DEFAULTS['sub_date'])
+    digest = models.BooleanField(default=_DEFAULTS['digest'])
+    changed_at = models.DateTimeField(null=True, db_index=True)
 
     def __unicode__(self):
         """Returns a simple description of this L{Subscriber}, namely
@@ -227,6 +242,13 @@ class Subscriber(models.Model):
         @return: Simple description of L{Subscriber}.
         """
         return self.email
+
+    def mark_changed(self):
+        """Sets L{changed_at} to now and saves this L{Subscriber}, so its
+        subscriptions are checked in the next update cycle."""
+
+        self.changed_at = datetime.now()
+        self.save()
  
     def _has_sub_type(self, sub_type):
         """Checks if this L{Subscriber} has a L{Subscription} of type
@@ -382,6 +404,8 @@ class Subscriber(models.Model):
 
         data['get_t_shirt'] = self.has_t_shirt_sub()
 
+        data['get_digest'] = self.digest
+
         return data
 
 class Subscription(models.Model):
@@ -445,6 +469,12 @@ class NodeDownSub(Subscription):
     @ivar last_changed: Datetime at which the L{triggered} flag was last 
         changed. Default value is the current time, evaluated with a call to
         C{datetime.now}.
+    @type notify_at: DateTimeField (datetime)
+    @ivar notify_at: Datetime at which the grace period of a triggered
+        subscription that hasn't been emailed yet runs out, C{None} for all
+        other subscriptions. It is indexed, so the subscriptions that are due
+        are found without looking at the others. Kept up to date by L{save}
+        and L{update_notify_at}.
     """
     
     _DEFAULTS = { 'triggered': False,
@@ -453,6 +483,23 @@ class NodeDownSub(Subscription):
     triggered= models.BooleanField(default=_DEFAULTS['triggered'])
     grace_pd = models.IntegerField(default=None, blank=False)
     last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
+    notify_at = models.DateTimeField(null=True, db_index=True)
+
+    def save(self, *args, **kwargs):
+        """Updates L{notify_at} and saves this L{NodeDownSub}."""
+
+        self.update_notify_at()
+        Subscription.save(self, *args, **kwargs)
+
+    def update_notify_at(self):
+        """Sets L{notify_at} from the L{triggered}, L{emailed}, 
+        L{last_changed} and L{grace_pd} fields."""
+
+        if self.triggered and not self.emailed:
+            self.notify_at = self.last_changed + \
+                    timedelta(hours=self.grace_pd)
+        else:
+            self.notify_at = None
     
     def is_grace_passed(self):
         """Check if the C{subscriber}'s C{router} has been offline for 
@@ -543,6 +590,14 @@ class TShirtSub(Subscription):
     @cvar _DEFAULTS: Dictionary mapping field names to their default parameters.
         These are the values that fields will be instantiated with if they are
         not specified in the model's construction.
+    @type HOURS_REQUIRED: int
+    @cvar HOURS_REQUIRED: The hours a router must be up to earn a t-shirt.
+    @type EXIT_BANDWIDTH: int
+    @cvar EXIT_BANDWIDTH: The average bandwidth in kB/s an exit node needs
+        to earn a t-shirt.
+    @type NON_EXIT_BANDWIDTH: int
+    @cvar NON_EXIT_BANDWIDTH: The average bandwidth in kB/s a non-exit node
+        needs to earn a t-shirt.
 
     @type triggered: BooleanField (bool)
     @ivar triggered: Whether the C{router} is up. Default is C{False}.
@@ -559,6 +614,11 @@ class TShirtSub(Subscription):
                   'avg_bandwidth': 0,
                   'last_changed': datetime.now }
 
+    #61 days, approx 2 months
+    HOURS_REQUIRED = 1464
+    EXIT_BANDWIDTH = 100
+    NON_EXIT_BANDWIDTH = 500
+
     triggered = models.BooleanField(default=_DEFAULTS['triggered'])
     avg_bandwidth = models.IntegerField(default=_DEFAULTS['avg_bandwidth'])
     last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
@@ -577,29 +637,45 @@ class TShirtSub(Subscription):
         else:
             return hours_since(self.last_changed)
         
+    @classmethod
+    def has_earned(cls, hours_up, avg_bandwidth, exit):
+        """Check if a router that has been up for C{hours_up} hours with an
+        average bandwidth of C{avg_bandwidth} kB/s has earned a t-shirt: it
+        must have been up for L{HOURS_REQUIRED} hours with at least
+        L{EXIT_BANDWIDTH} kB/s if it is an exit node and
+        L{NON_EXIT_BANDWIDTH} kB/s if it isn't.
+
+        @type hours_up: int
+        @param hours_up: The hours the router has been up.
+        @type avg_bandwidth: int
+        @param avg_bandwidth: The router's average bandwidth in kB/s.
+        @type exit: bool
+        @param exit: Whether the router is an exit node.
+        @rtype: C{bool}
+        @return: Whether a t-shirt was earned.
+        """
+
+        if exit:
+            required = cls.EXIT_BANDWIDTH
+        else:
+            required = cls.NON_EXIT_BANDWIDTH
+        return hours_up >= cls.HOURS_REQUIRED and avg_bandwidth >= required
+
     def should_email(self):
         """Determines if the L{subscriber<Subscription.subscriber>} has earned a
-        t-shirt by running its L{router<Subscriber.router>}. Determines this by
-        checking if the L{router<Subscriber.router>} has been up for 1464 hours
-        (61 days, appox 2 months) and then checking if its average bandwidth is
-        above the required threshold (100 kB/s for an exit node, 500 kB/s for a
-        non-exit node).
+        t-shirt by running its L{router<Subscriber.router>}, see
+        L{has_earned}.
         
         @rtype: C{bool}
         @return: Whether the L{subscriber<Subscription.subscriber>} has earned 
             a t-shirt; C{True} if they have, C{False} if they haven't.
         """ 
         
-        hours_up = self.get_hours_since_triggered()
-        
-        if not self.emailed and self.triggered and hours_up >= 1464:
-            if self.subscriber.router.exit:
-                if self.avg_bandwidth >= 100:
-                    return True
-            else:
-                if self.avg_bandwidth >= 500:
-                    return True
-        return False
+        if self.emailed or not self.triggered:
+            return False
+        return self.has_earned(self.get_hours_since_triggered(),
+                               self.avg_bandwidth,
+                               self.subscriber.router.exit)
 
 
 # CUSTOM FIELDS ---------------------------------------------------------------
@@ -777,6 +853,11 @@ class GenericForm(forms.Form):
     @type _GET_T_SHIRT_INIT: bool
     @cvar _GET_T_SHIRT_INIT: Initial display value and default submission 
         value of the L{get_t_shirt} checkbox.
+    @type _GET_DIGEST_LABEL: str
+    @cvar _GET_DIGEST_LABEL: Text displayed next to the L{get_digest} checkbox.
+    @type _GET_DIGEST_INIT: bool
+    @cvar _GET_DIGEST_INIT: Initial display value and default submission 
+        value of the L{get_digest} checkbox.
     @type _T_SHIRT_SECTION_INFO: str
     @cvar _T_SHIRT_SECTION_INFO: Text explaining the t-shirt subscription,
         displayed in the expandable version section of the form, with HTML
@@ -817,6 +898,10 @@ class GenericForm(forms.Form):
     @type get_t_shirt: BooleanField
     @ivar get_t_shirt: Checkbox letting users choose to subscribe to a 
         L{TShirtSub}.
+
+    @type get_digest: BooleanField
+    @ivar get_digest: Checkbox letting users choose whether their
+        notifications may be combined into digest emails.
     """
       
     _GET_NODE_DOWN_INIT = True
@@ -857,6 +942,10 @@ class GenericForm(forms.Form):
     _T_SHIRT_SECTION_INFO = '<em>Note:</em> You must be the router\'s \
     operator to claim your T-shirt.'
 
+    _GET_DIGEST_INIT = True
+    _GET_DIGEST_LABEL = 'Combine the reports sent to my email address at the \
+            same time into one email'
+
     _INIT_PREFIX = 'Default value is '
     _CLASS_SHORT = 'short-input'
     _CLASS_RADIO = 'radio-list'
@@ -870,7 +959,8 @@ class GenericForm(forms.Form):
                      'get_band_low': _GET_BAND_LOW_INIT,
                      'band_low_threshold': _INIT_PREFIX + \
                              str(_BAND_LOW_THRESHOLD_INIT),
-                     'get_t_shirt': _GET_T_SHIRT_INIT}
+                     'get_t_shirt': _GET_T_SHIRT_INIT,
+                     'get_digest': _GET_DIGEST_INIT}
 
     get_node_down = forms.BooleanField(required=False,
             label=_GET_NODE_DOWN_LABEL,
@@ -901,6 +991,10 @@ class GenericForm(forms.Form):
             label=_GET_T_SHIRT_LABEL,
             widget=forms.CheckboxInput(attrs={'class':_CLASS_CHECK}))
 
+    get_digest = forms.BooleanField(required=False,
+            label=_GET_DIGEST_LABEL,
+            widget=forms.CheckboxInput(attrs={'class':_CLASS_CHECK}))
+
     def __init__(self, data = None, initial = None):
         """Initializes form and creates instance variables for the text
         displayed in the version and t-shirt sections of the form so that the
@@ -1138,15 +1232,21 @@ class SubscribeForm(GenericForm):
             raise forms.ValidationError(msg)
 
     def is_valid_router(self, fingerprint):
-        """Helper function to check if a router exists in the database.
+        """Helper function to check if a router exists, in the relay
+        snapshot if one is published and else in the database.
 
         @type fingerprint: str
         @arg fingerprint: String representation of a router's fingerprint.
         @rtype: bool
-        @return: Whether a router with the specified fingerprint exists in
-            the database; C{True} if it does, C{False} if it doesn't.
+        @return: Whether a router with the specified fingerprint exists;
+            C{True} if it does, C{False} if it doesn't.
         """
 
+        #The snapshot leaves out routers stored with malformed fingerprints
+        snapshot = relaysnapshot.current()
+        if snapshot is not None and relaysnapshot.is_fingerprint(fingerprint):
+            return fingerprint in snapshot
+
         # The router fingerprint field is unique, so we only need to worry
         # about the router not existing, not there being two routers.
         try:
@@ -1156,6 +1256,26 @@ class SubscribeForm(GenericForm):
         else:
             return True
 
+    def get_router(self, fingerprint):
+        """Get the router with the fingerprint C{fingerprint}, built from
+        the relay snapshot if it has the router and else loaded from the
+        database. A router built from the snapshot only has the fields the
+        snapshot holds, so it must not be saved.
+
+        @type fingerprint: str
+        @arg fingerprint: String representation of a router's fingerprint.
+        @rtype: L{Router}
+        @return: The router.
+        """
+
+        snapshot = relaysnapshot.current()
+        entry = snapshot is not None and snapshot.get(fingerprint)
+        if not entry:
+            return Router.objects.get(fingerprint=fingerprint)
+        router_id, name, up, exit, last_seen = entry
+        return Router(id=router_id, fingerprint=fingerprint, name=name,
+                      up=up, exit=exit, last_seen=last_seen)
+
     def create_subscriber(self):
         """Attempts to save the new subscriber, but throws a catchable error
         if a subscriber already exists with the given email and fingerprint.
@@ -1165,12 +1285,12 @@ class SubscribeForm(GenericForm):
 
         email = self.cleaned_data['email_1']
         fingerprint = self.cleaned_data['fingerprint']
-        router = Router.objects.get(fingerprint=fingerprint)
+        router = self.get_router(fingerprint)
 
         # Get all subscribers that have both the email and fingerprint
         # entered in the form. 
         subscriber_query_set = Subscriber.objects.filter(email=email, 
-                                    router__fingerprint=fingerprint)
+                                                         router=router)
         
         # Redirect the user if such a subscriber exists, else create one.
         if subscriber_query_set.count() > 0:
@@ -1180,7 +1300,8 @@ class SubscribeForm(GenericForm):
             raise Exception(url_extension)
             #raise UserAlreadyExistsError(url_extension)
         else:
-            subscriber = Subscriber(email=email, router=router)
+            subscriber = Subscriber(email=email, router=router,
+                                    digest=self.cleaned_data['get_digest'])
             subscriber.save()
             return subscriber
  
@@ -1326,6 +1447,9 @@ class PreferencesForm(GenericForm):
             t = TShirtSub(subscriber=self.user)
             t.save()
 
+        self.user.digest = new_data['get_digest']
+        self.user.mark_changed()
+
 class DeployedDatetime(models.Model):
     """Stores the date and time when this instance of Tor Weather was first
     deployed. This should only ever have one row, and is used by updaters to 
@@ -1348,3 +1472,71 @@ class DeployedDatetime(models.Model):
 
         return self.deployed
 
+
+class QueuedEmail(models.Model):
+    """An outgoing notification email waiting in the mail queue. Rows are
+    written by L{mailqueue.enqueue} and removed by L{mailqueue.drain} once the
+    email was sent or given up on.
+
+    @type _SUBJECT_MAX_LEN: int
+    @cvar _SUBJECT_MAX_LEN: Maximum length for the L{subject} field.
+    @type _EMAIL_MAX_LEN: int
+    @cvar _EMAIL_MAX_LEN: Maximum length for the L{sender} and L{recipient}
+        fields.
+
+    @type subject: CharField (str)
+    @ivar subject: The subject line of the email.
+    @type message: TextField (str)
+    @ivar message: The body of the email.
+    @type sender: CharField (str)
+    @ivar sender: The From: address of the email.
+    @type recipient: CharField (str)
+    @ivar recipient: The address the email is sent to.
+    @type created: DateTimeField (datetime)
+    @ivar created: When the email was queued. Default value is the current
+        time, evaluated by a call to C{datetime.now}.
+    @type next_attempt: DateTimeField (datetime)
+    @ivar next_attempt: The earliest time at which the email should be
+        (re)sent. Default value is the current time.
+    @type attempts: IntegerField (int)
+    @ivar attempts: The number of failed attempts to send the email. Default
+        value is 0.
+    @type last_error: TextField (str)
+    @ivar last_error: The error of the most recent failed attempt.
+    @type priority: IntegerField (int)
+    @ivar priority: Emails with a higher priority are sent first. Default
+        value is 0.
+    @type claimed_by: CharField (str)
+    @ivar claimed_by: The drain sending the email, see L{mailqueue.drain}.
+        Default value is the empty string.
+    @type claimed_at: DateTimeField (datetime)
+    @ivar claimed_at: When L{claimed_by} claimed the email, or C{None} if
+        nobody is sending it.
+    """
+
+    _SUBJECT_MAX_LEN = 255
+    _EMAIL_MAX_LEN = 75
+    _OWNER_MAX_LEN = 64
+
+    subject = models.CharField(max_length=_SUBJECT_MAX_LEN)
+    message = models.TextField()
+    sender = models.CharField(max_length=_EMAIL_MAX_LEN)
+    recipient = models.CharField(max_length=_EMAIL_MAX_LEN)
+    created = models.DateTimeField(default=datetime.now)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    priority = models.IntegerField(default=0)
+    claimed_by = models.CharField(max_length=_OWNER_MAX_LEN, blank=True,
+            default='')
+    claimed_at = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        """Returns a simple description of this L{QueuedEmail}, namely its
+        L{recipient} and L{subject}.
+
+        @rtype: str
+        @return: Simple description of L{QueuedEmail}.
+        """
+
+        return self.recipient + ": " + self.subject
@@ -0,0 +1,222 @@
+"""
+This module looks up router names for the router search on the subscribe
+page. After each consensus the updater publishes the routers as a relay
+snapshot (see L{relaysnapshot}), which the web server processes map and
+search. Until the first snapshot is published, or while it can't be read,
+the lookups are answered by L{DatabaseIndex} with queries on the router
+table instead.
+
+After each consensus the updater also publishes the names and fingerprints
+of the running routers as a static JSON file in L{directory_dir}, named after
+a hash of its contents so browsers can cache it for good. The subscribe page
+loads it once and searches router names without asking the server. The URL
+of the current file is kept in L{stamp_file}, which the updater rewrites
+after every consensus.
+
+@var stamp_file: The file whose modification time tells when the routers
+    were last updated, and which holds the URL of the current router
+    directory.
+@var directory_dir: The directory the router directory files are written to.
+@var directory_url: The URL L{directory_dir} is served under.
+@var KEEP_DIRECTORIES: How many router directory files are kept, so pages
+    loaded before an update can still fetch theirs.
+@var MAX_RESULTS: The most names a name search returns.
+"""
+
+import hashlib
+import logging
+import os
+
+from weatherapp import relaysnapshot
+from weatherapp.models import Router
+
+from django.conf import settings
+from django.utils import simplejson
+
+stamp_file = os.path.join(settings.PROJECT_PATH, '..', 'var', 'routers.stamp')
+directory_dir = os.path.join(settings.PROJECT_PATH, 'media', 'relays')
+directory_url = '/media/relays/'
+
+MAX_RESULTS = relaysnapshot.MAX_RESULTS
+KEEP_DIRECTORIES = 3
+
+class DatabaseIndex:
+    """
+    Answers the lookups of L{relaysnapshot.RelaySnapshot} with queries on
+    the router table, in the same order, for when no snapshot can be read.
+    """
+
+    def search(self, query, limit = MAX_RESULTS):
+        """
+        Find the names of the routers whose name contains C{query},
+        case-insensitively and running routers first.
+
+        @type query: unicode
+        @param query: The text to look for, at least three characters long.
+        @type limit: int
+        @param limit: The most names to return.
+        @rtype: list [unicode]
+        @return: The distinct matching names.
+        """
+
+        results = []
+        seen = set()
+        names = Router.objects.filter(name__icontains = query).order_by(
+                    '-up', 'name').values_list('name', flat = True)
+        for name in names.iterator():
+            if name not in seen:
+                seen.add(name)
+                results.append(name)
+                if len(results) >= limit:
+                    break
+        return results
+
+    def fingerprints(self, name):
+        """
+        Get the fingerprints of the routers named exactly C{name}.
+
+        @type name: unicode
+        @param name: The router name.
+        @rtype: list [str]
+        @return: The fingerprints, running routers first, empty if there is
+            no such router.
+        """
+
+        return [str(fingerprint) for fingerprint in
+                Router.objects.filter(name = name).order_by(
+                    '-up', 'fingerprint').values_list('fingerprint',
+                                                      flat = True)]
+
+_directory = ''
+_directory_stamp = None
+
+def _stamp():
+    """Get the modification time of L{stamp_file}, or C{None} if it doesn't
+    exist."""
+
+    try:
+        return os.stat(stamp_file).st_mtime
+    except OSError:
+        return None
+
+def get_index():
+    """
+    Get the router name index: the published relay snapshot, or if there is
+    none, a L{DatabaseIndex}.
+
+    @rtype: L{relaysnapshot.RelaySnapshot} or L{DatabaseIndex}
+    @return: The current index.
+    """
+
+    snapshot = relaysnapshot.current()
+    if snapshot is not None:
+        return snapshot
+    return DatabaseIndex()
+
+def get_directory_url():
+    """
+    Get the URL of the current router directory file.
+
+    @rtype: str
+    @return: The URL, or the empty string if no directory was published.
+    """
+
+    global _directory, _directory_stamp
+
+    stamp = _stamp()
+    if stamp != _directory_stamp:
+        _directory = _read_stamp()
+        _directory_stamp = stamp
+    return _directory
+
+def _read_stamp():
+    """Get the router directory URL stored in L{stamp_file}."""
+
+    try:
+        stamp = open(stamp_file)
+        try:
+            return stamp.read().strip()
+        finally:
+            stamp.close()
+    except IOError:
+        return ''
+
+def publish_snapshot():
+    """
+    Publish a relay snapshot of all routers in the database.
+
+    @rtype: int
+    @return: The number of routers in the snapshot, or 0 if it couldn't be
+        written.
+    """
+
+    routers = Router.objects.values_list('id', 'fingerprint', 'name', 'up',
+                                         'exit', 'last_seen')
+    try:
+        return relaysnapshot.publish(routers)
+    except (IOError, OSError, TypeError, ValueError), e:
+        logging.error('Could not write the relay snapshot: %s' % e)
+        return 0
+
+def mark_changed(directory = ''):
+    """Tell the web server processes that the routers changed, so they link
+    the new router directory.
+
+    @type directory: str
+    @param directory: The URL of the new router directory file.
+    """
+
+    try:
+        stamp = open(stamp_file, 'w')
+        try:
+            stamp.write(directory)
+        finally:
+            stamp.close()
+    except IOError, e:
+        logging.error('Could not write %s: %s' % (stamp_file, e))
+
+def publish_directory():
+    """
+    Write the names and fingerprints of the running routers to a new router
+    directory file, and remove all but the newest L{KEEP_DIRECTORIES} files.
+    The file holds a JSON list of [name, fingerprint] pairs ordered by name.
+
+    @rtype: str
+    @return: The URL of the file, or the empty string if it couldn't be
+        written.
+    """
+
+    routers = Router.objects.filter(up = True).order_by('name', 'fingerprint')
+    data = simplejson.dumps([[name, fingerprint] for name, fingerprint in
+                             routers.values_list('name', 'fingerprint')],
+                            separators = (',', ':'))
+    filename = 'relays-%s.json' % hashlib.sha1(data).hexdigest()[:12]
+    path = os.path.join(directory_dir, filename)
+
+    try:
+        if not os.path.isdir(directory_dir):
+            os.makedirs(directory_dir)
+        if not os.path.exists(path):
+            directory = open(path + '.tmp', 'w')
+            try:
+                directory.write(data)
+            finally:
+                directory.close()
+            os.rename(path + '.tmp', path)
+        #Bump it so it's the newest even if it was published before
+        os.utime(path, None)
+    except (IOError, OSError), e:
+        logging.error('Could not write the router directory: %s' % e)
+        return ''
+
+    older = [os.path.join(directory_dir, name) for name in
+             os.listdir(directory_dir) if name != filename and
+             name.startswith('relays-') and name.endswith('.json')]
+    older.sort(key = os.path.getmtime, reverse = True)
+    for old in older[KEEP_DIRECTORIES - 1:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+    return directory_url + filename
@@ -0,0 +1,399 @@
+"""
+This module writes and reads the relay snapshot, a read-only file the
+updater publishes after every cycle so the web pages can validate and look
+up routers without asking the database. The web server processes map the
+file into memory instead of reading it, so all of them share one copy, and
+L{current} maps it again when the updater replaced it. A new snapshot is
+written to a temporary file and renamed over the old one, so a process
+either sees the old file or the new one, never half of one.
+
+The file, L{snapshot_file}, starts with L{_MAGIC} and a header of section
+offsets, followed by these sections:
+
+  - The records, one per router ordered by binary fingerprint: the
+    fingerprint, the router's id, its up and exit flags, when it was last
+    seen and where its name is.
+  - The positions of the records in search order: running routers first,
+    then by name.
+  - The positions of the records ordered by name, for exact name lookups.
+  - The trigram table: for the CRC-32 of every lowercase trigram of a name,
+    where its list of search order ranks is.
+  - The rank lists of the trigram table.
+  - The names, UTF-8 encoded.
+
+@var snapshot_file: The published snapshot.
+@var MAX_RESULTS: The most names a name search returns.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from django.conf import settings
+
+snapshot_file = os.path.join(settings.PROJECT_PATH, '..', 'var',
+                             'relays.snapshot')
+
+MAX_RESULTS = 20
+
+_MAGIC = 'TWRELAY\x00\x01'
+
+#relays, trigrams, published, and the offsets of the records, the search
+#order, the name order, the trigram table and the names
+_HEADER = struct.Struct('<IIIIIIII')
+
+#fingerprint, id, flags, last seen, name offset, name length
+_RECORD = struct.Struct('<20sIBIIH')
+
+#trigram hash, offset of its ranks, number of ranks
+_TRIGRAM = struct.Struct('<III')
+
+_POSITION = struct.Struct('<I')
+
+_UP = 1
+_EXIT = 2
+
+_FINGERPRINT = re.compile('^[0-9A-F]{40}$')
+
+def is_fingerprint(fingerprint):
+    """Check if C{fingerprint} is an uppercase hexadecimal fingerprint of
+    40 characters, the only kind a snapshot holds."""
+
+    return bool(_FINGERPRINT.match(fingerprint))
+
+def _trigrams(name):
+    """Get the hashes of the lowercase trigrams of C{name}."""
+
+    lower = name.lower()
+    return set([zlib.crc32(lower[i:i + 3].encode('utf-8')) & 0xffffffff
+                for i in range(len(lower) - 2)])
+
+def publish(routers, path = None):
+    """
+    Write a snapshot of C{routers} and replace the published one with it.
+
+    @type routers: iterable
+    @param routers: (id, fingerprint, name, up, exit, last_seen) tuples of
+        the routers. Routers whose fingerprint isn't L{is_fingerprint} are
+        left out.
+    @type path: str
+    @param path: The file to write, L{snapshot_file} by default.
+    @rtype: int
+    @return: The number of routers written.
+    """
+
+    path = path or snapshot_file
+    valid = []
+    for router_id, fingerprint, name, up, exit, last_seen in routers:
+        if is_fingerprint(fingerprint):
+            valid.append((str(fingerprint).decode('hex'), router_id, name, up,
+                          exit, last_seen))
+        else:
+            logging.warning('Left router %d with the fingerprint %r out of '
+                            'the relay snapshot.' % (router_id, fingerprint))
+    routers = sorted(valid)
+    count = len(routers)
+
+    names = []
+    name_offsets = []
+    offset = 0
+    for router in routers:
+        encoded = router[2].encode('utf-8')
+        names.append(encoded)
+        name_offsets.append(offset)
+        offset += len(encoded)
+
+    ranked = sorted(range(count), key = lambda i: (not routers[i][3],
+                                                   routers[i][2]))
+    rank = [0] * count
+    for position, index in enumerate(ranked):
+        rank[index] = position
+    by_name = sorted(range(count), key = lambda i: (names[i], rank[i]))
+
+    postings = {}
+    for position, index in enumerate(ranked):
+        for trigram in _trigrams(routers[index][2]):
+            postings.setdefault(trigram, []).append(position)
+    trigrams = sorted(postings)
+
+    records_offset = len(_MAGIC) + _HEADER.size
+    ranked_offset = records_offset + count * _RECORD.size
+    by_name_offset = ranked_offset + count * _POSITION.size
+    trigram_offset = by_name_offset + count * _POSITION.size
+    postings_offset = trigram_offset + len(trigrams) * _TRIGRAM.size
+    names_offset = postings_offset + sum([len(ranks) for ranks in
+                                          postings.values()]) * \
+                                     _POSITION.size
+
+    parts = [_MAGIC, _HEADER.pack(count, len(trigrams), int(time.time()),
+                                  records_offset, ranked_offset,
+                                  by_name_offset, trigram_offset,
+                                  names_offset)]
+    for i, (fingerprint, router_id, name, up, exit, last_seen) in \
+            enumerate(routers):
+        flags = (up and _UP or 0) | (exit and _EXIT or 0)
+        parts.append(_RECORD.pack(fingerprint, router_id, flags,
+                                  int(time.mktime(last_seen.timetuple())),
+                                  name_offsets[i], len(names[i])))
+    parts.append(struct.pack('<%dI' % count, *ranked))
+    parts.append(struct.pack('<%dI' % count, *by_name))
+    offset = postings_offset
+    for trigram in trigrams:
+        parts.append(_TRIGRAM.pack(trigram, offset, len(postings[trigram])))
+        offset += len(postings[trigram]) * _POSITION.size
+    for trigram in trigrams:
+        parts.append(struct.pack('<%dI' % len(postings[trigram]),
+                                 *postings[trigram]))
+    parts.extend(names)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp = open(path + '.tmp', 'wb')
+    try:
+        temp.write(''.join(parts))
+    finally:
+        temp.close()
+    os.rename(path + '.tmp', path)
+    return count
+
+class RelaySnapshot:
+    """
+    A mapped relay snapshot. It answers the router lookups of the web pages
+    without loading the routers.
+
+    @type relays: int
+    @ivar relays: The number of routers in the snapshot.
+    @type published: datetime
+    @ivar published: When the snapshot was written.
+    """
+
+    def __init__(self, path):
+        """
+        Map the snapshot C{path}.
+
+        @raise IOError: If C{path} can't be read, isn't a relay snapshot or
+            is truncated.
+        """
+
+        snapshot = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(snapshot.fileno(), 0,
+                                  access = mmap.ACCESS_READ)
+        finally:
+            snapshot.close()
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            raise IOError('%s is not a relay snapshot' % path)
+
+        (self.relays, self._trigram_count, published, self._records,
+         self._ranked, self._by_name, self._trigrams,
+         self._names) = _HEADER.unpack_from(self._map, len(_MAGIC))
+        if len(self._map) < self._names:
+            raise IOError('%s is truncated' % path)
+        self.published = datetime.fromtimestamp(published)
+
+    def __len__(self):
+        return self.relays
+
+    def __contains__(self, fingerprint):
+        return self._find(fingerprint) is not None
+
+    def _record(self, index):
+        """Get the record at position C{index}."""
+
+        return _RECORD.unpack_from(self._map,
+                                   self._records + index * _RECORD.size)
+
+    def _position(self, section, index):
+        """Get the C{index}th record position of the section starting at
+        C{section}."""
+
+        return _POSITION.unpack_from(self._map,
+                                     section + index * _POSITION.size)[0]
+
+    def _name(self, record):
+        """Get the name of the router of C{record}."""
+
+        start = self._names + record[4]
+        return self._map[start:start + record[5]].decode('utf-8')
+
+    def _find(self, fingerprint):
+        """Find the record of the router with the hexadecimal
+        C{fingerprint}, or return C{None} if there is none."""
+
+        if not is_fingerprint(fingerprint):
+            return None
+        key = str(fingerprint).decode('hex')
+
+        low, high = 0, self.relays
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.relays:
+            record = self._record(low)
+            if record[0] == key:
+                return record
+        return None
+
+    def get(self, fingerprint):
+        """
+        Get the router with the fingerprint C{fingerprint}.
+
+        @type fingerprint: str
+        @param fingerprint: The uppercase fingerprint, without spaces.
+        @rtype: tuple (int, unicode, bool, bool, datetime)
+        @return: The id, name, up and exit flags and last seen time of the
+            router, or C{None} if it isn't in the snapshot.
+        """
+
+        record = self._find(fingerprint)
+        if record is None:
+            return None
+        return (record[1], self._name(record), bool(record[2] & _UP),
+                bool(record[2] & _EXIT), datetime.fromtimestamp(record[3]))
+
+    def _ranks(self, trigram):
+        """Get the ascending search order ranks of the names with a trigram
+        hashing to C{trigram}."""
+
+        low, high = 0, self._trigram_count
+        while low < high:
+            middle = (low + high) // 2
+            entry = _TRIGRAM.unpack_from(self._map, self._trigrams +
+                                         middle * _TRIGRAM.size)
+            if entry[0] < trigram:
+                low = middle + 1
+            elif entry[0] > trigram:
+                high = middle
+            else:
+                return struct.unpack_from('<%dI' % entry[2], self._map,
+                                          entry[1])
+        return ()
+
+    def search(self, query, limit = MAX_RESULTS):
+        """
+        Find the names of the routers whose name contains C{query},
+        case-insensitively and running routers first.
+
+        @type query: unicode
+        @param query: The text to look for, at least three characters long.
+        @type limit: int
+        @param limit: The most names to return.
+        @rtype: list [unicode]
+        @return: The distinct matching names.
+        """
+
+        trigrams = _trigrams(query)
+        if not trigrams:
+            return []
+        postings = sorted([self._ranks(trigram) for trigram in trigrams],
+                          key = len)
+        others = [set(ranks) for ranks in postings[1:]]
+        query = query.lower()
+
+        results = []
+        seen = set()
+        for rank in postings[0]:
+            for ranks in others:
+                if rank not in ranks:
+                    break
+            else:
+                name = self._name(self._record(self._position(self._ranked,
+                                                              rank)))
+                if name not in seen and query in name.lower():
+                    seen.add(name)
+                    results.append(name)
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def fingerprints(self, name):
+        """
+        Get the fingerprints of the routers named exactly C{name}.
+
+        @type name: unicode
+        @param name: The router name.
+        @rtype: list [str]
+        @return: The fingerprints, running routers first, empty if there is
+            no such router.
+        """
+
+        encoded = name.encode('utf-8')
+        records = _NameOrder(self)
+        position = bisect.bisect_left(records, encoded)
+        fingerprints = []
+        while position < self.relays:
+            record = records.record(position)
+            if self._name(record).encode('utf-8') != encoded:
+                break
+            fingerprints.append(record[0].encode('hex').upper())
+            position += 1
+        return fingerprints
+
+class _NameOrder:
+    """The encoded names of a L{RelaySnapshot}'s routers in name order, as a
+    sequence for C{bisect}."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.relays
+
+    def record(self, position):
+        snapshot = self.snapshot
+        return snapshot._record(snapshot._position(snapshot._by_name,
+                                                   position))
+
+    def __getitem__(self, position):
+        return self.snapshot._name(self.record(position)).encode('utf-8')
+
+_snapshot = None
+_snapshot_id = None
+_snapshot_lock = threading.Lock()
+
+def current():
+    """
+    Get the published snapshot, mapping it again if it was replaced since
+    it was last mapped.
+
+    @rtype: L{RelaySnapshot}
+    @return: The snapshot, or C{None} if none was published or it can't be
+        read.
+    """
+
+    global _snapshot, _snapshot_id
+
+    try:
+        stat = os.stat(snapshot_file)
+    except OSError:
+        return None
+    snapshot_id = (snapshot_file, stat.st_ino, stat.st_size, stat.st_mtime)
+    if snapshot_id == _snapshot_id:
+        return _snapshot
+
+    _snapshot_lock.acquire()
+    try:
+        if snapshot_id != _snapshot_id:
+            try:
+                snapshot = RelaySnapshot(snapshot_file)
+            #mmap raises ValueError for an empty file
+            except (EnvironmentError, ValueError, struct.error), e:
+                logging.error('Could not map the relay snapshot: %s' % e)
+                return None
+            #Processes still reading the old snapshot keep their mapping
+            _snapshot = snapshot
+            _snapshot_id = snapshot_id
+        return _snapshot
+    finally:
+        _snapshot_lock.release()
@@ -0,0 +1,460 @@
+"""
+This module replays recorded consensuses through the updater without a tor
+process, to measure how long update cycles take and how much work they do.
+
+A replay directory holds one sub-directory per consensus, replayed in the
+order of their names. Each is a copy of the files tor keeps in its data
+directory: C{cached-consensus} and C{cached-descriptors}, plus
+C{cached-descriptors.new} if tor had one (it holds the descriptors that
+arrived since C{cached-descriptors} was last rebuilt). A consensus without
+descriptor files reuses the descriptors of the one before it.
+
+A replay directory may also hold a L{SUBSCRIBER_FILE}, a CSV file with a
+header line of L{SUBSCRIBER_COLUMNS} and one line per confirmed subscriber.
+The last four columns hold the grace period of the node down subscription,
+the notification type of the version subscription, the threshold of the
+bandwidth subscription and '1' for a T-shirt subscription, and are empty for
+the subscriptions the subscriber doesn't have. L{load_subscribers} inserts
+such a file into the database.
+
+L{ReplayController} stands in for the Stem controller of a L{CtlUtil} and
+answers its requests from these files with Stem's offline parsers.
+L{run_benchmark} loads the subscriber file into a throwaway database, or
+seeds it with random subscribers if there is none, and runs
+L{updaters.run_all} once per consensus. The cycles run back to back, so the
+checks that depend on time passing (grace periods, T-shirt uptime) see the
+clock of the benchmark rather than the consensus times.
+
+@var CONSENSUS_FILE: The name of the consensus file of each consensus.
+@var DESCRIPTOR_FILES: The names of the server descriptor files of each
+    consensus, in the order they are read.
+@var SUBSCRIBER_FILE: The name of the subscriber file of a replay
+    directory.
+@var SUBSCRIBER_COLUMNS: The header line of a subscriber file.
+@var SUBSCRIBERS: The default number of subscribers to seed.
+@var SEED: The default seed for choosing the subscribers' routers and
+    subscriptions.
+"""
+
+import csv
+from datetime import datetime
+import itertools
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import stem
+import stem.descriptor
+
+from weatherapp import ctlutil, history, mailqueue, metrics, relayindex, \
+                       relaysnapshot, updaters
+from weatherapp.ctlutil import CtlUtil, ContactCache
+from weatherapp.models import Router, Subscriber, Subscription, NodeDownSub, \
+                              VersionSub, BandwidthSub, TShirtSub, \
+                              get_rand_string
+from config import config
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+CONSENSUS_FILE = 'cached-consensus'
+DESCRIPTOR_FILES = ['cached-descriptors', 'cached-descriptors.new']
+SUBSCRIBER_FILE = 'subscribers.csv'
+SUBSCRIBER_COLUMNS = ['email', 'fingerprint', 'digest', 'grace_pd',
+                      'notify_type', 'threshold', 'tshirt']
+
+SUBSCRIBERS = 1000
+SEED = 0
+
+_CONSENSUS_TYPE = 'network-status-consensus-3 1.0'
+_DESCRIPTOR_TYPE = 'server-descriptor 1.0'
+
+#The number of subscriber file lines inserted with one statement per table
+_LOAD_BATCH_SIZE = 5000
+
+#The columns L{load_subscribers} fills in, the primary key first
+_LOAD_FIELDS = {
+    Router: ['id', 'fingerprint', 'name', 'welcomed', 'last_seen', 'up',
+             'exit'],
+    Subscriber: ['id', 'email', 'router', 'confirmed', 'confirm_auth',
+                 'unsubs_auth', 'pref_auth', 'sub_date', 'digest'],
+    Subscription: ['id', 'subscriber', 'emailed'],
+    NodeDownSub: ['subscription_ptr', 'triggered', 'grace_pd',
+                  'last_changed', 'notify_at'],
+    VersionSub: ['subscription_ptr', 'notify_type'],
+    BandwidthSub: ['subscription_ptr', 'threshold'],
+    TShirtSub: ['subscription_ptr', 'triggered', 'avg_bandwidth',
+                'last_changed'],
+}
+
+#The module level files the updater writes to, and the names they get in the
+#benchmark's scratch directory
+_SCRATCH_FILES = [(history, 'history_dir', 'history'),
+                  (relayindex, 'stamp_file', 'routers.stamp'),
+                  (relayindex, 'directory_dir', 'relays'),
+                  (relaysnapshot, 'snapshot_file', 'relays.snapshot'),
+                  (metrics, 'metrics_file', 'cycle_metrics.json'),
+                  (ctlutil, 'unparsable_email_file', 'unparsable_emails.txt'),
+                  (ctlutil, 'contact_cache_file', 'contacts.cache'),
+                  (mailqueue, 'drain_stamp_file', 'mailer.stamp'),
+                  (mailqueue, 'failed_email_file', 'failed_emails.txt')]
+
+class ReplayController:
+    """
+    Answers the requests L{CtlUtil} sends to tor from the consensuses in a
+    replay directory, one consensus at a time. The documents are parsed
+    without validation: tor checked them before it cached them.
+
+    @type consensuses: list [str]
+    @ivar consensuses: The directories of the consensuses, in replay order.
+    @type position: int
+    @ivar position: The index in L{consensuses} of the current consensus,
+        -1 before L{advance} was first called.
+    @type requests: int
+    @ivar requests: The number of requests answered.
+    """
+
+    def __init__(self, directory):
+        """
+        @type directory: str
+        @param directory: The replay directory.
+        @raise ValueError: If C{directory} holds no consensus.
+        """
+
+        self.consensuses = sorted([os.path.join(directory, name) for name in
+                                   os.listdir(directory) if os.path.isfile(
+                                   os.path.join(directory, name,
+                                                CONSENSUS_FILE))])
+        if not self.consensuses:
+            raise ValueError('No consensuses in %s' % directory)
+        self.position = -1
+        self.requests = 0
+        self._descriptor_dir = None
+        self._document = None
+
+    def advance(self):
+        """
+        Move on to the next consensus.
+
+        @rtype: bool
+        @return: C{False} if the last consensus was replayed already.
+        """
+
+        if self.position + 1 >= len(self.consensuses):
+            return False
+        self.position += 1
+        consensus_dir = self.consensuses[self.position]
+        for filename in DESCRIPTOR_FILES:
+            if os.path.isfile(os.path.join(consensus_dir, filename)):
+                self._descriptor_dir = consensus_dir
+                break
+        self._document = None
+        return True
+
+    def consensus_name(self):
+        """Get the name of the directory of the current consensus."""
+
+        return os.path.basename(self.consensuses[self.position])
+
+    def _consensus(self):
+        """Get the current consensus document, parsing it the first time it
+        is asked for."""
+
+        if self._document is None:
+            path = os.path.join(self.consensuses[self.position],
+                                CONSENSUS_FILE)
+            self._document = stem.descriptor.parse_file(path,
+                    _CONSENSUS_TYPE, validate = False,
+                    document_handler = stem.descriptor.DocumentHandler.DOCUMENT
+                    ).next()
+        return self._document
+
+    def get_network_statuses(self, default = None):
+        """Get the router status entries of the current consensus."""
+
+        self.requests += 1
+        return self._consensus().routers.values()
+
+    def get_server_descriptors(self, default = None):
+        """Get the server descriptors of the current consensus."""
+
+        self.requests += 1
+        if self._descriptor_dir is None:
+            return
+        for filename in DESCRIPTOR_FILES:
+            path = os.path.join(self._descriptor_dir, filename)
+            if os.path.isfile(path):
+                for desc in stem.descriptor.parse_file(path, _DESCRIPTOR_TYPE,
+                                                       validate = False):
+                    yield desc
+
+    def get_info(self, param, default = None):
+        """Answer the GETINFO request for C{param}. Only the recommended
+        versions are known, taken from the server-versions of the current
+        consensus."""
+
+        self.requests += 1
+        if param == 'status/version/recommended':
+            return ','.join([str(version) for version in
+                             self._consensus().server_versions])
+        if default is not None:
+            return default
+        raise stem.InvalidArguments('552', 'Unrecognized key "%s"' % param,
+                                    [param])
+
+    def is_alive(self):
+        return True
+
+    def connect(self):
+        pass
+
+    def authenticate(self, *args, **kwargs):
+        pass
+
+    def add_event_listener(self, listener, *events):
+        pass
+
+    def close(self):
+        pass
+
+@transaction.commit_on_success
+def seed_database(snapshot, subscribers = SUBSCRIBERS, seed = SEED):
+    """
+    Add a router for every relay in C{snapshot}, and C{subscribers}
+    confirmed subscribers to randomly chosen routers. Each subscriber gets
+    every kind of subscription with a probability of one half, and a node
+    down subscription if it got none.
+
+    @type snapshot: L{ctlutil.ConsensusSnapshot}
+    @param snapshot: The documents of the first consensus.
+    @type subscribers: int
+    @param subscribers: The number of subscribers to add.
+    @type seed: int
+    @param seed: The seed of the random choices.
+    @rtype: int
+    @return: The number of subscriptions added.
+    """
+
+    rand = random.Random(seed)
+    routers = []
+    for fingerprint in snapshot.descriptor_order:
+        router = Router(fingerprint = fingerprint, welcomed = True,
+                        name = snapshot.get_descriptor(fingerprint).nickname)
+        router.save()
+        routers.append(router)
+    if not routers:
+        return 0
+
+    subscriptions = 0
+    for number in range(subscribers):
+        subscriber = Subscriber(email = 'subscriber%d@example.com' % number,
+                                router = rand.choice(routers),
+                                confirmed = True)
+        subscriber.save()
+
+        subs = []
+        if rand.random() < 0.5:
+            subs.append(VersionSub(subscriber = subscriber,
+                                   notify_type = 'OBSOLETE'))
+        if rand.random() < 0.5:
+            subs.append(BandwidthSub(subscriber = subscriber,
+                                     threshold = rand.choice([20, 50, 100])))
+        if rand.random() < 0.5:
+            subs.append(TShirtSub(subscriber = subscriber))
+        if rand.random() < 0.5 or not subs:
+            subs.append(NodeDownSub(subscriber = subscriber,
+                                    grace_pd = rand.choice([1, 2, 6, 24])))
+        for sub in subs:
+            sub.save()
+        subscriptions += len(subs)
+    return subscriptions
+
+@transaction.commit_on_success
+def load_subscribers(path):
+    """
+    Insert the subscribers and subscriptions in the subscriber file C{path}
+    into the database, with batched statements. Routers that aren't in the
+    database yet are added as running routers named C{'Unnamed'}; the next
+    update cycle fills in the rest.
+
+    @type path: str
+    @param path: The subscriber file.
+    @rtype: tuple (int, int)
+    @return: The number of subscribers and of subscriptions inserted.
+    @raise ValueError: If C{path} isn't a subscriber file.
+    """
+
+    routers = dict(Router.objects.values_list('fingerprint', 'id'))
+    next_ids = {}
+    for model in (Router, Subscriber, Subscription):
+        next_ids[model] = (model.objects.aggregate(
+                           highest = Max('pk'))['highest'] or 0) + 1
+    loaded = [0, 0]
+
+    subscriber_file = open(path, 'rb')
+    try:
+        reader = csv.reader(subscriber_file)
+        if reader.next() != SUBSCRIBER_COLUMNS:
+            raise ValueError('%s is not a subscriber file' % path)
+        while True:
+            lines = list(itertools.islice(reader, _LOAD_BATCH_SIZE))
+            if not lines:
+                break
+            _load_lines(lines, routers, next_ids, loaded)
+    finally:
+        subscriber_file.close()
+
+    transaction.set_dirty()
+    return tuple(loaded)
+
+def _load_lines(lines, routers, next_ids, loaded):
+    """Insert the subscribers of the subscriber file lines C{lines}, see
+    L{load_subscribers}. C{routers} maps the fingerprints of the routers in
+    the database to their ids, C{next_ids} holds the next free id of each
+    table and C{loaded} the subscriber and subscription counts, all of which
+    are updated."""
+
+    now = datetime.now()
+    rows = dict([(model, []) for model in _LOAD_FIELDS])
+
+    def next_id(model):
+        next_ids[model] += 1
+        return next_ids[model] - 1
+
+    for email, fingerprint, digest, grace_pd, notify_type, threshold, \
+            tshirt in lines:
+        if fingerprint not in routers:
+            routers[fingerprint] = next_id(Router)
+            rows[Router].append((routers[fingerprint], fingerprint,
+                                 'Unnamed', True, now, True, False))
+
+        subscriber_id = next_id(Subscriber)
+        rows[Subscriber].append((subscriber_id, email, routers[fingerprint],
+                                 True, get_rand_string(), get_rand_string(),
+                                 get_rand_string(), now, digest == '1'))
+        loaded[0] += 1
+
+        for sub_class, values in (
+                (NodeDownSub, grace_pd and (False, int(grace_pd), now, None)),
+                (VersionSub, notify_type and (notify_type,)),
+                (BandwidthSub, threshold and (int(threshold),)),
+                (TShirtSub, tshirt == '1' and (False, 0, now))):
+            if values:
+                sub_id = next_id(Subscription)
+                rows[Subscription].append((sub_id, subscriber_id, False))
+                rows[sub_class].append((sub_id,) + values)
+                loaded[1] += 1
+
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    for model in (Router, Subscriber, Subscription, NodeDownSub, VersionSub,
+                  BandwidthSub, TShirtSub):
+        if not rows[model]:
+            continue
+        fields = [model._meta.get_field(name) for name in _LOAD_FIELDS[model]]
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+              qn(model._meta.db_table),
+              ', '.join([qn(field.column) for field in fields]),
+              ', '.join(['%s'] * len(fields)))
+        cursor.executemany(sql, [[field.get_db_prep_save(value,
+                                      connection = connection)
+                                  for field, value in zip(fields, row)]
+                                 for row in rows[model]])
+
+def run_benchmark(directory, subscribers = SUBSCRIBERS, seed = SEED):
+    """
+    Replay the consensuses in the replay directory C{directory} against a
+    new database holding the subscribers of its subscriber file, or seeded
+    by L{seed_database} if it has none. The database and the files the
+    updater writes are kept in a scratch directory that is removed
+    afterwards, so the real ones aren't touched, and the queued emails are
+    never sent.
+
+    @type directory: str
+    @param directory: The replay directory.
+    @type subscribers: int
+    @param subscribers: The number of subscribers to seed if there is no
+        subscriber file.
+    @type seed: int
+    @param seed: The seed of the random choices of L{seed_database}.
+    @rtype: dict
+    @return: The 'seconds', 'queries', 'stem_calls', 'relays', 'emails'
+        and peak resident memory in 'peak_memory_kb' of each of the
+        'cycles' and over all of them, and the settings of the run.
+    """
+
+    controller = ReplayController(directory)
+    scratch_dir = tempfile.mkdtemp(prefix = 'weather-replay-')
+    saved_files = [(module, name, getattr(module, name))
+                   for module, name, filename in _SCRATCH_FILES]
+    settings_dict = connection.settings_dict
+    old_test_name = settings_dict.get('TEST_NAME')
+    old_name = settings_dict['NAME']
+
+    saved_contacts = CtlUtil._contacts
+    saved_mailer_is_running = mailqueue.mailer_is_running
+
+    for module, name, filename in _SCRATCH_FILES:
+        setattr(module, name, os.path.join(scratch_dir, filename))
+    CtlUtil._contacts = ContactCache(filename = ctlutil.contact_cache_file)
+    #The queued emails go away with the scratch database; never send them
+    mailqueue.mailer_is_running = lambda: True
+    settings_dict['TEST_NAME'] = os.path.join(scratch_dir, 'WeatherDB')
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    updaters._previous_state = None
+    updaters._cycles_since_full = 0
+
+    try:
+        controller.advance()
+        ctl_util = CtlUtil(controller = controller)
+        subscriber_file = os.path.join(directory, SUBSCRIBER_FILE)
+        if os.path.isfile(subscriber_file):
+            subscribers, seeded = load_subscribers(subscriber_file)
+            seed = None
+        else:
+            seeded = seed_database(ctl_util.refresh_snapshot(), subscribers,
+                                   seed)
+
+        cycles = []
+        while True:
+            data = updaters.run_all(ctl_util)
+            cycle = {'consensus': controller.consensus_name(),
+                     'peak_memory_kb': _peak_memory(),
+                     'phases': data['phases']}
+            for counter in ('seconds', 'queries', 'stem_calls', 'relays',
+                            'emails'):
+                cycle[counter] = data[counter]
+            cycles.append(cycle)
+            if not controller.advance():
+                break
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        settings_dict['TEST_NAME'] = old_test_name
+        for module, name, value in saved_files:
+            setattr(module, name, value)
+        CtlUtil._contacts = saved_contacts
+        mailqueue.mailer_is_running = saved_mailer_is_running
+        updaters._previous_state = None
+        updaters._cycles_since_full = 0
+        shutil.rmtree(scratch_dir, ignore_errors = True)
+
+    results = {'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'replay_directory': os.path.abspath(directory),
+               'subscribers': subscribers,
+               'subscriptions': seeded,
+               'seed': seed,
+               'checker_workers': config.checker_workers,
+               'cycles': cycles,
+               'peak_memory_kb': max([cycle['peak_memory_kb']
+                                      for cycle in cycles])}
+    for counter in ('seconds', 'queries', 'stem_calls', 'relays', 'emails'):
+        results[counter] = sum([cycle[counter] for cycle in cycles])
+    return results
+
+def _peak_memory():
+    """Get the most memory the process has held so far, in kilobytes."""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
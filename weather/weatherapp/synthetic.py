@@ -0,0 +1,299 @@
+"""
+This module generates synthetic Tor networks and subscriber bases of any
+size, to see how the updater scales with them. L{generate} writes a replay
+directory (see L{replay}) holding a series of consensuses and a subscriber
+file. Between consensuses a share of the relays churn: they go down or come
+back, their bandwidth changes or they switch tor versions, and a few new
+relays join. The replay directory can be run by the benchmark, and its
+subscriber file loaded into the database with L{replay.load_subscribers}.
+
+The documents hold the fields the updater reads, in the format tor writes
+them, but no keys or signatures.
+
+@var MIX: The default probabilities of a subscriber having a node down,
+    version, bandwidth and T-shirt subscription. Subscribers who get none
+    get a node down subscription.
+@var CHURN: The default share of the relays that change between two
+    consensuses.
+@var RECOMMENDED_VERSIONS: The tor versions the consensuses recommend.
+@var OLD_VERSIONS: The tor versions some relays run that aren't recommended.
+"""
+
+import base64
+import csv
+from datetime import datetime, timedelta
+import hashlib
+import os
+import random
+
+from weatherapp import replay
+
+MIX = (0.8, 0.3, 0.3, 0.1)
+CHURN = 0.05
+
+RECOMMENDED_VERSIONS = ['0.2.3.25', '0.2.4.17-rc']
+OLD_VERSIONS = ['0.2.2.39', '0.2.3.24-rc']
+
+#The valid-after time of the first consensus
+_START = datetime(2013, 8, 1)
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_CONSENSUS_HEADER = """network-status-version 3
+vote-status consensus
+consensus-method 13
+valid-after %(valid_after)s
+fresh-until %(fresh_until)s
+valid-until %(valid_until)s
+voting-delay 300 300
+client-versions %(versions)s
+server-versions %(versions)s
+known-flags Exit Fast Guard Running Stable Valid
+"""
+
+_STATUS_ENTRY = """r %(nickname)s %(identity)s %(digest)s %(published)s \
+%(address)s 9001 0
+s %(flags)s
+v Tor %(version)s
+w Bandwidth=%(bandwidth)d
+p %(ports)s
+"""
+
+_DESCRIPTOR = """@downloaded-at %(published)s
+router %(nickname)s %(address)s 9001 0 0
+platform Tor %(version)s on Linux
+published %(published)s
+fingerprint %(spaced_fingerprint)s
+uptime %(uptime)d
+bandwidth %(rate)d %(burst)d %(observed)d
+contact %(contact)s
+%(policy)s
+router-signature
+-----BEGIN SIGNATURE-----
+%(signature)s
+-----END SIGNATURE-----
+"""
+
+class _Relay:
+    """A synthetic relay, with the attributes that end up in its router
+    status entry and server descriptor. Bandwidths are in bytes per second.
+
+    @type joined: int
+    @ivar joined: The number of the consensus the relay first appeared in.
+    @type up: bool
+    @ivar up: Whether the relay is listed in the consensus.
+    """
+
+    def __init__(self, number, rand, joined):
+        self.joined = joined
+        self.fingerprint = hashlib.sha1('relay %d' % number).hexdigest(
+                           ).upper()
+        self.nickname = 'synthetic%d' % number
+        self.address = '10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255,
+                                        number & 255)
+        #Relay bandwidths are heavy-tailed: most are small, a few are huge
+        self.bandwidth = int(min(rand.paretovariate(1.2) * 20, 100000)) * 1000
+        self.version = rand.random() < 0.8 and \
+                       rand.choice(RECOMMENDED_VERSIONS) or \
+                       rand.choice(OLD_VERSIONS)
+        self.up = rand.random() < 0.95
+        self.exit = rand.random() < 0.15
+        self.stable = rand.random() < 0.7
+        if rand.random() < 0.8:
+            self.contact = 'operator%d@example.com' % number
+        else:
+            self.contact = 'operator%d at example dot com' % number
+
+    def churn(self, rand):
+        """Change the relay: it goes down or comes back, its bandwidth
+        changes, or it switches tor versions."""
+
+        event = rand.random()
+        if event < 0.5:
+            self.up = not self.up
+        elif event < 0.8:
+            self.bandwidth = max(1000, int(self.bandwidth *
+                                           rand.uniform(0.5, 1.5)))
+        elif self.version in OLD_VERSIONS:
+            self.version = rand.choice(RECOMMENDED_VERSIONS)
+        else:
+            self.version = rand.choice(OLD_VERSIONS)
+
+    def status_entry(self, published):
+        """Get the router status entry of the relay."""
+
+        flags = ['Fast', 'Running', 'Valid']
+        if self.exit:
+            flags.append('Exit')
+        if self.stable:
+            flags.extend(['Guard', 'Stable'])
+        return _STATUS_ENTRY % {
+            'nickname': self.nickname,
+            'identity': _base64(self.fingerprint.decode('hex')),
+            'digest': _base64(hashlib.sha1(self.fingerprint +
+                                           self.version).digest()),
+            'published': published,
+            'address': self.address,
+            'flags': ' '.join(sorted(flags)),
+            'version': self.version,
+            'bandwidth': self.bandwidth / 1000,
+            'ports': self.exit and 'accept 80,443' or 'reject 1-65535'}
+
+    def descriptor(self, published, uptime):
+        """Get the server descriptor of the relay."""
+
+        return _DESCRIPTOR % {
+            'nickname': self.nickname,
+            'address': self.address,
+            'version': self.version,
+            'published': published,
+            'spaced_fingerprint': ' '.join([self.fingerprint[i:i + 4] for i
+                                            in range(0, 40, 4)]),
+            'uptime': uptime,
+            'rate': self.bandwidth * 2,
+            'burst': self.bandwidth * 4,
+            'observed': self.bandwidth,
+            'contact': self.contact,
+            'policy': self.exit and 'accept *:80\naccept *:443\nreject *:*'
+                      or 'reject *:*',
+            'signature': _base64(self.fingerprint * 2)}
+
+def _base64(data):
+    """Encode C{data} the way tor does in its documents, without padding."""
+
+    return base64.b64encode(data).rstrip('=')
+
+def generate(directory, relays, subscribers, consensuses = 24,
+             mix = MIX, churn = CHURN, seed = 0):
+    """
+    Write a synthetic network and subscriber base to the replay directory
+    C{directory}, which is created if necessary.
+
+    @type directory: str
+    @param directory: The replay directory.
+    @type relays: int
+    @param relays: The number of relays at the first consensus, of which
+        about 95% are running.
+    @type subscribers: int
+    @param subscribers: The number of subscribers.
+    @type consensuses: int
+    @param consensuses: The number of consensuses, one hour apart.
+    @type mix: tuple (float, float, float, float)
+    @param mix: The probabilities of a subscriber having a node down,
+        version, bandwidth and T-shirt subscription.
+    @type churn: float
+    @param churn: The share of the relays that change between two
+        consensuses. A tenth of that share joins as new relays.
+    @type seed: int
+    @param seed: The seed of all random choices, the same seed and sizes
+        give the same files.
+    @rtype: tuple (int, int)
+    @return: The number of relays generated, including the ones that
+        joined later, and the number of subscriptions.
+    """
+
+    rand = random.Random(seed)
+    network = [_Relay(number, rand, 0) for number in range(relays)]
+    initial = [relay.fingerprint for relay in network]
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for consensus in range(consensuses):
+        if consensus > 0:
+            for relay in rand.sample(network, int(round(len(network) *
+                                                        churn))):
+                relay.churn(rand)
+            for number in range(int(round(relays * churn / 10))):
+                network.append(_Relay(len(network), rand, consensus))
+        _write_consensus(os.path.join(directory, '%04d' % consensus),
+                         network, consensus)
+
+    subscriptions = write_subscribers(os.path.join(directory,
+                                                   replay.SUBSCRIBER_FILE),
+                                      initial, subscribers, mix, rand)
+    return len(network), subscriptions
+
+def _write_consensus(consensus_dir, network, consensus):
+    """Write the consensus number C{consensus} of the relays in C{network},
+    and the descriptors of all of them."""
+
+    valid_after = _START + timedelta(hours = consensus)
+    published = (valid_after - timedelta(minutes = 30)).strftime(_TIME_FORMAT)
+    if not os.path.isdir(consensus_dir):
+        os.makedirs(consensus_dir)
+
+    document = open(os.path.join(consensus_dir, replay.CONSENSUS_FILE), 'w')
+    try:
+        document.write(_CONSENSUS_HEADER % {
+            'valid_after': valid_after.strftime(_TIME_FORMAT),
+            'fresh_until': (valid_after +
+                            timedelta(hours = 1)).strftime(_TIME_FORMAT),
+            'valid_until': (valid_after +
+                            timedelta(hours = 3)).strftime(_TIME_FORMAT),
+            'versions': ','.join(RECOMMENDED_VERSIONS)})
+        #Tor orders the entries by identity
+        for relay in sorted(network, key = lambda relay: relay.fingerprint):
+            if relay.up:
+                document.write(relay.status_entry(published))
+        document.write('directory-footer\n')
+    finally:
+        document.close()
+
+    descriptors = open(os.path.join(consensus_dir,
+                                    replay.DESCRIPTOR_FILES[0]), 'w')
+    try:
+        for relay in network:
+            descriptors.write(relay.descriptor(published,
+                              (consensus - relay.joined) * 3600 + 1800))
+    finally:
+        descriptors.close()
+
+def write_subscribers(path, fingerprints, subscribers, mix = MIX,
+                      rand = None):
+    """
+    Write a subscriber file with C{subscribers} subscribers to randomly
+    chosen routers. One in ten subscribers reuses the address of an earlier
+    one, like operators of several relays do.
+
+    @type path: str
+    @param path: The file to write.
+    @type fingerprints: list [str]
+    @param fingerprints: The fingerprints of the routers to subscribe to.
+    @type subscribers: int
+    @param subscribers: The number of subscribers.
+    @type mix: tuple (float, float, float, float)
+    @param mix: The probabilities of a subscriber having a node down,
+        version, bandwidth and T-shirt subscription.
+    @type rand: random.Random
+    @param rand: The source of the random choices.
+    @rtype: int
+    @return: The number of subscriptions written.
+    """
+
+    rand = rand or random.Random()
+    node_down, version, bandwidth, tshirt = mix
+    subscriptions = 0
+
+    subscriber_file = open(path, 'wb')
+    try:
+        writer = csv.writer(subscriber_file, lineterminator = '\n')
+        writer.writerow(replay.SUBSCRIBER_COLUMNS)
+        for number in range(subscribers):
+            if number and rand.random() < 0.1:
+                number = rand.randrange(number)
+            row = ['subscriber%d@example.com' % number,
+                   rand.choice(fingerprints),
+                   rand.random() < 0.9 and '1' or '0', '', '', '', '']
+            if rand.random() < version:
+                row[4] = 'OBSOLETE'
+            if rand.random() < bandwidth:
+                row[5] = rand.choice([20, 50, 100])
+            if rand.random() < tshirt:
+                row[6] = '1'
+            if rand.random() < node_down or row[4:] == ['', '', '']:
+                row[3] = rand.choice([1, 2, 6, 24])
+            subscriptions += 4 - row[3:].count('')
+            writer.writerow(row)
+    finally:
+        subscriber_file.close()
+    return subscriptions
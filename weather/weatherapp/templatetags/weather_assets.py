@@ -0,0 +1,25 @@
+"""Template tags for including the bundles built by L{assets}, used as
+{% load weather_assets %} ... {% asset_tags "form.js" %}"""
+
+from weatherapp import assets
+
+from django import template
+
+register = template.Library()
+
+_SCRIPT_TAG = '<script type="text/javascript" src="%s"></script>'
+_STYLE_TAG = '<link rel="stylesheet" type="text/css" href="%s">'
+
+def asset_tags(name):
+    """Get the HTML tags including the bundle C{name}.
+
+    @type name: str
+    @param name: The name of the bundle, a key of L{assets.BUNDLES}.
+    @rtype: str
+    @return: A script or stylesheet tag for each URL to include.
+    """
+
+    tag = name.endswith('.js') and _SCRIPT_TAG or _STYLE_TAG
+    return '\n'.join([tag % url for url in assets.bundle_urls(name)])
+
+register.simple_tag(asset_tags)
@@ -2,17 +2,35 @@
 The test module. To run tests, cd to weather and run 'python manage.py
 test weatherapp'.
 """
+import base64
+import os
+import shutil
+import tempfile
 import time
 from datetime import datetime, timedelta
 
 from models import Subscriber, Subscription, Router, NodeDownSub, TShirtSub, \
-                   VersionSub, BandwidthSub
+                   VersionSub, BandwidthSub, DeployedDatetime, QueuedEmail, \
+                   SubscribeForm, insert_fingerprint_spaces
+import assets
+import database
 import emails
-from ctlutil import CtlUtil
+import history
+import mailqueue
+import metrics
+import relayindex
+import replay
+import synthetic
+import updaters
+import views
+from ctlutil import CtlUtil, ConsensusSnapshot, ContactCache, \
+                    VersionClassifier
 
-from django.test import TestCase
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 from django.core import mail
+from django.core.cache import cache
 
 class TestWeb(TestCase):
     """Tests the Tor Weather application via post requests"""
@@ -48,10 +66,7 @@ class TestWeb(TestCase):
         self.assertEqual(subscriber.confirmed, False)
         
         #Test that one message has been sent
-        for i in range(0, 100, 1):
-            if len(mail.outbox) == 1:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
 
         self.assertEqual(len(mail.outbox), 1)
 
@@ -72,10 +87,7 @@ class TestWeb(TestCase):
                 self.assertEqual(subscriber.confirmed, True)
 
         #verify that the "confirmation successful" email was sent
-        for i in range(0, 500, 1):
-            if len(mail.outbox) == 2:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(mail.outbox[1].subject, 
                 '[Tor Weather] Confirmation Successful')
@@ -121,10 +133,7 @@ class TestWeb(TestCase):
         self.assertEqual(version_sub.notify_type, 'OBSOLETE')
 
         #Test that one message has been sent
-        for i in range(0, 100, 1):
-            if len(mail.outbox) == 1:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 1)
 
         #Verify that the subject of the message is correct.
@@ -143,10 +152,7 @@ class TestWeb(TestCase):
                 self.assertEqual(subscriber.confirmed, True)
 
         #verify that the "confirmation successful" email was sent
-        for i in range(0, 500, 1):
-            if len(mail.outbox) == 2:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(mail.outbox[1].subject, 
                 '[Tor Weather] Confirmation Successful')
@@ -180,10 +186,7 @@ class TestWeb(TestCase):
         self.assertEqual(bandwidth_sub.threshold, 40)
         
         #Test that one message has been sent
-        for i in range(0, 100, 1):
-            if len(mail.outbox) == 1:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 1)
         
         #Verify that the subject of the message is correct.
@@ -202,10 +205,7 @@ class TestWeb(TestCase):
                 self.assertEqual(subscriber.confirmed, True)
 
         #verify that the "confirmation successful" email was sent
-        for i in range(0, 500, 1):
-            if len(mail.outbox) == 2:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(mail.outbox[1].subject, 
                 '[Tor Weather] Confirmation Successful')
@@ -244,10 +244,7 @@ class TestWeb(TestCase):
         self.assertEqual(shirt_sub.avg_bandwidth, 0)       
 
         #Test that one message has been sent
-        for i in range(0, 100, 1):
-            if len(mail.outbox) == 1:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 1)
 
         #Verify that the subject of the message is correct.
@@ -268,10 +265,7 @@ class TestWeb(TestCase):
                 self.assertEqual(subscriber.confirmed, True)
 
         #verify that the "confirmation successful" email was sent
-        for i in range(0, 500, 1):
-            if len(mail.outbox) == 2:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(mail.outbox[1].subject, 
                 '[Tor Weather] Confirmation Successful')
@@ -323,10 +317,7 @@ class TestWeb(TestCase):
         self.assertEqual(tshirt.emailed, False)
 
         #Test that one message has been sent
-        for i in range(0, 100, 1):
-            if len(mail.outbox) == 1:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 1)
 
         #Verify that the subject of the message is correct.
@@ -347,10 +338,7 @@ class TestWeb(TestCase):
                 self.assertEqual(subscriber.confirmed, True)
 
         #verify that the "confirmation successful" email was sent
-        for i in range(0, 500, 1):
-            if len(mail.outbox) == 2:
-                break
-            time.sleep(0.1)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(mail.outbox[1].subject, 
                 '[Tor Weather] Confirmation Successful')
@@ -375,9 +363,118 @@ class TestWeb(TestCase):
         self.assertEqual(response.template[0].name, 'subscribe.html')
 
         #Test that no messages have been sent
-        time.sleep(3)
+        mailqueue.drain()
         self.assertEqual(len(mail.outbox), 0)
     
+class TestPageCache(TestCase):
+    """Test the caching headers and conditional GETs of the static pages"""
+
+    def test_conditional_get(self):
+        """Cached pages carry validators, and a request repeating them gets
+        a 304 Not Modified."""
+        client = Client()
+        response = client.get('/notification_info/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('max-age=3600' in response['Cache-Control'])
+
+        response = client.get('/notification_info/',
+                              HTTP_IF_NONE_MATCH = response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        response = client.get('/notification_info/',
+                              HTTP_IF_MODIFIED_SINCE =
+                                  response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        #Also when the page is rendered again after the cache was emptied
+        cache.clear()
+        response = client.get('/', HTTP_IF_NONE_MATCH = '"none"')
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/', HTTP_IF_NONE_MATCH = response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_rebuilt_assets(self):
+        """Pages cached before the bundles were built aren't served
+        afterwards, not even the 404 page."""
+        client = Client()
+        response = client.get('/notification_info/')
+        self.assertFalse('/media/build/' in response.content)
+        response = client.get('/no_such_page/')
+        self.assertFalse('/media/build/' in response.content)
+
+        build_dir = tempfile.mkdtemp()
+        saved = (views.assets.build_dir, views.assets.manifest_file)
+        views.assets.build_dir = build_dir
+        views.assets.manifest_file = os.path.join(build_dir, 'manifest.json')
+        try:
+            built = views.assets.build_all()['base.css'][0]
+            response = client.get('/notification_info/')
+            self.assertTrue('/media/build/' + built in response.content)
+            response = client.get('/no_such_page/')
+            self.assertTrue('/media/build/' + built in response.content)
+        finally:
+            views.assets.build_dir, views.assets.manifest_file = saved
+            shutil.rmtree(build_dir)
+        response = client.get('/notification_info/')
+        self.assertFalse('/media/build/' in response.content)
+        response = client.get('/no_such_page/')
+        self.assertFalse('/media/build/' in response.content)
+
+    def test_not_found(self):
+        """Unknown pages get the 404 page."""
+        response = Client().get('/no_such_page/')
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue('404: Page Not Found' in response.content)
+
+class TestAssets(TestCase):
+    """Test building the JavaScript and CSS bundles in L{assets}"""
+
+    def test_minify(self):
+        """Whole-line comments and whitespace go, the rest of each line
+        stays as it is, whatever literals it holds."""
+        script = ("/*! license */\n// comment\nvar a = 'x  // y';  \n\n"
+                  "\tvar b = s.match(/a  \\/ b/g) /* note */ / 2\n"
+                  "  /* block\n   comment */  return /a  b/.test(c)\n"
+                  "if (d) /x  y/.exec(e)\n"
+                  "    f = typeof /z  // w/ + '/*'\n"
+                  "// kept, the line above may have opened a comment\n"
+                  "*/ g = 'h  \\\n    i'\n")
+        self.assertEqual(assets.minify_js(script),
+                         "/*! license */\nvar a = 'x  // y';\n"
+                         "var b = s.match(/a  \\/ b/g) /* note */ / 2\n"
+                         "return /a  b/.test(c)\n"
+                         "if (d) /x  y/.exec(e)\n"
+                         "f = typeof /z  // w/ + '/*'\n"
+                         "// kept, the line above may have opened a comment\n"
+                         "*/ g = 'h  \\\n    i'\n")
+        self.assertEqual(assets.minify_css('/* c */ a :hover ,b {\n'
+                                           '  color : red;\n}\n'),
+                         'a :hover,b{color:red}\n')
+
+    def test_build(self):
+        """Pages include the source files until the bundles are built, and
+        the hashed bundles afterwards."""
+        self.assertEqual(assets.bundle_urls('subscribe.css'),
+                         ['/media/autocomplete.css'])
+        build_dir = tempfile.mkdtemp()
+        saved = (assets.build_dir, assets.manifest_file)
+        assets.build_dir = build_dir
+        assets.manifest_file = os.path.join(build_dir, 'manifest.json')
+        try:
+            results = assets.build_all()
+            built = results['form.js'][0]
+            self.assertTrue(os.path.exists(os.path.join(build_dir,
+                                                        built + '.gz')))
+            self.assertEqual(assets.bundle_urls('form.js'),
+                             ['/media/build/' + built])
+            self.assertEqual(assets.build_all()['form.js'][0], built)
+        finally:
+            assets.build_dir, assets.manifest_file = saved
+            for name in os.listdir(build_dir):
+                os.remove(os.path.join(build_dir, name))
+            os.rmdir(build_dir)
+
 class TestNotifications(TestCase):
     """Test the notification side of Tor Weather"""
 
@@ -455,3 +552,1241 @@ class TestNotifications(TestCase):
 
                                
                                    
+
+class TestConsensusSnapshot(TestCase):
+    """Test the fingerprint index of L{ConsensusSnapshot}"""
+
+    class _Entry:
+        """Stand-in for a stem router status entry or server descriptor"""
+
+        def __init__(self, fingerprint, nickname = 'Unnamed'):
+            self.fingerprint = fingerprint
+            self.nickname = nickname
+
+    def test_index(self):
+        """Entries are found by fingerprint, missing ones give None and
+        descriptors without a fingerprint are skipped."""
+        statuses = [self._Entry('1234'), self._Entry('5678')]
+        descriptors = [self._Entry('1234', 'abc'), self._Entry(None),
+                       self._Entry('5678', 'def'), self._Entry('1234', 'ghi')]
+        snapshot = ConsensusSnapshot(statuses, descriptors, ['0.2.4.21'])
+
+        self.assertEqual(snapshot.get_status('1234').fingerprint, '1234')
+        self.assertEqual(snapshot.get_status('9999'), None)
+        self.assertEqual(snapshot.get_descriptor('1234').nickname, 'ghi')
+        self.assertEqual(snapshot.get_descriptor('9999'), None)
+        self.assertEqual(snapshot.descriptor_order, ['1234', '5678'])
+        self.assertEqual(snapshot.rec_versions, ['0.2.4.21'])
+
+    def test_versions(self):
+        """Versions are classified against the recommended list once and
+        newer dev versions count as recommended."""
+        classifier = VersionClassifier(['0.2.3.25', '0.2.4.21'])
+        self.assertEqual(classifier.classify('0.2.4.21'), 'RECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.4.20'), 'OBSOLETE')
+        self.assertEqual(classifier.classify('0.2.5.1-alpha-dev'),
+                         'RECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.3.25-dev'), 'RECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.2.1-dev'), 'OBSOLETE')
+        self.assertEqual(classifier.verdicts['0.2.4.20'], 'OBSOLETE')
+
+        self.assertEqual(VersionClassifier(['']).classify('0.2.2.1'),
+                         'RECOMMENDED')
+
+class TestContactCache(TestCase):
+    """Test parsing and caching contact lines in L{ContactCache}"""
+
+    def test_parse(self):
+        """Obscured addresses are parsed and unparsable lines give the
+        empty string."""
+        contacts = ContactCache()
+        self.assertEqual(contacts.get_email('Op <op@place.com>'),
+                         'op@place.com')
+        self.assertEqual(contacts.get_email('op AT place DOT com'),
+                         'op@place.com')
+        self.assertEqual(contacts.get_email('nothing here'), '')
+        self.assertEqual(contacts.get_email(None), '')
+
+    def test_cache(self):
+        """The least recently used line is evicted, and each unparsable line
+        is appended to the report only once."""
+        contacts = ContactCache(max_size = 2)
+        contacts.get_email('a@place.com')
+        contacts.get_email('nothing here')
+        contacts.get_email('a@place.com')
+        contacts.get_email('nothing here')
+        contacts.get_email('b@place.com')
+        self.assertEqual(contacts.cache.keys(), ['nothing here',
+                                                 'b@place.com'])
+
+        handle, filename = tempfile.mkstemp()
+        os.write(handle, 'earlier\n')
+        os.close(handle)
+        try:
+            self.assertEqual(contacts.report_unparsable(filename), 1)
+            self.assertEqual(contacts.report_unparsable(filename), 0)
+            self.assertEqual(open(filename).read(), 'earlier\nnothing here\n')
+        finally:
+            os.remove(filename)
+
+    def test_store(self):
+        """A stored cache is read back by the next one using its file, even
+        if a run in between looked nothing up, and a broken file gives an
+        empty cache."""
+        filename = tempfile.mktemp()
+        try:
+            contacts = ContactCache(filename = filename)
+            contacts.get_email('a@place.com')
+            contacts.get_email('nothing here')
+            self.assertEqual(contacts.store(), 2)
+
+            contacts = ContactCache(max_size = 1, filename = filename)
+            self.assertEqual(contacts.get_email('b@place.com'), 'b@place.com')
+            self.assertEqual(contacts.cache.keys(), ['b@place.com'])
+            contacts = ContactCache(filename = filename)
+            contacts.get_email('nothing here')
+            self.assertEqual(contacts.cache.keys(), ['a@place.com',
+                                                     'nothing here'])
+            #Lines parsed before the restart aren't reported again
+            self.assertEqual(contacts.unparsable, [])
+
+            #A run without lookups stores what the previous run stored
+            self.assertEqual(ContactCache(filename = filename).store(), 2)
+            contacts = ContactCache(filename = filename)
+            contacts.get_email('a@place.com')
+            self.assertEqual(contacts.cache.keys(), ['nothing here',
+                                                     'a@place.com'])
+
+            open(filename, 'wb').write('broken')
+            contacts = ContactCache(filename = filename)
+            contacts.get_email('b@place.com')
+            self.assertEqual(contacts.cache.keys(), ['b@place.com'])
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class StubCtlUtil:
+    """Answers the L{CtlUtil} queries used by L{updaters} from a dictionary
+    of relay attributes instead of a tor control connection."""
+
+    def __init__(self, relays):
+        """
+        @type relays: dict {str: dict}
+        @param relays: Maps fingerprints to dictionaries with the keys
+            'name', 'up', 'exit', 'stable', 'email' and 'bandwidth'.
+        """
+        self.relays = relays
+
+    def get_finger_name_list(self):
+        return [(finger, relay['name']) for finger, relay in
+                sorted(self.relays.items())]
+
+    def is_up_or_hibernating(self, fingerprint):
+        return self.relays[fingerprint]['up']
+
+    def is_exit(self, fingerprint):
+        return self.relays[fingerprint]['exit']
+
+    def is_stable(self, fingerprint):
+        return self.relays[fingerprint]['stable']
+
+    def get_email(self, fingerprint):
+        return self.relays[fingerprint]['email']
+
+    def get_bandwidth(self, fingerprint):
+        return self.relays[fingerprint]['bandwidth']
+
+    def get_version_type(self, fingerprint):
+        return self.relays[fingerprint]['version_type']
+
+def _stub_relay(name, up = True, exit = False, stable = True,
+                email = 'op@place.com', bandwidth = 100,
+                version_type = 'RECOMMENDED'):
+    """Returns a relay attribute dictionary for L{StubCtlUtil}"""
+    return {'name': name, 'up': up, 'exit': exit, 'stable': stable,
+            'email': email, 'bandwidth': bandwidth,
+            'version_type': version_type}
+
+class TestRouterSync(TestCase):
+    """Test the set-based router table update in L{updaters}"""
+
+    def setUp(self):
+        """Store a router that is still running, one that went away and one
+        that hasn't been seen for more than a year."""
+        Router(fingerprint = 'AAAA', name = 'old', welcomed = True).save()
+        Router(fingerprint = 'BBBB', name = 'gone', welcomed = True).save()
+        Router(fingerprint = 'CCCC', name = 'ancient', welcomed = True,
+               last_seen = datetime.now() - timedelta(days = 400)).save()
+        DeployedDatetime(deployed = datetime.now() - timedelta(days = 3)).save()
+
+    def test_update_all_routers(self):
+        """Routers are inserted, updated, marked down and expired, and new
+        stable routers are welcomed."""
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('renamed', exit = True),
+                                'DDDD': _stub_relay('new'),
+                                'EEEE': _stub_relay('unstable',
+                                                    stable = False),
+                                'FFFF': _stub_relay('down', up = False)})
+
+        email_list = updaters.update_all_routers(ctl_util, [])
+
+        old = Router.objects.get(fingerprint = 'AAAA')
+        self.assertEqual(old.name, 'renamed')
+        self.assertEqual(old.up, True)
+        self.assertEqual(old.exit, True)
+        self.assertEqual(Router.objects.get(fingerprint = 'BBBB').up, False)
+        self.assertEqual(Router.objects.filter(fingerprint = 'CCCC').count(), 0)
+        self.assertEqual(Router.objects.filter(fingerprint = 'FFFF').count(), 0)
+
+        new = Router.objects.get(fingerprint = 'DDDD')
+        self.assertEqual(new.welcomed, True)
+        self.assertEqual(Router.objects.get(fingerprint = 'EEEE').welcomed,
+                         False)
+
+        self.assertEqual(len(email_list), 1)
+        self.assertEqual(email_list[0][3], ['op@place.com'])
+
+class TestCheckers(TestCase):
+    """Test the subscription checkers in L{updaters}"""
+
+    def setUp(self):
+        """Create a down router watched by a confirmed and an unconfirmed
+        subscriber."""
+        self.router = Router(fingerprint = 'AAAA', name = 'down', up = False)
+        self.router.save()
+        self.confirmed = Subscriber(email = 'yes@place.com',
+                                    router = self.router, confirmed = True)
+        self.confirmed.save()
+        self.unconfirmed = Subscriber(email = 'no@place.com',
+                                      router = self.router)
+        self.unconfirmed.save()
+
+    def test_node_down(self):
+        """Only confirmed subscribers are emailed, once the grace period has
+        passed, and only once."""
+        then = datetime.now() - timedelta(hours = 3)
+        for subscriber in (self.confirmed, self.unconfirmed):
+            NodeDownSub(subscriber = subscriber, grace_pd = 2,
+                        triggered = True, last_changed = then).save()
+
+        email_list = updaters.check_node_down([])
+        self.assertEqual(len(email_list), 1)
+        self.assertEqual(email_list[0][3], ['yes@place.com'])
+        sub = NodeDownSub.objects.get(subscriber = self.confirmed)
+        self.assertEqual(sub.emailed, True)
+        self.assertEqual(sub.last_changed, then)
+
+        self.assertEqual(updaters.check_node_down([]), [])
+
+        self.router.up = True
+        self.router.save()
+        self.assertEqual(updaters.check_node_down([]), [])
+        sub = NodeDownSub.objects.get(subscriber = self.confirmed)
+        self.assertEqual(sub.triggered, False)
+        self.assertEqual(sub.emailed, False)
+        self.assertNotEqual(sub.last_changed, then)
+
+    def test_low_bandwidth(self):
+        """Subscribers are emailed when the bandwidth drops below their
+        threshold and may be emailed again after it recovers."""
+        BandwidthSub(subscriber = self.confirmed, threshold = 50).save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', bandwidth = 10)})
+
+        self.assertEqual(len(updaters.check_low_bandwidth(ctl_util, [])), 1)
+        self.assertEqual(updaters.check_low_bandwidth(ctl_util, []), [])
+
+        ctl_util.relays['AAAA']['bandwidth'] = 60
+        self.assertEqual(updaters.check_low_bandwidth(ctl_util, []), [])
+        sub = BandwidthSub.objects.get(subscriber = self.confirmed)
+        self.assertEqual(sub.emailed, False)
+
+    def test_earn_tshirt(self):
+        """Progress is reset when the router goes down and restarts when it
+        comes back, the average is kept while it stays up, and the shirt is
+        announced once."""
+        then = datetime.now() - timedelta(days = 62)
+        for subscriber in (self.confirmed, self.unconfirmed):
+            TShirtSub(subscriber = subscriber, triggered = True,
+                      avg_bandwidth = 600, last_changed = then).save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', bandwidth = 400)})
+
+        self.assertEqual(updaters.check_earn_tshirt(ctl_util, []), [])
+        sub = TShirtSub.objects.get(subscriber = self.confirmed)
+        self.assertEqual((sub.triggered, sub.avg_bandwidth), (False, 0))
+        sub = TShirtSub.objects.get(subscriber = self.unconfirmed)
+        self.assertEqual((sub.triggered, sub.avg_bandwidth), (True, 600))
+
+        self.router.up = True
+        self.router.save()
+        self.assertEqual(updaters.check_earn_tshirt(ctl_util, []), [])
+        sub = TShirtSub.objects.get(subscriber = self.confirmed)
+        self.assertEqual((sub.triggered, sub.avg_bandwidth), (True, 400))
+
+        TShirtSub.objects.filter(pk = sub.pk).update(avg_bandwidth = 600,
+                                                     last_changed = then)
+        email_list = updaters.check_earn_tshirt(ctl_util, [])
+        self.assertEqual(len(email_list), 1)
+        self.assertEqual(email_list[0][3], ['yes@place.com'])
+        sub = TShirtSub.objects.get(subscriber = self.confirmed)
+        self.assertEqual((sub.avg_bandwidth, sub.emailed), (600, True))
+        self.assertEqual(sub.last_changed, then)
+        self.assertEqual(updaters.check_earn_tshirt(ctl_util, []), [])
+
+    def test_tshirt_rules(self):
+        """The checker and L{TShirtSub.should_email} share one rule."""
+        hours = TShirtSub.HOURS_REQUIRED
+        self.assertTrue(TShirtSub.has_earned(hours, 100, True))
+        self.assertFalse(TShirtSub.has_earned(hours, 99, True))
+        self.assertFalse(TShirtSub.has_earned(hours, 499, False))
+        self.assertFalse(TShirtSub.has_earned(hours - 1, 500, False))
+
+        then = datetime.now() - timedelta(days = 62)
+        sub = TShirtSub(subscriber = self.confirmed, triggered = True,
+                        avg_bandwidth = 600, last_changed = then)
+        sub.save()
+        self.router.up = True
+        self.router.save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('up', bandwidth = 600)})
+        saved = TShirtSub.NON_EXIT_BANDWIDTH
+        TShirtSub.NON_EXIT_BANDWIDTH = 700
+        try:
+            self.assertFalse(sub.should_email())
+            self.assertEqual(updaters.check_earn_tshirt(ctl_util, []), [])
+        finally:
+            TShirtSub.NON_EXIT_BANDWIDTH = saved
+        self.assertTrue(sub.should_email())
+        self.assertEqual(len(updaters.check_earn_tshirt(ctl_util, [])), 1)
+
+    def test_changes(self):
+        """After the first cycle only the subscriptions of routers whose
+        state changed, those of changed subscribers and pending node down
+        subscriptions are checked."""
+        node_down = NodeDownSub(subscriber = self.confirmed, grace_pd = 2)
+        node_down.save()
+        bandwidth = BandwidthSub(subscriber = self.confirmed, threshold = 50)
+        bandwidth.save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', up = False)})
+
+        updaters._previous_state = None
+        try:
+            self.assertEqual(updaters.find_changes(ctl_util), None)
+            changes = updaters.find_changes(ctl_util)
+            for sub_class in (NodeDownSub, VersionSub, BandwidthSub):
+                self.assertEqual(changes.sub_pks(sub_class), [])
+
+            version = VersionSub(subscriber = self.confirmed)
+            version.save()
+            self.confirmed.mark_changed()
+            ctl_util.relays['AAAA']['bandwidth'] = 10
+            NodeDownSub.objects.filter(pk = node_down.pk).update(
+                triggered = True)
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(VersionSub), [version.pk])
+            self.assertEqual(changes.sub_pks(BandwidthSub), [bandwidth.pk])
+            self.assertEqual(changes.sub_pks(NodeDownSub), [node_down.pk])
+
+            email_list = updaters.check_all_subs(ctl_util, [],
+                                                 changes = changes)
+            self.assertEqual(len(email_list), 1)
+            self.assertEqual(BandwidthSub.objects.get().emailed, True)
+
+            self.router.up = True
+            self.router.save()
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(NodeDownSub), [node_down.pk])
+            self.assertEqual(changes.sub_pks(BandwidthSub), [])
+        finally:
+            updaters._previous_state = None
+            updaters._cycles_since_full = 0
+
+    def test_failed_checks(self):
+        """Changes that weren't acted on because the checks failed are not
+        lost: the next cycle checks all subscriptions."""
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', up = False)})
+
+        updaters._previous_state = None
+        try:
+            updaters.find_changes(ctl_util)
+            self.assertNotEqual(updaters.find_changes(ctl_util), None)
+            try:
+                with updaters.acting_on_changes():
+                    raise IOError('disk full')
+            except IOError:
+                pass
+            self.assertEqual(updaters.find_changes(ctl_util), None)
+
+            with updaters.acting_on_changes():
+                pass
+            self.assertNotEqual(updaters.find_changes(ctl_util), None)
+        finally:
+            updaters._previous_state = None
+            updaters._cycles_since_full = 0
+
+    def test_changed_preferences(self):
+        """A subscriber who changed their preferences or confirmed their
+        subscription is checked in the next cycle only, and routers nobody
+        confirmed a subscription to aren't compared at all."""
+        bandwidth = BandwidthSub(subscriber = self.confirmed, threshold = 50)
+        bandwidth.save()
+        Router(fingerprint = 'BBBB', name = 'lonely').save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', up = False,
+                                                    bandwidth = 60)})
+
+        updaters._previous_state = None
+        try:
+            updaters.find_changes(ctl_util)
+            self.assertEqual(updaters._previous_state[0].keys(), [u'AAAA'])
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(BandwidthSub), [])
+
+            bandwidth.threshold = 80
+            bandwidth.save()
+            self.confirmed.mark_changed()
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(BandwidthSub), [bandwidth.pk])
+            self.assertEqual(len(updaters.check_all_subs(ctl_util, [],
+                                                         changes = changes)),
+                             1)
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(BandwidthSub), [])
+
+            late = BandwidthSub(subscriber = self.unconfirmed, threshold = 80)
+            late.save()
+            self.unconfirmed.confirmed = True
+            self.unconfirmed.mark_changed()
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(BandwidthSub), [late.pk])
+        finally:
+            updaters._previous_state = None
+            updaters._cycles_since_full = 0
+
+    def test_notify_at(self):
+        """Triggered node down subscriptions are found through notify_at
+        once their grace period ran out, and emailing them clears it."""
+        then = datetime.now() - timedelta(hours = 3)
+        due = NodeDownSub(subscriber = self.confirmed, grace_pd = 2,
+                          triggered = True, last_changed = then)
+        due.save()
+        self.assertEqual(due.notify_at, then + timedelta(hours = 2))
+        waiting = NodeDownSub(subscriber = self.confirmed, grace_pd = 4,
+                              triggered = True, last_changed = then)
+        waiting.save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', up = False)})
+
+        updaters._previous_state = None
+        try:
+            updaters.find_changes(ctl_util)
+            changes = updaters.find_changes(ctl_util)
+            self.assertEqual(changes.sub_pks(NodeDownSub), [due.pk])
+
+            self.assertEqual(len(updaters.check_node_down([], pks = [due.pk])), 1)
+            self.assertEqual(NodeDownSub.objects.get(pk = due.pk).notify_at,
+                             None)
+            self.assertEqual(changes.sub_pks(NodeDownSub), [])
+        finally:
+            updaters._previous_state = None
+            updaters._cycles_since_full = 0
+
+    def test_unsubscribed(self):
+        """A subscription deleted while it is being checked is skipped
+        instead of aborting the check."""
+        BandwidthSub(subscriber = self.confirmed, threshold = 50).save()
+        TShirtSub(subscriber = self.confirmed, triggered = True,
+                  avg_bandwidth = 600, last_changed = datetime.now() -
+                  timedelta(hours = TShirtSub.HOURS_REQUIRED + 1)).save()
+        self.router.up = True
+        self.router.save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', bandwidth = 10)})
+
+        subs_by_pk = updaters._subs_by_pk
+        def unsubscribe(sub_class, pks):
+            sub_class.objects.filter(pk__in = pks).delete()
+            return subs_by_pk(sub_class, pks)
+        updaters._subs_by_pk = unsubscribe
+        try:
+            self.assertEqual(updaters.check_low_bandwidth(ctl_util, []), [])
+            ctl_util.relays['AAAA']['bandwidth'] = 600
+            self.assertEqual(updaters.check_earn_tshirt(ctl_util, []), [])
+        finally:
+            updaters._subs_by_pk = subs_by_pk
+        self.assertEqual(BandwidthSub.objects.count(), 0)
+        self.assertEqual(TShirtSub.objects.count(), 0)
+
+    def test_partitions(self):
+        """The id partitions cover every subscription, and a checker only
+        looks at the subscriptions in the range it is given."""
+        self.assertEqual(updaters.id_partitions(BandwidthSub), [])
+        sub = BandwidthSub(subscriber = self.confirmed, threshold = 50)
+        sub.save()
+        ctl_util = StubCtlUtil({'AAAA': _stub_relay('down', bandwidth = 10)})
+
+        partitions = updaters.id_partitions(BandwidthSub)
+        self.assertEqual(len(partitions), 1)
+        start, end = partitions[0]
+        self.assertTrue(start <= sub.id < end)
+
+        self.assertEqual(updaters.check_low_bandwidth(ctl_util, [],
+                                                      (end, end + 1)), [])
+        self.assertEqual(len(updaters.check_low_bandwidth(ctl_util, [],
+                                                          (start, end))), 1)
+
+    def test_digests(self):
+        """The notifications to one address are combined into one digest,
+        except for the subscribers who opted out."""
+        then = datetime.now() - timedelta(hours = 3)
+        for fingerprint, name, digest in (('BBBB', 'second', True),
+                                          ('CCCC', 'third', False)):
+            router = Router(fingerprint = fingerprint, name = name, up = False)
+            router.save()
+            subscriber = Subscriber(email = 'Yes@place.com', router = router,
+                                    confirmed = True, digest = digest)
+            subscriber.save()
+            NodeDownSub(subscriber = subscriber, grace_pd = 2,
+                        triggered = True, last_changed = then).save()
+        NodeDownSub(subscriber = self.confirmed, grace_pd = 2,
+                    triggered = True, last_changed = then).save()
+
+        email_list = updaters.check_node_down([])
+        welcome = emails.welcome_tuple('yes@place.com', 'AAAA', 'down', False)
+        email_list.append(welcome)
+        self.assertEqual(len(email_list), 4)
+
+        #The checkers mark the parts with their own module's DigestPart
+        digests = updaters.emails.make_digests(email_list)
+        self.assertEqual(len(digests), 3)
+        self.assertTrue(welcome in digests)
+        single = [email for email in digests if 'third' in email[1]]
+        self.assertEqual(len(single), 1)
+        self.assertTrue(single[0][0].endswith('Node Down!'))
+
+        digest = [email for email in digests if 'Reports' in email[0]][0]
+        self.assertEqual(digest[0], '[Tor Weather] 2 Reports About Your Nodes')
+        self.assertEqual(digest[1].count('This is a Tor Weather Report.'), 1)
+        self.assertEqual(digest[1].count('Node Down!\n=========='), 2)
+        self.assertTrue('down (id:' in digest[1])
+        self.assertTrue('second (id:' in digest[1])
+        self.assertEqual(digest[1].count('/unsubscribe/'), 2)
+
+class TestParallelChecks(TransactionTestCase):
+    """Test L{updaters.check_all_subs} on a thread pool. The pool threads
+    have database connections of their own, which only see committed rows,
+    so the test data is committed instead of rolled back."""
+
+    def _subscribe(self):
+        """Store six routers, half of them down, each with a confirmed
+        subscriber who has every kind of subscription.
+
+        @rtype: L{StubCtlUtil}
+        @return: The relays, of which the down ones run an obsolete version
+            and every third has a low bandwidth.
+        """
+        Subscriber.objects.all().delete()
+        Router.objects.all().delete()
+        then = datetime.now() - timedelta(hours = 3)
+        long_ago = datetime.now() - timedelta(days = 62)
+        relays = {}
+        for i in range(6):
+            fingerprint = 'AAAA%d' % i
+            up = i % 2 == 0
+            router = Router(fingerprint = fingerprint, name = 'relay%d' % i,
+                            up = up)
+            router.save()
+            subscriber = Subscriber(email = 'sub%d@place.com' % i,
+                                    router = router, confirmed = True,
+                                    confirm_auth = 'confirm%d' % i,
+                                    unsubs_auth = 'unsubs%d' % i,
+                                    pref_auth = 'pref%d' % i)
+            subscriber.save()
+            NodeDownSub(subscriber = subscriber, grace_pd = 2,
+                        triggered = True, last_changed = then).save()
+            VersionSub(subscriber = subscriber,
+                       notify_type = 'OBSOLETE').save()
+            BandwidthSub(subscriber = subscriber, threshold = 50).save()
+            TShirtSub(subscriber = subscriber, triggered = True,
+                      avg_bandwidth = 600, last_changed = long_ago).save()
+            relays[fingerprint] = _stub_relay(
+                'relay%d' % i, up = up,
+                bandwidth = i % 3 == 0 and 10 or 600,
+                version_type = up and 'RECOMMENDED' or 'OBSOLETE')
+        return StubCtlUtil(relays)
+
+    def _state(self):
+        """Get the fields the checkers update, keyed by subscriber.
+
+        @rtype: list
+        @return: The sorted (class name, email, field values) tuples of all
+            subscriptions.
+        """
+        state = []
+        for sub_class, fields in ((NodeDownSub, ('triggered', 'emailed')),
+                                  (VersionSub, ('emailed',)),
+                                  (BandwidthSub, ('emailed',)),
+                                  (TShirtSub, ('triggered', 'emailed',
+                                               'avg_bandwidth'))):
+            for values in sub_class.objects.values_list('subscriber__email',
+                                                        *fields):
+                state.append((sub_class.__name__,) + tuple(values))
+        return sorted(state)
+
+    def _check(self, workers):
+        """Check fresh subscriptions with C{workers} threads.
+
+        @rtype: tuple (list, list)
+        @return: The emails and the resulting L{_state}.
+        """
+        ctl_util = self._subscribe()
+        email_list = updaters.check_all_subs(ctl_util, [], workers = workers)
+        return email_list, self._state()
+
+    def test_parallel(self):
+        """The thread pool produces the emails of the sequential checks in
+        the same order and makes the same database updates."""
+        partition_size = updaters._PARTITION_SIZE
+        updaters._PARTITION_SIZE = 2
+        try:
+            serial = self._check(1)
+            parallel = self._check(3)
+        finally:
+            updaters._PARTITION_SIZE = partition_size
+        #Node down, version and tshirt for every other relay, bandwidth for
+        #every third
+        self.assertEqual(len(serial[0]), 11)
+        self.assertEqual(parallel[0], serial[0])
+        self.assertEqual(parallel[1], serial[1])
+
+    def test_failure(self):
+        """An exception in a pool thread is raised by check_all_subs."""
+        ctl_util = self._subscribe()
+
+        def broken(*args):
+            raise IOError('lost the control connection')
+
+        check_version = updaters.check_version
+        updaters.check_version = broken
+        try:
+            self.assertRaises(IOError, updaters.check_all_subs, ctl_util, [],
+                              workers = 3)
+        finally:
+            updaters.check_version = check_version
+
+class TestRelayIndex(TestCase):
+    """Test the router name search in L{relayindex} and the lookup views"""
+
+    def setUp(self):
+        """Store routers with similar names and make the views load a fresh
+        index."""
+        for fingerprint, name, up in [('A' * 40, 'freeRelay', False),
+                                      ('B' * 40, 'relayfree', True),
+                                      ('C' * 40, 'twin', True),
+                                      ('D' * 40, 'twin', False)]:
+            Router(fingerprint = fingerprint, name = name, up = up).save()
+        #Ask the database unless a test publishes a snapshot
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.snapshot_file = views.relayindex.relaysnapshot.snapshot_file
+        views.relayindex.relaysnapshot.snapshot_file = os.path.join(
+            self.snapshot_dir, 'relays.snapshot')
+
+    def tearDown(self):
+        views.relayindex.relaysnapshot.snapshot_file = self.snapshot_file
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_search(self):
+        """Names match case-insensitively anywhere, running routers come
+        first and results are capped."""
+        index = relayindex.DatabaseIndex()
+        self.assertEqual(index.search('FREE'), ['relayfree', 'freeRelay'])
+        self.assertEqual(index.search('ylf'), [])
+        self.assertEqual(index.search('relay', limit = 1), ['relayfree'])
+        self.assertEqual(index.search('twin'), ['twin'])
+        self.assertEqual(index.fingerprints('twin'), ['C' * 40, 'D' * 40])
+
+    def test_views(self):
+        """Without a snapshot the lookup views answer from the database,
+        including routers stored a moment ago."""
+        client = Client()
+        response = client.get('/router_name_lookup/', {'query': 'free'})
+        self.assertEqual(response.content, '["relayfree", "freeRelay"]')
+        response = client.get('/router_fingerprint_lookup/',
+                              {'query': 'twin'})
+        self.assertEqual(response.content, '"nonunique_name"')
+
+        Router(fingerprint = 'E' * 40, name = 'newcomer').save()
+        response = client.get('/router_fingerprint_lookup/',
+                              {'query': 'newcomer'})
+        self.assertEqual(response.content, '"EEEE %s"' %
+                         ' '.join(['EEEE'] * 9))
+
+    def test_directory(self):
+        """The running routers are published under a name that changes with
+        them, old files are removed and the subscribe page links the current
+        one."""
+        directory_dir = tempfile.mkdtemp()
+        handle, stamp_file = tempfile.mkstemp()
+        os.close(handle)
+        saved = (views.relayindex.directory_dir, views.relayindex.stamp_file,
+                 views.relayindex.KEEP_DIRECTORIES)
+        views.relayindex.directory_dir = directory_dir
+        views.relayindex.stamp_file = stamp_file
+        views.relayindex.KEEP_DIRECTORIES = 1
+        try:
+            url = views.relayindex.publish_directory()
+            self.assertEqual(views.relayindex.publish_directory(), url)
+            filename = url[len(views.relayindex.directory_url):]
+            self.assertEqual(open(os.path.join(directory_dir, filename)).read(),
+                             '[["relayfree","%s"],["twin","%s"]]' %
+                             ('B' * 40, 'C' * 40))
+
+            Router.objects.filter(name = 'twin').update(up = False)
+            new_url = views.relayindex.publish_directory()
+            self.assertNotEqual(new_url, url)
+            self.assertEqual(os.listdir(directory_dir),
+                             [new_url[len(views.relayindex.directory_url):]])
+
+            views.relayindex.mark_changed(new_url)
+            response = Client().get('/subscribe/')
+            self.assertEqual(response.context['relay_directory'], new_url)
+        finally:
+            (views.relayindex.directory_dir, views.relayindex.stamp_file,
+             views.relayindex.KEEP_DIRECTORIES) = saved
+            for name in os.listdir(directory_dir):
+                os.remove(os.path.join(directory_dir, name))
+            os.rmdir(directory_dir)
+            os.remove(stamp_file)
+
+    def test_snapshot(self):
+        """The published snapshot answers the lookups like the database and
+        the subscribe form, and is mapped again when it is republished."""
+        index = views.relayindex
+        database = index.get_index()
+        self.assertEqual(database.__class__, index.DatabaseIndex)
+        self.assertEqual(index.publish_snapshot(), 4)
+        snapshot = index.get_index()
+        self.assertEqual(len(snapshot), 4)
+        for query, limit in [('FREE', 20), ('ylf', 20), ('relay', 1),
+                             ('twin', 20)]:
+            self.assertEqual(snapshot.search(query, limit),
+                             database.search(query, limit))
+        self.assertEqual(snapshot.search('FREE'), ['relayfree', 'freeRelay'])
+        self.assertEqual(snapshot.fingerprints('twin'),
+                         database.fingerprints('twin'))
+        self.assertEqual(snapshot.fingerprints('twin'), ['C' * 40, 'D' * 40])
+        self.assertEqual(snapshot.fingerprints('twi'), [])
+        self.assertTrue('B' * 40 in snapshot)
+        self.assertFalse('E' * 40 in snapshot)
+        self.assertFalse('not a fingerprint' in snapshot)
+
+        router = Router.objects.get(fingerprint = 'B' * 40)
+        router_id, name, up, exit, last_seen = snapshot.get('B' * 40)
+        self.assertEqual((router_id, name, up, exit),
+                         (router.id, 'relayfree', True, router.exit))
+        self.assertEqual(last_seen, router.last_seen.replace(microsecond = 0))
+
+        form = SubscribeForm()
+        self.assertTrue(form.is_valid_router('C' * 40))
+        self.assertEqual(form.get_router('C' * 40).id,
+                         Router.objects.get(fingerprint = 'C' * 40).id)
+
+        #Routers stored later are only found once the snapshot is republished
+        Router(fingerprint = 'E' * 40, name = 'newcomer').save()
+        client = Client()
+        response = client.get('/router_fingerprint_lookup/',
+                              {'query': 'newcomer'})
+        self.assertEqual(response.content, '"no_router"')
+        self.assertFalse(form.is_valid_router('E' * 40))
+        index.publish_snapshot()
+        response = client.get('/router_fingerprint_lookup/',
+                              {'query': 'newcomer'})
+        self.assertEqual(response.content, '"EEEE %s"' %
+                         ' '.join(['EEEE'] * 9))
+        self.assertTrue(form.is_valid_router('E' * 40))
+
+    def test_bad_snapshot(self):
+        """Routers with malformed fingerprints are left out of the snapshot
+        but still found in the database, and an unreadable snapshot makes
+        the lookups fall back to the database."""
+        index = views.relayindex
+        Router(fingerprint = 'F' * 39, name = 'short').save()
+        Router(fingerprint = 'g' * 40, name = 'nothex').save()
+        self.assertEqual(index.publish_snapshot(), 4)
+        self.assertEqual(index.get_index().fingerprints('short'), [])
+        form = SubscribeForm()
+        self.assertTrue(form.is_valid_router('F' * 39))
+        self.assertEqual(form.get_router('F' * 39).name, 'short')
+        self.assertFalse(form.is_valid_router('0' * 40))
+
+        snapshot_file = index.relaysnapshot.snapshot_file
+        for content in ['', open(snapshot_file, 'rb').read()[:100]]:
+            broken = open(snapshot_file, 'wb')
+            broken.write(content)
+            broken.close()
+            self.assertEqual(index.relaysnapshot.current(), None)
+            response = Client().get('/router_fingerprint_lookup/',
+                                    {'query': 'short'})
+            self.assertEqual(response.content, '"%s"' %
+                             insert_fingerprint_spaces('F' * 39))
+
+class TestHistory(TestCase):
+    """Test recording and compacting the relay history in L{history}"""
+
+    class _Status:
+        """Stand-in for a stem router status entry"""
+
+        def __init__(self, fingerprint, flags):
+            self.fingerprint = fingerprint
+            self.flags = flags
+
+    class _Descriptor:
+        """Stand-in for a stem server descriptor"""
+
+        def __init__(self, fingerprint, bandwidth, version,
+                     hibernating = False):
+            self.fingerprint = fingerprint
+            self.observed_bandwidth = bandwidth * 1000
+            self.tor_version = version
+            self.hibernating = hibernating
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_history(self):
+        """Uptime and average bandwidth are answered from the recorded
+        consensuses, also after they were merged, and old ones are dropped
+        along with the slots of the relays only they held."""
+        day = 86400 * 100
+        for hour, bandwidths in enumerate([{'AAAA': 100},
+                                           {'AAAA': 200, 'BBBB': 50},
+                                           {'BBBB': 70}]):
+            statuses = [self._Status(fingerprint, ['Running', 'Stable'])
+                        for fingerprint in sorted(bandwidths)]
+            descriptors = [self._Descriptor(fingerprint, bandwidth, '0.2.4.21')
+                           for fingerprint, bandwidth in
+                           sorted(bandwidths.items())]
+            if 'AAAA' not in bandwidths:
+                descriptors.append(self._Descriptor('AAAA', 300, '0.2.4.22',
+                                                    hibernating = True))
+            snapshot = ConsensusSnapshot(statuses, descriptors, [])
+            history.RelayHistory(self.directory).append(day + hour * 3600,
+                history.snapshot_states(snapshot))
+
+        relay_history = history.RelayHistory(self.directory)
+        self.assertEqual(relay_history.relays, ['AAAA', 'BBBB'])
+        #A frame only holds the relays seen in its consensus
+        before = os.path.getsize(os.path.join(self.directory, 'frames.bin'))
+        relay_history.append(day + 3 * 3600, [('BBBB', True, False, 70,
+                                                ['Running'], '0.2.4.21')])
+        self.assertEqual(os.path.getsize(os.path.join(self.directory,
+                                                      'frames.bin')) - before,
+                         history._HEADER.size + history._RECORD.size)
+        relay_history = history.RelayHistory(self.directory)
+        self.assertEqual(relay_history.uptime('AAAA'), 2)
+        self.assertEqual(relay_history.average_bandwidth('AAAA'), 150)
+        self.assertEqual(relay_history.average_bandwidth('BBBB',
+                                                         since = day + 7200),
+                         70)
+        records = relay_history.relay_records('AAAA')
+        self.assertEqual(records[0], (day, 1, 100, 1, 0,
+                                      ['Running', 'Stable'], '0.2.4.21'))
+        self.assertEqual(records[2], (day + 7200, 1, 0, 0, 1, [], '0.2.4.22'))
+        self.assertEqual(relay_history.relay_records('CCCC'), [])
+
+        self.assertEqual(relay_history.compact(day + 86400 * 3, 3, 24, 10), 0)
+        self.assertEqual(relay_history.compact(day + 86400 * 2, 1, 24, 10), 3)
+        self.assertEqual(relay_history.frame_times(), [(day, 4)])
+        self.assertEqual(relay_history.uptime('AAAA'), 2)
+        self.assertEqual(relay_history.uptime('BBBB'), 3)
+        self.assertEqual(relay_history.average_bandwidth('AAAA'), 150)
+        self.assertEqual(relay_history.relay_records('AAAA')[0][4:],
+                         (1, ['Running', 'Stable'], '0.2.4.22'))
+
+        self.assertEqual(relay_history.compact(day + 86400 * 2, 1, 24, 1), 1)
+        self.assertEqual(relay_history.frame_times(), [])
+        self.assertEqual(relay_history.uptime('AAAA'), 0)
+
+        #The slots of the dropped relays are given to new ones
+        relay_history = history.RelayHistory(self.directory)
+        self.assertEqual(relay_history.relays, ['-', '-'])
+        self.assertEqual(relay_history.free, [0, 1])
+        relay_history.append(day + 86400 * 2, [('CCCC', True, False, 80,
+                                                ['Running'], '0.2.4.21')])
+        relay_history = history.RelayHistory(self.directory)
+        self.assertEqual(relay_history.relays, ['CCCC', '-'])
+        self.assertEqual(relay_history.uptime('CCCC'), 1)
+        self.assertEqual(relay_history.average_bandwidth('CCCC'), 80)
+        self.assertEqual(relay_history.uptime('AAAA'), 0)
+
+class TestReplay(TestCase):
+    """Test replaying recorded consensuses with L{replay.ReplayController}"""
+
+    _CONSENSUS = """network-status-version 3
+vote-status consensus
+valid-after 2013-08-01 %02d:00:00
+server-versions 0.2.3.25,0.2.4.15-rc
+known-flags Fast Running Stable Valid
+%s
+directory-footer
+"""
+
+    _DESCRIPTOR = """@downloaded-at 2013-08-01 11:30:00
+router %s 10.0.0.1 9001 0 0
+platform Tor 0.2.3.25 on Linux
+published 2013-08-01 11:00:00
+fingerprint %s
+bandwidth 102400 204800 51200
+contact op at place dot com
+reject *:*
+router-signature
+-----BEGIN SIGNATURE-----
+AAAA
+-----END SIGNATURE-----
+"""
+
+    _RELAYS = [('1111111111111111111111111111111111111111', 'first'),
+               ('2222222222222222222222222222222222222222', 'second')]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, hour, running, descriptors = True):
+        """Write a consensus listing the relays in C{running}."""
+        consensus_dir = os.path.join(self.directory, name)
+        os.mkdir(consensus_dir)
+        entries = []
+        for fingerprint, nickname in self._RELAYS:
+            identity = base64.b64encode(fingerprint.decode('hex')).rstrip('=')
+            if nickname in running:
+                entries.append('r %s %s %s 2013-08-01 11:00:00 10.0.0.1 9001 '
+                               '0\ns Fast Running Valid' %
+                               (nickname, identity, identity))
+        open(os.path.join(consensus_dir, replay.CONSENSUS_FILE), 'w').write(
+            self._CONSENSUS % (hour, '\n'.join(entries)))
+        if descriptors:
+            open(os.path.join(consensus_dir, 'cached-descriptors'), 'w').write(
+                ''.join([self._DESCRIPTOR % (nickname, fingerprint)
+                         for fingerprint, nickname in self._RELAYS]))
+
+    def test_replay(self):
+        """The consensuses are replayed in order, each reusing the last
+        descriptors, and the database is seeded from the first."""
+        self._write('01', 12, ['first', 'second'])
+        self._write('02', 13, ['first'], descriptors = False)
+        controller = replay.ReplayController(self.directory)
+        ctl_util = CtlUtil(controller = controller)
+
+        self.assertEqual(controller.advance(), True)
+        snapshot = ctl_util.refresh_snapshot()
+        self.assertEqual(snapshot.descriptor_order,
+                         [fingerprint for fingerprint, name in self._RELAYS])
+        self.assertEqual(snapshot.rec_versions, ['0.2.3.25', '0.2.4.15-rc'])
+        self.assertEqual(ctl_util.stem_calls, 3)
+
+        subscriptions = replay.seed_database(snapshot, 20)
+        self.assertEqual(Router.objects.count(), 2)
+        self.assertEqual(Subscriber.objects.filter(confirmed = True).count(),
+                         20)
+        self.assertEqual(Subscription.objects.count(), subscriptions)
+
+        self.assertEqual(controller.advance(), True)
+        snapshot = ctl_util.refresh_snapshot()
+        self.assertEqual(controller.consensus_name(), '02')
+        self.assertEqual(len(snapshot.descriptors), 2)
+        self.assertEqual(ctl_util.is_up(self._RELAYS[0][0]), True)
+        self.assertEqual(ctl_util.is_up(self._RELAYS[1][0]), False)
+        self.assertEqual(controller.advance(), False)
+
+    def test_synthetic(self):
+        """A generated network can be replayed and its subscribers loaded,
+        and the same seed generates the same files."""
+        relays, subscriptions = synthetic.generate(self.directory, 40, 30,
+                                                   consensuses = 3,
+                                                   churn = 0.25, seed = 7)
+        self.assertEqual(relays, 42)
+        controller = replay.ReplayController(self.directory)
+        ctl_util = CtlUtil(controller = controller)
+        while controller.advance():
+            snapshot = ctl_util.refresh_snapshot()
+            self.assertTrue(0 < len(snapshot.statuses) <= relays)
+            #One relay joins in every consensus after the first
+            self.assertEqual(len(snapshot.descriptors),
+                             40 + controller.position)
+
+        subscriber_file = os.path.join(self.directory, replay.SUBSCRIBER_FILE)
+        contents = open(subscriber_file).read()
+        synthetic.generate(self.directory, 40, 30, consensuses = 3,
+                           churn = 0.25, seed = 7)
+        self.assertEqual(open(subscriber_file).read(), contents)
+
+        self.assertEqual(replay.load_subscribers(subscriber_file),
+                         (30, subscriptions))
+        self.assertEqual(Subscriber.objects.count(), 30)
+        self.assertEqual(Subscription.objects.count(), subscriptions)
+        self.assertEqual(NodeDownSub.objects.filter(
+                         notify_at__isnull = True).count(),
+                         NodeDownSub.objects.count())
+        self.assertTrue(Router.objects.count() <= 40)
+
+    def test_benchmark_files(self):
+        """The benchmark leaves the real files alone and sends no emails."""
+        synthetic.generate(self.directory, 20, 10, consensuses = 2, seed = 3)
+        real_dir = tempfile.mkdtemp()
+        contacts = replay.CtlUtil._contacts
+        #Every file the updater writes, the ones the benchmark doesn't know
+        #about included
+        real_files = [(replay.history, 'history_dir'),
+                      (replay.relayindex, 'stamp_file'),
+                      (replay.relayindex, 'directory_dir'),
+                      (replay.relaysnapshot, 'snapshot_file'),
+                      (replay.metrics, 'metrics_file'),
+                      (replay.ctlutil, 'unparsable_email_file'),
+                      (replay.ctlutil, 'contact_cache_file'),
+                      (replay.mailqueue, 'drain_stamp_file'),
+                      (replay.mailqueue, 'failed_email_file')]
+        saved_files = [(module, name, getattr(module, name))
+                       for module, name in real_files]
+        for module, name in real_files:
+            setattr(module, name, os.path.join(real_dir, name))
+        replay.CtlUtil._contacts = ContactCache(
+            filename = replay.ctlutil.contact_cache_file)
+        try:
+            results = replay.run_benchmark(self.directory, seed = 3)
+            self.assertEqual(len(results['cycles']), 2)
+            #Each cycle counts the relays of its consensus once
+            for cycle in results['cycles']:
+                fetched = [phase for phase in cycle['phases']
+                           if phase['name'] == 'fetch_consensus'][0]
+                self.assertEqual(cycle['relays'], fetched['relays'])
+            self.assertEqual(os.listdir(real_dir), [])
+            self.assertEqual(mail.outbox, [])
+            for module, name in real_files:
+                self.assertEqual(getattr(module, name),
+                                 os.path.join(real_dir, name))
+            self.assertEqual(replay.CtlUtil._contacts.filename,
+                             replay.ctlutil.contact_cache_file)
+            self.assertFalse(replay.mailqueue.mailer_is_running())
+        finally:
+            for module, name, value in saved_files:
+                setattr(module, name, value)
+            replay.CtlUtil._contacts = contacts
+            shutil.rmtree(real_dir)
+
+class TestDatabase(TestCase):
+    """Test the SQLite tuning and lock retries in L{database}"""
+
+    def test_pragmas(self):
+        """Connections use write-ahead logging."""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode')
+        self.assertEqual(cursor.fetchone()[0], 'wal')
+        cursor.execute('PRAGMA synchronous')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_retry(self):
+        """Transactions that find the database locked are run again, other
+        errors aren't retried."""
+        calls = []
+
+        def locked_twice():
+            calls.append(None)
+            if len(calls) < 3:
+                raise DatabaseError('database is locked')
+            return len(calls)
+
+        def broken():
+            calls.append(None)
+            raise DatabaseError('no such table: weatherapp_router')
+
+        retry_delay = database.RETRY_DELAY
+        database.RETRY_DELAY = 0
+        try:
+            self.assertEqual(database.atomically(locked_twice), 3)
+            del calls[:]
+            self.assertRaises(DatabaseError, database.atomically, broken)
+            self.assertEqual(len(calls), 1)
+        finally:
+            database.RETRY_DELAY = retry_delay
+
+class TestMetrics(TestCase):
+    """Test the update cycle instrumentation in L{metrics}"""
+
+    def test_phases(self):
+        """Phases record their duration, the queries and Stem calls they
+        issued and their own counters, and the totals are written as JSON."""
+        ctl_util = StubCtlUtil({})
+        ctl_util.stem_calls = 0
+        cycle = metrics.CycleMetrics(ctl_util)
+
+        with metrics.counting_queries():
+            cycle.begin('sync_routers')
+            Router(fingerprint = 'AAAA', name = 'one').save()
+            Router.objects.count()
+            ctl_util.stem_calls += 3
+            cycle.end('sync_routers', relays = 1, emails = 2)
+        #Only the statements in the block are counted
+        self.assertFalse('cursor' in connection.__dict__)
+        counted = metrics.query_count()
+        Router.objects.count()
+        self.assertEqual(metrics.query_count(), counted)
+
+        phase = cycle.phases[0]
+        self.assertEqual(phase['name'], 'sync_routers')
+        self.assertTrue(phase['queries'] >= 2)
+        self.assertEqual(phase['stem_calls'], 3)
+        self.assertEqual(phase['relays'], 1)
+
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            data = cycle.write(filename)
+            self.assertEqual(data['emails'], 2)
+            self.assertEqual(open(filename).read().count('sync_routers'), 1)
+        finally:
+            os.remove(filename)
+
+class TestMailQueue(TestCase):
+    """Test queueing and sending notification emails"""
+
+    class _FailingConnection:
+        """Stand-in for an email backend whose server refuses every email"""
+
+        def open(self):
+            raise IOError('connection refused')
+
+        def close(self):
+            pass
+
+    def test_drain(self):
+        """Queued emails are sent and removed from the queue."""
+        email_list = [emails.welcome_tuple('a@place.com', '1234', 'abc', True),
+                      emails.welcome_tuple('b@place.com', '5678', 'def', False),
+                      emails.version_tuple('c@place.com', '1234', 'abc',
+                                           'OBSOLETE', 'unsubs', 'pref')]
+        self.assertEqual(mailqueue.enqueue(email_list), 3)
+        self.assertEqual(mailqueue.queue_length(), 3)
+
+        stats = mailqueue.drain(workers = 2)
+        self.assertEqual(stats['sent'], 3)
+        self.assertEqual(mailqueue.queue_length(), 0)
+        self.assertEqual(sorted([m.to[0] for m in mail.outbox]),
+                         ['a@place.com', 'b@place.com', 'c@place.com'])
+
+    def test_retry(self):
+        """Emails that can't be sent are rescheduled with a growing delay,
+        then given up on."""
+        mailqueue.enqueue([emails.welcome_tuple('a@place.com', '1234', 'abc',
+                                                True)])
+        get_connection = mailqueue.get_connection
+        failed_email_file = mailqueue.failed_email_file
+        mailqueue.get_connection = lambda **kw: self._FailingConnection()
+        mailqueue.failed_email_file = tempfile.mktemp()
+        try:
+            stats = mailqueue.drain()
+            self.assertEqual(stats['retried'], 1)
+            queued = QueuedEmail.objects.get()
+            self.assertEqual(queued.attempts, 1)
+            self.assertEqual(queued.last_error, 'connection refused')
+            self.assertTrue(queued.next_attempt > datetime.now())
+
+            queued.attempts = mailqueue.MAX_ATTEMPTS - 1
+            queued.next_attempt = datetime.now()
+            queued.save()
+            stats = mailqueue.drain()
+            self.assertEqual(stats['failed'], 1)
+            self.assertEqual(mailqueue.queue_length(), 0)
+            self.assertTrue('a@place.com' in
+                            open(mailqueue.failed_email_file).read())
+        finally:
+            if os.path.exists(mailqueue.failed_email_file):
+                os.remove(mailqueue.failed_email_file)
+            mailqueue.get_connection = get_connection
+            mailqueue.failed_email_file = failed_email_file
+
+    def test_claims(self):
+        """Emails claimed by another drain are left to it until the claim
+        is stale."""
+        mailqueue.enqueue([emails.welcome_tuple('a@place.com', '1234', 'abc',
+                                                True),
+                           emails.welcome_tuple('b@place.com', '5678', 'def',
+                                                True)])
+        claimed = QueuedEmail.objects.get(recipient = 'b@place.com')
+        claimed.claimed_by = 'other'
+        claimed.claimed_at = datetime.now()
+        claimed.save()
+
+        stats = mailqueue.drain()
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual([m.to[0] for m in mail.outbox], ['a@place.com'])
+        self.assertEqual(QueuedEmail.objects.get().claimed_by, 'other')
+
+        claimed.claimed_at = datetime.now() - \
+                timedelta(seconds = mailqueue.CLAIM_TIMEOUT + 1)
+        claimed.save()
+        stats = mailqueue.drain()
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(mailqueue.queue_length(), 0)
+
+    def test_lost_results(self):
+        """Emails whose worker thread died are rescheduled, and the drain
+        ends."""
+        mailqueue.enqueue([emails.welcome_tuple('a@place.com', '1234', 'abc',
+                                                True)])
+        send_batch = mailqueue._send_batch
+        mailqueue._send_batch = lambda emails, results: None
+        try:
+            stats = mailqueue.drain()
+        finally:
+            mailqueue._send_batch = send_batch
+        self.assertEqual(stats['retried'], 1)
+        queued = QueuedEmail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertTrue(queued.next_attempt > datetime.now())
+        self.assertEqual(queued.claimed_by, '')
+        self.assertEqual(queued.claimed_at, None)
+
+    def test_mailer_stamp(self):
+        """The mailer counts as running while the queue was drained
+        recently."""
+        drain_stamp_file = mailqueue.drain_stamp_file
+        mailqueue.drain_stamp_file = tempfile.mktemp()
+        try:
+            self.assertFalse(mailqueue.mailer_is_running())
+            mailqueue.drain()
+            self.assertTrue(mailqueue.mailer_is_running())
+            then = time.time() - mailqueue.MAILER_TIMEOUT - 1
+            os.utime(mailqueue.drain_stamp_file, (then, then))
+            self.assertFalse(mailqueue.mailer_is_running())
+        finally:
+            if os.path.exists(mailqueue.drain_stamp_file):
+                os.remove(mailqueue.drain_stamp_file)
+            mailqueue.drain_stamp_file = drain_stamp_file
+
+    def test_backlog(self):
+        """New subscriptions are turned away while too many confirmation
+        emails are waiting."""
+        Router(fingerprint = '1234', name = 'abc').save()
+        # the views may see the module under a different name
+        max_pending = views.mailqueue.MAX_PENDING_CONFIRMATIONS
+        views.mailqueue.MAX_PENDING_CONFIRMATIONS = 1
+        try:
+            mailqueue.enqueue([emails.confirmation_tuple('a@place.com', '1234',
+                                                         'abc', 'auth')],
+                              mailqueue.PRIORITY_CONFIRMATION)
+            response = Client().post('/subscribe/',
+                                     {'email_1': 'name@place.com',
+                                      'email_2': 'name@place.com',
+                                      'fingerprint': '1234',
+                                      'get_node_down': True,
+                                      'node_down_grace_pd': '',
+                                      'version_type': 'OBSOLETE',
+                                      'band_low_threshold': ''},
+                                     follow = True)
+            self.assertEqual(response.template[0].name, 'error.html')
+            self.assertEqual(Subscriber.objects.count(), 0)
+        finally:
+            views.mailqueue.MAX_PENDING_CONFIRMATIONS = max_pending
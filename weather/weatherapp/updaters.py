@@ -1,177 +1,480 @@
 """This module's run_all() method is called when a new consensus event is 
 triggered in listener.py. It first populates and updates
 the Router table by storing new routers seen in the consensus document and 
-updating info relating to routers already stored. Next, each subscription is 
-checked to determine if the Subscriber should be emailed. When an email 
+updating info relating to routers already stored. Next, the subscriptions are 
+checked to determine if the Subscriber should be emailed: all of them every
+few cycles, and in between only those the changes since the previous cycle
+can affect (see L{RouterChanges}). When an email 
 notification is indicated, a tuple with the email subject, message, sender, and 
 recipient is added to the list of email tuples. Once all updates are complete, 
-Django's send_mass_mail method is called, passing in the emails tuple as a 
-parameter.
+the notifications to the same address are combined into digests and the emails
+are handed to the L{mailqueue}, which sends them outside of the consensus
+processing path.
 
 @type ctl_util: CtlUtil
 @var ctl_util: A CtlUtil object for the module to handle the connection to and
     communication with Stem.
-@var failed_email_file: A log file for parsed email addresses that were non-functional. 
 """
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import itertools
 import logging
-from smtplib import SMTPException
+from multiprocessing.pool import ThreadPool
 
-from weatherapp.ctlutil import CtlUtil
+from weatherapp.ctlutil import CtlUtil, new_avg_bandwidth
 from weatherapp.models import Subscriber, Router, NodeDownSub, BandwidthSub, \
                               TShirtSub, VersionSub, DeployedDatetime
-from weatherapp import emails
+from weatherapp import database, emails, mailqueue, metrics, relayindex
+from config import config
 
-from django.core.mail import send_mass_mail
+from django.db import connection, transaction
+from django.db.models import Max, Min
 
-failed_email_file = 'log/failed_emails.txt'
+#The most primary keys put into a single UPDATE ... WHERE id IN (...), and
+#the most rows written in one transaction, so that the web pages never wait
+#long for the database
+_UPDATE_BATCH_SIZE = 500
 
-def check_node_down(email_list):
+#The number of subscription ids one checker task covers when the checkers run
+#on several threads
+_PARTITION_SIZE = 5000
+
+class SubChanges:
+    """Collects the fields a checker changed on its subscriptions so that
+    only the changed rows are written, with only the changed columns, in a
+    few batched UPDATE statements once the checker is done. Rows that got
+    the same new values are updated together.
+
+    @type sub_class: class
+    @ivar sub_class: The subclass of L{Subscription} being checked.
+    @type fields: list [str]
+    @ivar fields: The names of the fields the checker may change.
+    @type pending: dict {tuple: list [int]}
+    @ivar pending: Maps tuples of (field name, new value) pairs to the primary
+        keys of the subscriptions that got those values.
+    """
+
+    def __init__(self, sub_class, fields):
+        self.sub_class = sub_class
+        self.fields = fields
+        self.pending = {}
+
+    def values(self, sub):
+        """Get the current values of the tracked fields of C{sub}; pass them
+        to L{record} after the checker is done with C{sub}.
+
+        @type sub: L{Subscription}
+        @param sub: A subscription of type L{sub_class}.
+        @rtype: list
+        @return: The values of L{fields} on C{sub}.
+        """
+        return [getattr(sub, field) for field in self.fields]
+
+    def record(self, sub, before):
+        """Remember the tracked fields of C{sub} that differ from C{before}.
+
+        @type sub: L{Subscription}
+        @param sub: A subscription of type L{sub_class}.
+        @type before: list
+        @param before: The values L{values} returned before C{sub} was
+            checked.
+        """
+        changes = []
+        for field, old in zip(self.fields, before):
+            new = getattr(sub, field)
+            if new != old:
+                changes.append((field, new))
+
+        if changes:
+            self.pending.setdefault(tuple(changes), []).append(sub.pk)
+
+    def flush(self):
+        """Write all recorded changes, in transactions of at most
+        L{_UPDATE_BATCH_SIZE} rows.
+
+        @rtype: int
+        @return: The number of changed subscriptions.
+        """
+        changed = sum([len(pks) for pks in self.pending.values()])
+        _flush_sub_changes(self.sub_class, self.pending)
+        self.pending = {}
+        return changed
+
+def _flush_sub_changes(sub_class, pending):
+    """Apply the changes collected by a L{SubChanges} with one UPDATE per
+    distinct set of new values and batch of L{_UPDATE_BATCH_SIZE} rows,
+    each in a transaction of its own.
+
+    @type sub_class: class
+    @param sub_class: The subclass of L{Subscription} to update.
+    @type pending: dict {tuple: list [int]}
+    @param pending: See L{SubChanges.pending}.
+    """
+    for changes, pks in pending.items():
+        for start in range(0, len(pks), _UPDATE_BATCH_SIZE):
+            _update_batch(sub_class, pks[start:start + _UPDATE_BATCH_SIZE],
+                          dict(changes))
+
+@database.short_transaction
+def _update_batch(sub_class, pks, values):
+    """Set the fields in C{values} on the subscriptions with the primary
+    keys C{pks}."""
+    sub_class.objects.filter(pk__in = pks).update(**values)
+
+def _selection(sub_class, id_range, pks, filters):
+    """Get the subscriptions of type C{sub_class} that belong to confirmed
+    subscribers, as one query set per batch of L{_UPDATE_BATCH_SIZE}
+    primary keys if C{pks} is given.
+
+    @type sub_class: class
+    @param sub_class: A subclass of L{Subscription}.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are selected.
+    @type pks: list [int]
+    @param pks: If given, only the subscriptions with these ascending primary
+        keys are selected.
+    @type filters: dict
+    @param filters: Additional field lookups to filter the subscriptions by.
+    @rtype: list [QuerySet]
+    @return: The query sets, in primary key order.
+    """
+    subs = sub_class.objects.filter(subscriber__confirmed = True, **filters)
+    if id_range is not None:
+        subs = subs.filter(pk__gte = id_range[0], pk__lt = id_range[1])
+    if pks is None:
+        return [subs]
+    return [subs.filter(pk__in = pks[start:start + _UPDATE_BATCH_SIZE])
+            for start in range(0, len(pks), _UPDATE_BATCH_SIZE)]
+
+def confirmed_subs(sub_class, id_range = None, pks = None, **filters):
+    """Stream the subscriptions of type C{sub_class} that belong to confirmed
+    subscribers, with each subscription's subscriber and router fetched in
+    the same query.
+
+    @type sub_class: class
+    @param sub_class: A subclass of L{Subscription}.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are returned.
+    @type pks: list [int]
+    @param pks: If given, only the subscriptions with these ascending primary
+        keys are returned.
+    @param filters: Additional field lookups to filter the subscriptions by.
+    @rtype: iterator
+    @return: An iterator over the matching subscriptions.
+    """
+
+    return itertools.chain(*[subs.order_by('pk').select_related(
+                                 'subscriber__router').iterator()
+                             for subs in _selection(sub_class, id_range, pks,
+                                                    filters)])
+
+def _sub_columns(sub_class, id_range, pks, fields, **filters):
+    """Load fields of the subscriptions of type C{sub_class} that belong to
+    confirmed subscribers as columns, ordered by primary key.
+
+    @type sub_class: class
+    @param sub_class: A subclass of L{Subscription}.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are loaded.
+    @type pks: list [int]
+    @param pks: If given, only the subscriptions with these ascending primary
+        keys are loaded.
+    @type fields: list [str]
+    @param fields: The field lookups to load, such as 'emailed' or
+        'subscriber__router__up'.
+    @param filters: Additional field lookups to filter the subscriptions by.
+    @rtype: list [list]
+    @return: The primary keys followed by one list per field in C{fields},
+        all in the same order.
+    """
+    rows = []
+    for subs in _selection(sub_class, id_range, pks, filters):
+        rows.extend(subs.order_by('pk').values_list('pk', *fields))
+    if not rows:
+        return [[] for column in range(len(fields) + 1)]
+    return [list(column) for column in zip(*rows)]
+
+def _bandwidth_column(ctl_util, fingerprints, wanted = None):
+    """Look up the observed bandwidth of each router in C{fingerprints},
+    asking C{ctl_util} once per router.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @type fingerprints: list [unicode]
+    @param fingerprints: The router fingerprints.
+    @type wanted: list [bool]
+    @param wanted: If given, only the bandwidths of the routers at the
+        positions where it is C{True} are looked up; the others are 0.
+    @rtype: list [int]
+    @return: The bandwidths in kB/s, in the order of C{fingerprints}.
+    """
+    if wanted is None:
+        wanted = [True] * len(fingerprints)
+    known = {}
+    for fingerprint, is_wanted in zip(fingerprints, wanted):
+        if is_wanted and fingerprint not in known:
+            #Stem does type checking, so the fingerprint needs to be
+            #converted from a unicode string to a python str
+            known[fingerprint] = ctl_util.get_bandwidth(str(fingerprint))
+    return [known.get(fingerprint, 0) for fingerprint in fingerprints]
+
+def _hours_between(start, end):
+    """Get the whole hours from C{start} to C{end}, like
+    L{models.hours_since}."""
+    delta = end - start
+    return (delta.days * 24) + (delta.seconds / 3600)
+
+def _subs_by_pk(sub_class, pks):
+    """Load the subscriptions of type C{sub_class} with the primary keys
+    C{pks}, with their subscribers and routers.
+
+    @rtype: dict {int: L{Subscription}}
+    @return: The subscriptions keyed by primary key. Those deleted since
+        their primary keys were read are missing.
+    """
+    subs = {}
+    for start in range(0, len(pks), _UPDATE_BATCH_SIZE):
+        batch = pks[start:start + _UPDATE_BATCH_SIZE]
+        for sub in sub_class.objects.filter(pk__in = batch).select_related(
+                                                'subscriber__router'):
+            subs[sub.pk] = sub
+    return subs
+
+def _write_rows(sub_class, fields, rows):
+    """Write rows that each got their own new values with one prepared
+    UPDATE statement per table, executed for every row. Fields inherited from
+    L{Subscription} are stored in its table. Every L{_UPDATE_BATCH_SIZE} rows
+    are written in a transaction of their own.
+
+    @type sub_class: class
+    @param sub_class: The subclass of L{Subscription} to update.
+    @type fields: list [str]
+    @param fields: The names of the fields to set.
+    @type rows: list [tuple]
+    @param rows: The new values of C{fields} for each row, followed by the
+        row's primary key.
+    """
+    if not rows:
+        return
+    tables = {}
+    for position, name in enumerate(fields):
+        field = sub_class._meta.get_field(name)
+        tables.setdefault(field.model, []).append((position, field))
+
+    for start in range(0, len(rows), _UPDATE_BATCH_SIZE):
+        _write_row_batch(tables, rows[start:start + _UPDATE_BATCH_SIZE])
+
+@database.short_transaction
+def _write_row_batch(tables, rows):
+    """Write one batch of L{_write_rows}' rows. C{tables} maps the models
+    owning the fields to (position in the row, field) pairs."""
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for model, columns in tables.items():
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (qn(model._meta.db_table),
+              ', '.join(['%s = %%s' % qn(field.column)
+                         for position, field in columns]),
+              qn(model._meta.pk.column))
+        params = [[field.get_db_prep_save(row[position],
+                                          connection = connection)
+                   for position, field in columns] + [row[-1]]
+                  for row in rows]
+        cursor.executemany(sql, params)
+    #Raw statements don't mark the transaction as needing a commit
+    transaction.set_dirty()
+
+def _notification(subscriber, email):
+    """Mark the notification C{email} to C{subscriber} as a part of a
+    digest, unless the subscriber opted out of digests.
+
+    @type subscriber: Subscriber
+    @param subscriber: The subscriber the notification is sent to.
+    @type email: tuple
+    @param email: The tuple representing the notification email.
+    @rtype: tuple
+    @return: C{email}, as an L{emails.DigestPart} if it may be combined.
+    """
+    if subscriber.digest:
+        return emails.DigestPart(email)
+    return email
+
+def check_node_down(email_list, id_range = None, pks = None):
     """Check if all nodes with L{NodeDownSub} subs are up or down,
     and send emails and update sub data as necessary.
     
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are checked.
+    @type pks: list [int]
+    @param pks: If given, only the subscriptions with these ascending primary
+        keys are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    #All node down subs
-    subs = NodeDownSub.objects.all()
+    #All node down subs of confirmed subscribers
+    subs = confirmed_subs(NodeDownSub, id_range, pks)
+    changes = SubChanges(NodeDownSub, ['triggered', 'emailed', 'last_changed',
+                                       'notify_at'])
+    now = datetime.now()
 
     for sub in subs:
-        #only check subscriptions of confirmed subscribers
-        if sub.subscriber.confirmed:
-
-            if sub.subscriber.router.up:
-                if sub.triggered:
-                   sub.triggered = False
-                   sub.emailed = False
-                   sub.last_changed = datetime.now()
-            else:
-                if not sub.triggered:
-                    sub.triggered = True
-                    sub.last_changed = datetime.now()
-
-                if sub.is_grace_passed() and sub.emailed == False:
-                    recipient = sub.subscriber.email
-                    fingerprint = sub.subscriber.router.fingerprint
-                    name = sub.subscriber.router.name
-                    grace_pd = sub.grace_pd
-                    unsubs_auth = sub.subscriber.unsubs_auth
-                    pref_auth = sub.subscriber.pref_auth
-                        
-                    email = emails.node_down_tuple(recipient, fingerprint, 
-                                                   name, grace_pd,          
-                                                   unsubs_auth, pref_auth)
-                    email_list.append(email)
-                    sub.emailed = True 
-
-            sub.save()
+        before = changes.values(sub)
+        subscriber = sub.subscriber
+        router = subscriber.router
+
+        if router.up:
+            if sub.triggered:
+               sub.triggered = False
+               sub.emailed = False
+               sub.last_changed = now
+        else:
+            if not sub.triggered:
+                sub.triggered = True
+                sub.last_changed = now
+
+            if sub.is_grace_passed() and sub.emailed == False:
+                email = emails.node_down_tuple(subscriber.email,
+                                               router.fingerprint,
+                                               router.name, sub.grace_pd,
+                                               subscriber.unsubs_auth,
+                                               subscriber.pref_auth)
+                email_list.append(_notification(subscriber, email))
+                sub.emailed = True 
+
+        sub.update_notify_at()
+        changes.record(sub, before)
+
+    changes.flush()
     return email_list
 
-def check_low_bandwidth(ctl_util, email_list):
+def check_low_bandwidth(ctl_util, email_list, id_range = None, pks = None):
     """Checks all L{BandwidthSub} subscriptions, updates the information,
-    determines if an email should be sent, and updates email_list.
+    determines if an email should be sent, and updates email_list. The
+    subscriptions are loaded as columns and evaluated in whole-column passes;
+    only the subscribers to email are loaded as objects.
 
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are checked.
+    @type pks: list [int]
+    @param pks: If given, only the subscriptions with these ascending primary
+        keys are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    subs = BandwidthSub.objects.all()
-
-    for sub in subs:
+    sub_ids, thresholds, emailed, fingerprints = _sub_columns(BandwidthSub,
+        id_range, pks, ['threshold', 'emailed',
+                        'subscriber__router__fingerprint'])
+    bandwidths = _bandwidth_column(ctl_util, fingerprints)
 
-        #Stem does type checking, so fingerprint needs to be converted from
-        #a unicode string to a python str
-        fingerprint = str(sub.subscriber.router.fingerprint)
+    low = [bandwidth < threshold for bandwidth, threshold in
+           zip(bandwidths, thresholds)]
+    notify = [pk for pk, is_low, was_emailed in zip(sub_ids, low, emailed)
+              if is_low and not was_emailed]
+    recovered = [pk for pk, is_low, was_emailed in zip(sub_ids, low, emailed)
+                 if was_emailed and not is_low]
 
-        if sub.subscriber.confirmed:
-            bandwidth = ctl_util.get_bandwidth(fingerprint)
-            if bandwidth < sub.threshold: 
-                if sub.emailed == False:
-                    recipient = sub.subscriber.email
-                    name = sub.subscriber.router.name
-                    threshold = sub.threshold
-                    unsubs_auth = sub.subscriber.unsubs_auth
-                    pref_auth = sub.subscriber.pref_auth
-                    email_list.append(emails.bandwidth_tuple(recipient, 
-                    fingerprint, name, bandwidth, threshold, unsubs_auth,
-                    pref_auth)) 
-                    sub.emailed = True
-            else:
-                sub.emailed = False
-            sub.save()
+    subs = _subs_by_pk(BandwidthSub, notify)
+    bandwidth_of = dict(zip(sub_ids, bandwidths))
+    for pk in notify:
+        sub = subs.get(pk)
+        if sub is None:
+            #Unsubscribed since the columns were loaded
+            continue
+        subscriber = sub.subscriber
+        router = subscriber.router
+        email = emails.bandwidth_tuple(subscriber.email,
+                                       str(router.fingerprint), router.name,
+                                       bandwidth_of[pk], sub.threshold,
+                                       subscriber.unsubs_auth,
+                                       subscriber.pref_auth)
+        email_list.append(_notification(subscriber, email))
 
+    _flush_sub_changes(BandwidthSub, {(('emailed', True),): notify,
+                                      (('emailed', False),): recovered})
     return email_list
 
-def check_earn_tshirt(ctl_util, email_list):
+def check_earn_tshirt(ctl_util, email_list, id_range = None):
     """Check all L{TShirtSub} subscriptions and send an email if necessary. 
     If the node is down, the trigger flag set to False. The average 
-    bandwidth is calculated if triggered is True. This method uses the 
-    should_email method in the TShirtSub class.
+    bandwidth is calculated if triggered is True. The subscriptions are
+    loaded as columns and evaluated in whole-column passes with the same
+    rules as L{TShirtSub.should_email}, through L{TShirtSub.has_earned}
+    and L{ctlutil.new_avg_bandwidth}; only the changed rows are written.
 
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-   
-    subs = TShirtSub.objects.filter(emailed = False)
+    pks, triggered, averages, last_changed, up, exits, fingerprints = \
+        _sub_columns(TShirtSub, id_range, None, ['triggered', 'avg_bandwidth',
+                                           'last_changed',
+                                           'subscriber__router__up',
+                                           'subscriber__router__exit',
+                                           'subscriber__router__fingerprint'],
+                     emailed = False)
+    bandwidths = _bandwidth_column(ctl_util, fingerprints, up)
+    now = datetime.now()
 
-    for sub in subs:
-        if sub.subscriber.confirmed:
-
-            # first, update the database 
-            router = sub.subscriber.router
-            is_up = router.up
-            fingerprint = str(router.fingerprint)
-            if not is_up and sub.triggered:
-                # reset the data if the node goes down
-                sub.triggered = False
-                sub.avg_bandwidth = 0
-                sub.last_changed = datetime.now()
-            elif is_up:
-                current_bandwidth = ctl_util.get_bandwidth(fingerprint)
-                if sub.triggered == False:
-                # router just came back, reset values
-                    sub.triggered = True
-                    sub.avg_bandwidth = current_bandwidth
-                    sub.last_changed = datetime.now()
-                else:
-                # update the avg bandwidth (arithmetic)
-                    hours_up = sub.get_hours_since_triggered()
-                    sub.avg_bandwidth = ctl_util.get_new_avg_bandwidth(
-                                                sub.avg_bandwidth,
-                                                hours_up,
-                                                current_bandwidth)
-
-                    #send email if needed
-                    if sub.should_email():
-                        recipient = sub.subscriber.email
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        avg_band = sub.avg_bandwidth
-                        time = hours_up
-                        exit = sub.subscriber.router.exit
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        
-                        email = emails.t_shirt_tuple(recipient, fingerprint,
-                                                     name, avg_band, time,
-                                                     exit, unsubs_auth, 
-                                                     pref_auth)
-                        email_list.append(email)
-                        sub.emailed = True
-
-            sub.save()
+    #The routers that went down lose their progress
+    went_down = [pk for pk, is_up, was_triggered in zip(pks, up, triggered)
+                 if was_triggered and not is_up]
+    #The routers that came back start over with their current bandwidth
+    came_up = [(True, bandwidth, now, False, pk) for pk, is_up, was_triggered,
+               bandwidth in zip(pks, up, triggered, bandwidths)
+               if is_up and not was_triggered]
+
+    #The routers that stayed up get a new average
+    stayed_up = [i for i in range(len(pks)) if up[i] and triggered[i]]
+    hours = [_hours_between(last_changed[i], now) for i in stayed_up]
+    new_averages = [new_avg_bandwidth(averages[i], hours_up, bandwidths[i])
+                    for i, hours_up in zip(stayed_up, hours)]
+    earned = [TShirtSub.has_earned(hours_up, average, exits[i])
+              for i, hours_up, average in zip(stayed_up, hours, new_averages)]
+
+    updated = [(True, average, last_changed[i], is_earned, pks[i])
+               for i, average, is_earned in zip(stayed_up, new_averages,
+                                                earned)
+               if average != averages[i] or is_earned]
+
+    notify = [(pks[i], hours_up, average) for i, hours_up, average, is_earned
+              in zip(stayed_up, hours, new_averages, earned) if is_earned]
+    subs = _subs_by_pk(TShirtSub, [pk for pk, hours_up, average in notify])
+    for pk, hours_up, average in notify:
+        if pk not in subs:
+            #Unsubscribed since the columns were loaded
+            continue
+        subscriber = subs[pk].subscriber
+        router = subscriber.router
+        email = emails.t_shirt_tuple(subscriber.email, router.fingerprint,
+                                     router.name, average, hours_up,
+                                     router.exit, subscriber.unsubs_auth,
+                                     subscriber.pref_auth)
+        email_list.append(_notification(subscriber, email))
+
+    _flush_sub_changes(TShirtSub, {(('triggered', False),
+                                    ('avg_bandwidth', 0),
+                                    ('last_changed', now)): went_down})
+    _write_rows(TShirtSub, ['triggered', 'avg_bandwidth', 'last_changed',
+                            'emailed'], came_up + updated)
     return email_list
 
-def check_version(ctl_util, email_list):
+def check_version(ctl_util, email_list, id_range = None, pks = None):
     """Check/update all C{VersionSub} subscriptions and send emails as
     necessary.
 
@@ -179,66 +482,346 @@ def check_version(ctl_util, email_list):
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type id_range: tuple (int, int)
+    @param id_range: If given, only subscriptions with C{start <= id < end}
+        are checked.
+    @type pks: list [int]
+    @param pks: If given, only the subscriptions with these ascending primary
+        keys are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send."""
 
-    subs = VersionSub.objects.all()
+    subs = confirmed_subs(VersionSub, id_range, pks)
+    changes = SubChanges(VersionSub, ['emailed'])
 
     for sub in subs:
-        if sub.subscriber.confirmed:
-            version_type = ctl_util.get_version_type(
-                           str(sub.subscriber.router.fingerprint))
+        before = changes.values(sub)
+        subscriber = sub.subscriber
+        router = subscriber.router
+        version_type = ctl_util.get_version_type(str(router.fingerprint))
 
-            if version_type != 'ERROR':
-                if (version_type == 'OBSOLETE'):
-                    if sub.emailed == False:
-                
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        recipient = sub.subscriber.email
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        email_list.append(emails.version_tuple(recipient,     
-                                                               fingerprint,
-                                                               name,
-                                                               version_type,
-                                                               unsubs_auth,
-                                                               pref_auth))
-                        sub.emailed = True
-
-            #if the user has their desired version type, we need to set emailed
-            #to False so that we can email them in the future if we need to
-                else:
-                    sub.emailed = False
+        if version_type != 'ERROR':
+            if (version_type == 'OBSOLETE'):
+                if sub.emailed == False:
+                    email = emails.version_tuple(subscriber.email,
+                                                 router.fingerprint,
+                                                 router.name, version_type,
+                                                 subscriber.unsubs_auth,
+                                                 subscriber.pref_auth)
+                    email_list.append(_notification(subscriber, email))
+                    sub.emailed = True
+
+        #if the user has their desired version type, we need to set emailed
+        #to False so that we can email them in the future if we need to
             else:
-                logging.info("Couldn't parse the version relay %s is running" \
-                              % str(sub.subscriber.router.fingerprint))
+                sub.emailed = False
+        else:
+            logging.info("Couldn't parse the version relay %s is running" \
+                          % str(router.fingerprint))
 
-            sub.save()
+        changes.record(sub, before)
 
+    changes.flush()
     return email_list
         
                 
-def check_all_subs(ctl_util, email_list):
-    """Check/update all subscriptions
+class RouterChanges:
+    """The subscribed routers whose state changed since the previous update
+    cycle. Only the subscriptions these changes can affect are checked, and
+    those of the subscribers who confirmed their subscription or changed
+    their preferences since the previous cycle.
+
+    @type up_changed: set [unicode]
+    @ivar up_changed: The fingerprints of the routers that went up or down.
+    @type bandwidth_changed: set [unicode]
+    @ivar bandwidth_changed: The fingerprints of the routers whose observed
+        bandwidth changed.
+    @type version_changed: set [unicode]
+    @ivar version_changed: The fingerprints of the routers whose version
+        type changed, because they upgraded or the recommended versions
+        changed.
+    @type since: datetime
+    @ivar since: When the state of the previous cycle was taken; the
+        subscribers with a later L{Subscriber.changed_at} are checked.
+    """
+
+    def __init__(self, previous, current):
+        """Compare the router states of two cycles.
+
+        @type previous: tuple (dict, datetime)
+        @param previous: What L{_cycle_state} returned in the previous
+            cycle.
+        @type current: tuple (dict, datetime)
+        @param current: What L{_cycle_state} returned in this cycle.
+        """
+        old_routers, self.since = previous
+        routers = current[0]
+
+        self.up_changed = set()
+        self.bandwidth_changed = set()
+        self.version_changed = set()
+        for fingerprint, (up, bandwidth, version_type) in routers.items():
+            old = old_routers.get(fingerprint)
+            if old is None or old[0] != up:
+                self.up_changed.add(fingerprint)
+            if old is None or old[1] != bandwidth:
+                self.bandwidth_changed.add(fingerprint)
+            if old is None or old[2] != version_type:
+                self.version_changed.add(fingerprint)
+
+    def sub_pks(self, sub_class):
+        """Get the subscriptions of type C{sub_class} to check: those of the
+        routers whose relevant state changed, those of the subscribers who
+        changed since the previous cycle, found with a range query on
+        L{Subscriber.changed_at}, and for L{NodeDownSub} the ones whose grace
+        period ran out, found with a range query on L{NodeDownSub.notify_at}.
+
+        @type sub_class: class
+        @param sub_class: L{NodeDownSub}, L{VersionSub} or L{BandwidthSub}.
+        @rtype: list [int]
+        @return: The ascending primary keys of the subscriptions.
+        """
+        if sub_class is NodeDownSub:
+            routers = self.up_changed
+        elif sub_class is VersionSub:
+            routers = self.version_changed
+        else:
+            routers = self.bandwidth_changed
+
+        subs = sub_class.objects.filter(subscriber__confirmed = True)
+        pks = set(subs.filter(subscriber__changed_at__gte = self.since)
+                      .values_list('pk', flat = True))
+        routers = list(routers)
+        for start in range(0, len(routers), _UPDATE_BATCH_SIZE):
+            batch = routers[start:start + _UPDATE_BATCH_SIZE]
+            pks.update(subs.filter(subscriber__router__fingerprint__in =
+                                   batch).values_list('pk', flat = True))
+        if sub_class is NodeDownSub:
+            pks.update(subs.filter(notify_at__lte = datetime.now())
+                           .values_list('pk', flat = True))
+            #Subscriptions triggered before notify_at existed
+            pks.update(subs.filter(notify_at__isnull = True, triggered = True,
+                                   emailed = False)
+                           .values_list('pk', flat = True))
+        return sorted(pks)
+
+#The subscription types whose checks depend only on router state changes
+_CHANGE_DRIVEN = (NodeDownSub, VersionSub, BandwidthSub)
+
+#The router states of the previous cycle, and the number of cycles since all
+#subscriptions were checked
+_previous_state = None
+_cycles_since_full = 0
+
+def _cycle_state(ctl_util):
+    """Get the state of every router with a confirmed subscriber. Routers
+    nobody is subscribed to can't trigger a check, so they are left out.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @rtype: tuple (dict, datetime)
+    @return: The (up, bandwidth, version type) of the routers keyed by
+        fingerprint, and when the state was taken.
+    """
+    taken = datetime.now()
+    routers = {}
+    subscribed = Router.objects.filter(subscriber__confirmed = True) \
+                               .distinct()
+    for fingerprint, up in subscribed.values_list('fingerprint', 'up'):
+        #Stem does type checking, so fingerprint needs to be converted from
+        #a unicode string to a python str
+        routers[fingerprint] = (up, ctl_util.get_bandwidth(str(fingerprint)),
+                                ctl_util.get_version_type(str(fingerprint)))
+    return routers, taken
+
+def find_changes(ctl_util):
+    """Compare the subscribed routers with those of the previous cycle.
+    Every L{config.full_check_cycles} cycles, and in the first cycle after a
+    restart, all subscriptions are checked instead.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @rtype: L{RouterChanges}
+    @return: The changes, or C{None} if all subscriptions should be checked.
+    """
+    global _previous_state, _cycles_since_full
+
+    state = _cycle_state(ctl_util)
+    previous = _previous_state
+    _previous_state = state
+
+    if previous is None or _cycles_since_full + 1 >= config.full_check_cycles:
+        _cycles_since_full = 0
+        return None
+    _cycles_since_full += 1
+    return RouterChanges(previous, state)
+
+@contextmanager
+def acting_on_changes():
+    """Check the subscriptions and queue the emails of the changes
+    L{find_changes} found in the block. If the block raises, the router
+    states are forgotten, so the next cycle checks all subscriptions instead
+    of comparing against states whose changes were never acted on."""
+    global _previous_state
+
+    try:
+        yield
+    except:
+        _previous_state = None
+        raise
+
+def check_all_subs(ctl_util, email_list, workers = 1, cycle_metrics = None,
+                   changes = None):
+    """Check/update all subscriptions. With more than one worker, the four
+    checkers run concurrently on a thread pool, each split into partitions of
+    L{_PARTITION_SIZE} subscriptions; the emails are merged in the same
+    order the sequential run produces them.
    
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type workers: int
+    @param workers: The number of threads checking subscriptions.
+    @type cycle_metrics: L{metrics.CycleMetrics}
+    @param cycle_metrics: If given, each checker is recorded as a phase, or
+        all of them as one phase when they run in parallel.
+    @type changes: L{RouterChanges}
+    @param changes: If given, only the node down, version and bandwidth
+        subscriptions these changes can affect are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    logging.debug('Checking node down subscriptions.')
-    email_list = check_node_down(email_list)
-    logging.debug('Checking version subscriptions.')
-    check_version(ctl_util, email_list)
-    logging.debug('Checking bandwidth subscriptions.')
-    check_low_bandwidth(ctl_util, email_list)
-    logging.debug('Checking shirt subscriptions.')
-    email_list = check_earn_tshirt(ctl_util, email_list)
+    selected = {}
+    if changes is not None:
+        for sub_class in _CHANGE_DRIVEN:
+            selected[sub_class] = changes.sub_pks(sub_class)
+        logging.debug('Checking %d node down, %d version and %d bandwidth '
+                      'subscriptions of changed routers.' %
+                      (len(selected[NodeDownSub]), len(selected[VersionSub]),
+                       len(selected[BandwidthSub])))
+
+    if workers <= 1:
+        logging.debug('Checking node down subscriptions.')
+        _timed(cycle_metrics, 'check_node_down', email_list,
+               check_node_down, email_list, None, selected.get(NodeDownSub))
+        logging.debug('Checking version subscriptions.')
+        _timed(cycle_metrics, 'check_version', email_list,
+               check_version, ctl_util, email_list, None,
+               selected.get(VersionSub))
+        logging.debug('Checking bandwidth subscriptions.')
+        _timed(cycle_metrics, 'check_low_bandwidth', email_list,
+               check_low_bandwidth, ctl_util, email_list, None,
+               selected.get(BandwidthSub))
+        logging.debug('Checking shirt subscriptions.')
+        _timed(cycle_metrics, 'check_earn_tshirt', email_list,
+               check_earn_tshirt, ctl_util, email_list)
+        return email_list
+
+    if cycle_metrics is not None:
+        cycle_metrics.begin('check_subs')
+    emails_before = len(email_list)
+
+    checkers = [(NodeDownSub, lambda emails, id_range, pks:
+                     check_node_down(emails, id_range, pks)),
+                (VersionSub, lambda emails, id_range, pks:
+                     check_version(ctl_util, emails, id_range, pks)),
+                (BandwidthSub, lambda emails, id_range, pks:
+                     check_low_bandwidth(ctl_util, emails, id_range, pks)),
+                (TShirtSub, lambda emails, id_range, pks:
+                     check_earn_tshirt(ctl_util, emails, id_range))]
+
+    tasks = []
+    for sub_class, checker in checkers:
+        if sub_class in selected:
+            pks = selected[sub_class]
+            for start in range(0, len(pks), _PARTITION_SIZE):
+                tasks.append((checker, None,
+                              pks[start:start + _PARTITION_SIZE],
+                              cycle_metrics is not None))
+        else:
+            for id_range in id_partitions(sub_class):
+                tasks.append((checker, id_range, None,
+                              cycle_metrics is not None))
+
+    logging.debug('Checking subscriptions in %d partitions on %d threads.' %
+                  (len(tasks), workers))
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(_run_checker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    for emails_found in results:
+        email_list.extend(emails_found)
+    if cycle_metrics is not None:
+        cycle_metrics.end('check_subs', partitions = len(tasks),
+                          emails = len(email_list) - emails_before)
     return email_list
 
+def _timed(cycle_metrics, name, email_list, func, *args):
+    """Call C{func} with C{args}, and record the call as the phase C{name}
+    of C{cycle_metrics} together with the number of emails it added to
+    C{email_list}.
+
+    @type cycle_metrics: L{metrics.CycleMetrics}
+    @param cycle_metrics: The metrics to record to, or C{None} to only call
+        C{func}.
+    @type name: str
+    @param name: The name of the phase.
+    @type email_list: list
+    @param email_list: The list of tuples representing emails to send, which
+        C{func} appends to.
+    @type func: callable
+    @param func: The function to call.
+    @return: What C{func} returned.
+    """
+    if cycle_metrics is None:
+        return func(*args)
+
+    emails_before = len(email_list)
+    cycle_metrics.begin(name)
+    result = func(*args)
+    cycle_metrics.end(name, emails = len(email_list) - emails_before)
+    return result
+
+def id_partitions(sub_class):
+    """Split the ids of the subscriptions of type C{sub_class} into ranges
+    of L{_PARTITION_SIZE} ids.
+
+    @type sub_class: class
+    @param sub_class: A subclass of L{Subscription}.
+    @rtype: list [tuple (int, int)]
+    @return: (start, end) pairs covering every id, where C{end} is exclusive.
+    """
+    bounds = sub_class.objects.aggregate(Min('pk'), Max('pk'))
+    low, high = bounds['pk__min'], bounds['pk__max']
+    if low is None:
+        return []
+    return [(start, start + _PARTITION_SIZE) for start in
+            range(low, high + 1, _PARTITION_SIZE)]
+
+def _run_checker(task):
+    """Run one checker partition on a pool thread.
+
+    @type task: tuple (callable, tuple (int, int), list [int], bool)
+    @param task: The checker, called with an email list, an id range and a
+        list of primary keys, the id range or primary keys to check, and
+        whether its queries are counted for the cycle metrics.
+    @rtype: list
+    @return: The emails the checker generated.
+    """
+    checker, id_range, pks, counted = task
+    try:
+        if counted:
+            with metrics.counting_queries():
+                return checker([], id_range, pks)
+        return checker([], id_range, pks)
+    finally:
+        # Every thread has its own database connection; don't leak it.
+        connection.close()
+
 def update_all_routers(ctl_util, email_list):
     """Add ORs we haven't seen before to the database and update the
     information of ORs that are already in the database. Check if a welcome
@@ -267,77 +850,202 @@ def update_all_routers(ctl_util, email_list):
     else:
         fully_deployed = True
     
-    router_set = Router.objects.all()
-    for router in router_set:
-        #remove routers from the db that we haven't seen for more than a year 
-        if (datetime.now() - router.last_seen).days > 365:
-            router.delete()
-        #Set the 'up' flag to False for every router
-        else:
-            router.up = False
-            router.save()
-    
+    sync_routers(ctl_util, email_list, fully_deployed)
+    return email_list
+
+def sync_routers(ctl_util, email_list, fully_deployed):
+    """Bring the Router table in line with the current descriptor list using
+    set-based statements: one DELETE removes routers we haven't seen for more
+    than a year, one SELECT loads the remaining routers, and the new, seen
+    and no longer running rows are then written with batched statements.
+    Every L{_UPDATE_BATCH_SIZE} rows are written in a transaction of their
+    own, so the web pages can write between them. The routers that went
+    down are marked down one by one instead of marking every router down
+    first, so a page never sees a running router as down.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @type email_list: list
+    @param email_list: The list of tuples representing emails to send. Welcome
+        emails are appended to it.
+    @type fully_deployed: bool
+    @param fully_deployed: Whether Tor Weather has been deployed for long
+        enough that new routers should be welcomed.
+    """
+
+    now = datetime.now()
+
+    #remove routers from the db that we haven't seen for more than a year
+    database.atomically(Router.objects.filter(
+                        last_seen__lte = now - timedelta(days = 366)).delete)
+
+    #Map the fingerprints of stored routers to their id and welcomed flag,
+    #and remember the ones that were running
+    existing = {}
+    running = set()
+    for router_id, finger, welcomed, up in Router.objects.values_list('id',
+                                            'fingerprint', 'welcomed', 'up'):
+        existing[finger] = (router_id, welcomed)
+        if up:
+            running.add(router_id)
+
+    inserts = []
+    updates = []
+
     #Get a list of fingerprint/name tuples in the current descriptor file
     finger_name = ctl_util.get_finger_name_list()
 
-    for router in finger_name:
-        finger = router[0]
-        name = router[1]
-
-        if ctl_util.is_up_or_hibernating(finger):
-
-            router_data = None
-            try:
-                router_data = Router.objects.get(fingerprint = finger)
-            except:
-                if fully_deployed:
-                    router_data = Router(name = name, fingerprint = finger,
-                                         welcomed = False)
-                else:
-                    #We don't ever want to welcome relays that were running 
-                    #when  Weather was deployed, so set welcomed to True
-                    router_data = Router(name = name, fingerprint = finger,
-                                         welcomed = True)           
-            
-            router_data.last_seen = datetime.now()
-            router_data.name = name
-            router_data.up = True
-            router_data.exit = ctl_util.is_exit(finger)
-
-            #send a welcome email if indicated
-            if router_data.welcomed == False and ctl_util.is_stable(finger):
-                recipient = ctl_util.get_email(finger)
-                # Don't spam people for now XXX
-                #recipient = "kaner@strace.org"
-                is_exit = ctl_util.is_exit(finger)
-                if not recipient == "":
-                    email = emails.welcome_tuple(recipient, finger, name, is_exit)
-                    email_list.append(email)
-                router_data.welcomed = True
-
-            router_data.save()
+    for finger, name in finger_name:
+        if not ctl_util.is_up_or_hibernating(finger):
+            continue
 
-    return email_list
+        if finger in existing:
+            router_id, welcomed = existing[finger]
+        else:
+            router_id = None
+            #We don't ever want to welcome relays that were running
+            #when Weather was deployed, so set welcomed to True
+            welcomed = not fully_deployed
+
+        is_exit = ctl_util.is_exit(finger)
 
-def run_all():
-    """Run all updaters/checkers in proper sequence, then send emails."""
+        #send a welcome email if indicated
+        if welcomed == False and ctl_util.is_stable(finger):
+            recipient = ctl_util.get_email(finger)
+            # Don't spam people for now XXX
+            #recipient = "kaner@strace.org"
+            if not recipient == "":
+                email = emails.welcome_tuple(recipient, finger, name, is_exit)
+                email_list.append(email)
+            welcomed = True
+
+        if router_id is None:
+            inserts.append((finger, name, welcomed, now, True, is_exit))
+        else:
+            updates.append((name, welcomed, now, True, is_exit, router_id))
+            running.discard(router_id)
+
+    #What is left in running went down since the last consensus
+    down = sorted(running)
+    for start in range(0, max(len(inserts), len(updates), len(down)),
+                       _UPDATE_BATCH_SIZE):
+        end = start + _UPDATE_BATCH_SIZE
+        _write_router_rows(inserts[start:end], updates[start:end],
+                           down[start:end])
+
+@database.short_transaction
+def _write_router_rows(inserts, updates, down):
+    """Write new and changed L{Router} rows with one batched INSERT, one
+    batched UPDATE and one UPDATE marking routers down, in one transaction.
+
+    @type inserts: list [tuple]
+    @param inserts: (fingerprint, name, welcomed, last_seen, up, exit) tuples
+        for routers that aren't in the database yet.
+    @type updates: list [tuple]
+    @param updates: (name, welcomed, last_seen, up, exit, id) tuples for
+        routers that are already in the database.
+    @type down: list [int]
+    @param down: The ids of the routers that are no longer running.
+    """
+
+    opts = Router._meta
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+
+    def prep(field_name, value):
+        return opts.get_field(field_name).get_db_prep_save(value,
+                                                       connection = connection)
+
+    insert_fields = ['fingerprint', 'name', 'welcomed', 'last_seen', 'up',
+                     'exit']
+    update_fields = ['name', 'welcomed', 'last_seen', 'up', 'exit']
+
+    cursor = connection.cursor()
+
+    if inserts:
+        columns = ', '.join([qn(opts.get_field(f).column)
+                             for f in insert_fields])
+        placeholders = ', '.join(['%s'] * len(insert_fields))
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, columns,
+                                                   placeholders)
+        cursor.executemany(sql, [[prep(f, v) for f, v in
+                                  zip(insert_fields, row)] for row in inserts])
+
+    if updates:
+        assignments = ', '.join(['%s = %%s' % qn(opts.get_field(f).column)
+                                 for f in update_fields])
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (table, assignments,
+                                                   qn(opts.pk.column))
+        cursor.executemany(sql, [[prep(f, v) for f, v in
+                                  zip(update_fields, row[:-1])] + [row[-1]]
+                                 for row in updates])
+
+    if down:
+        Router.objects.filter(pk__in = down).update(up = False)
+
+    #Raw statements don't mark the transaction as needing a commit
+    transaction.set_dirty()
+
+def run_all(ctl_util = None):
+    """Run all updaters/checkers in proper sequence, then queue the emails,
+    and send the queued emails if the mailer isn't running. The time and
+    work of every phase is written to L{metrics.metrics_file}.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: The CtlUtil to use. A new connection to tor is opened
+        if none is given.
+    @rtype: dict
+    @return: The metrics of the cycle, see L{metrics.CycleMetrics.as_dict}.
+    """
+    with metrics.counting_queries():
+        return _run_cycle(ctl_util)
+
+def _run_cycle(ctl_util):
+    """Run one update cycle for L{run_all}."""
 
     #The CtlUtil for all methods to use
-    ctl_util = CtlUtil()
+    if ctl_util is None:
+        ctl_util = CtlUtil()
+    cycle_metrics = metrics.CycleMetrics(ctl_util)
+
+    #Fetch the consensus and descriptors once, all checks read from this
+    cycle_metrics.begin('fetch_consensus')
+    snapshot = ctl_util.refresh_snapshot()
+    cycle_metrics.end('fetch_consensus',
+                      relays = len(snapshot.descriptor_order))
 
     # the list of tuples of email info, gets updated w/ each call
     email_list = []
+    cycle_metrics.begin('sync_routers')
     email_list = update_all_routers(ctl_util, email_list)
+    cycle_metrics.end('sync_routers', emails = len(email_list))
+    cycle_metrics.begin('publish_relays')
+    published = relayindex.publish_snapshot()
+    relayindex.mark_changed(relayindex.publish_directory())
+    cycle_metrics.end('publish_relays', published = published)
     logging.info('Finished updating routers. About to check all subscriptions.')
-    email_list = check_all_subs(ctl_util, email_list)
-    logging.info('Finished checking subscriptions. About to send emails.')
-    mails = tuple(email_list)
+    cycle_metrics.begin('find_changes')
+    changes = find_changes(ctl_util)
+    cycle_metrics.end('find_changes', full_check = changes is None)
+    with acting_on_changes():
+        email_list = check_all_subs(ctl_util, email_list,
+                                    config.checker_workers, cycle_metrics,
+                                    changes)
+        logging.info('Finished checking subscriptions. About to queue '
+                     'emails.')
+        cycle_metrics.begin('queue_emails')
+        if config.digest_emails:
+            email_list = emails.make_digests(email_list)
+        queued = mailqueue.enqueue(email_list)
+        cycle_metrics.end('queue_emails', queued = queued)
+    logging.info('Queued %d emails.' % queued)
+    if not mailqueue.mailer_is_running():
+        logging.warning('The mailer is not running, sending the queued '
+                        'emails from the update cycle instead.')
+        cycle_metrics.begin('drain_queue')
+        stats = mailqueue.drain()
+        cycle_metrics.end('drain_queue', sent = stats['sent'])
+    ctl_util.report_unparsable_contacts()
+    ctl_util.store_contacts()
 
-    try:
-        send_mass_mail(mails, fail_silently = False)
-    except SMTPException, e:
-        logging.info(e)
-        failed = open(failed_email_file, 'w')
-        failed.write(str(e) + '\n')
-        failed.close()
-    logging.info('Finished sending emails.')
+    return cycle_metrics.write()
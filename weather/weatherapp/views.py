@@ -3,13 +3,13 @@ The views module contains the controllers for the Tor Weather application
 (Django is idiosyncratic in that it names controllers 'views'; models are still
 models and views are called templates). This module contains a single 
 controller for each page type. The controllers handle form submission and
-page rendering/redirection.
+page rendering/redirection. Their database writes run through
+L{database.atomically}, so one that finds the database locked by the updater
+is retried rather than shown as an error.
 """
-import threading
-
 from weatherapp.models import Subscriber, Router, GenericForm, \
         SubscribeForm, PreferencesForm, insert_fingerprint_spaces
-from weatherapp import emails
+from weatherapp import assets, database, emails, mailqueue, relayindex
 from config import url_helper, templates
 from weatherapp import error_messages
 
@@ -18,9 +18,47 @@ from django.db import models
 from django.core.context_processors import csrf
 from django.shortcuts import render_to_response, get_object_or_404
 from django.http import HttpResponseRedirect, HttpRequest, Http404
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotFound, \
+        HttpResponseServerError
+from django.template import loader
+from django.conf import settings
 from django.utils import simplejson
-
+from django.utils.cache import patch_response_headers
+from django.utils.functional import wraps
+from django.views.decorators.cache import cache_page
+
+#How long pages that only depend on their URL are cached, by us and by
+#browsers. Together with the ConditionalGetMiddleware, repeat visitors get a
+#304 Not Modified.
+_PAGE_CACHE_SECONDS = 60 * 60
+
+#The rendered 404 and 500 pages, which only change with the
+#assets.manifest_version of the bundles they link
+_rendered_pages = {}
+
+def _cache_page(view):
+    """Cache the pages of C{view} for L{_PAGE_CACHE_SECONDS} like
+    C{cache_page}, under a key that includes the L{assets.manifest_version},
+    so pages cached before the bundles were rebuilt don't link the old
+    ones. The pages always carry an ETag and a Last-Modified header, which
+    the ConditionalGetMiddleware needs to answer 304 Not Modified."""
+
+    cached_views = {}
+
+    def cached_view(request, *args, **kwargs):
+        version = assets.manifest_version()
+        if version not in cached_views:
+            cached_views.clear()
+            cached_views[version] = cache_page(view, _PAGE_CACHE_SECONDS,
+                key_prefix = '%s-%s' % (settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+                                        version))
+        response = cached_views[version](request, *args, **kwargs)
+        patch_response_headers(response, _PAGE_CACHE_SECONDS)
+        return response
+
+    return wraps(view)(cached_view)
+
+@_cache_page
 def home(request):
     """Displays a home page for Tor Weather with basic information about
     the application."""
@@ -41,33 +79,38 @@ def subscribe(request):
         form = SubscribeForm(request.POST)
 
         if form.is_valid():
+            # Turn the user away rather than queueing ever more emails.
+            if mailqueue.is_backlogged():
+                error_extension = url_helper.get_error_ext('mail_backlog',
+                                                           'subscribe')
+                return HttpResponseRedirect(error_extension)
+
             # Tries to save the new subscriber, but redirects if saving the
             # subscriber failed because of the subscriber already existing
             try:
-                subscriber = form.create_subscriber()
+                subscriber = database.atomically(form.create_subscriber)
             except Exception, e:
                 return HttpResponseRedirect(e)
             else:
                 # Creates subscriptions based on form data
-                form.create_subscriptions(subscriber)
+                database.atomically(form.create_subscriptions, subscriber)
 
-                # Spawn a daemon to send the confirmation email.
+                # Queue the confirmation email.
                 confirm_auth = subscriber.confirm_auth
-		unsubs_auth = subscriber.unsubs_auth
+                unsubs_auth = subscriber.unsubs_auth
                 addr = subscriber.email
                 fingerprint = subscriber.router.fingerprint
                 name = subscriber.router.name
-                email_thread = threading.Thread(target=emails.send_confirmation,
-                               args=[addr, fingerprint, name, confirm_auth])
-                email_thread.setDaemon(True)
-                email_thread.start()
+                mailqueue.enqueue([emails.confirmation_tuple(addr, fingerprint,
+                                                  name, confirm_auth)],
+                                  mailqueue.PRIORITY_CONFIRMATION)
         
                 # Redirect the user to the pending page.
                 #url_extension = url_helper.get_pending_ext(confirm_auth)
                 url_extension = url_helper.get_pending_ext(unsubs_auth)
                 return HttpResponseRedirect(url_extension)
     
-    c = {'form' : form}
+    c = {'form' : form, 'relay_directory' : relayindex.get_directory_url()}
 
     # For pages with POST methods, a Cross Site Request Forgery protection
     # key is added to block attacking sites.
@@ -98,7 +141,8 @@ def preferences(request, pref_auth):
         if form.is_valid():
             # Creates/changes/deletes subscriptions and subscription info
             # based on form data
-            form.change_subscriptions(form.cleaned_data)
+            database.atomically(form.change_subscriptions,
+                                form.cleaned_data)
             
             # Redirect the user to the pending page
             url_extension = url_helper.get_confirm_pref_ext(pref_auth)
@@ -114,6 +158,7 @@ def preferences(request, pref_auth):
     # display the page
     return render_to_response(template, fields)
 
+@_cache_page
 def notification_info(request):
     """Displays detailed technical information about how the different
     notification types are triggered.
@@ -154,7 +199,7 @@ def confirm(request, confirm_auth):
     if not user.confirmed:
         # confirm the user's subscription
         user.confirmed = True
-        user.save()
+        database.atomically(user.mark_changed)
     else:
         # the user is already confirmed, send to an error page
         error_url_ext = url_helper.get_error_ext('already_confirmed',    
@@ -167,19 +212,17 @@ def confirm(request, confirm_auth):
         #We set welcomed to True so that we don't accidentally send welcome
         #emails to users who are already subscribed.
         router.welcomed = True
-        router.save()
+        database.atomically(router.save)
 
     # get the urls for the user's unsubscribe and prefs pages to add links
     unsubURL = url_helper.get_unsubscribe_url(user.unsubs_auth)
     prefURL = url_helper.get_preferences_url(user.pref_auth)
 
-    # spawn a daemon to send an email confirming subscription and 
-    #providing the links
-    email_thread=threading.Thread(target=emails.send_confirmed,
-                            args=[user.email, router.fingerprint, router.name,
-                                  user.unsubs_auth, user.pref_auth])
-    email_thread.setDaemon(True)
-    email_thread.start()
+    # queue an email confirming subscription and providing the links
+    mailqueue.enqueue([emails.confirmed_tuple(user.email, router.fingerprint,
+                                              router.name, user.unsubs_auth,
+                                              user.pref_auth)],
+                      mailqueue.PRIORITY_CONFIRMATION)
 
     # get the template for the confirm page
     template = templates.confirm
@@ -214,7 +257,7 @@ def unsubscribe(request, unsubscribe_auth):
 
     # delete the Subscriber (all Subscriptions with a foreign key relationship
     # to this Subscriber are automatically deleted)
-    user.delete()
+    database.atomically(user.delete)
 
     # get the url extension for the subscribe page to add a link on the page
     url_extension = url_helper.get_subscribe_ext()
@@ -253,15 +296,21 @@ def resend_conf(request, confirm_auth):
     router = user.router
     template = templates.resend_conf
 
-    # spawn a daemon to resend the confirmation email
-    email_thread=threading.Thread(target=emails.send_confirmation,
-                            args=[user.email, router.fingerprint, router.name,
-                                  confirm_auth])
-    email_thread.setDaemon(True)
-    email_thread.start()
+    # Turn the user away rather than queueing ever more emails.
+    if mailqueue.is_backlogged():
+        error_extension = url_helper.get_error_ext('mail_backlog',
+                                                   confirm_auth)
+        return HttpResponseRedirect(error_extension)
+
+    # queue the confirmation email again
+    mailqueue.enqueue([emails.confirmation_tuple(user.email,
+                                                 router.fingerprint,
+                                                 router.name, confirm_auth)],
+                      mailqueue.PRIORITY_CONFIRMATION)
 
     return render_to_response(template, {'email' : user.email})
 
+@_cache_page
 def fingerprint_not_found(request, fingerprint):
     """Displays the fingerprint not found page when a user follows a link for 
     more info in the 'fingerprint not found' validation error. This error is 
@@ -298,12 +347,46 @@ def error(request, error_type, key):
     # display the page
     return render_to_response(template, {'error_message' : message})
 
+def _render_once(template):
+    """Render C{template}, which needs no context, the first time it is
+    asked for and return the same page from then on, until the bundles are
+    rebuilt.
+
+    @type template: str
+    @param template: The name of the template.
+    @rtype: str
+    @return: The rendered page.
+    """
+
+    version = assets.manifest_version()
+    if version not in _rendered_pages:
+        _rendered_pages.clear()
+        _rendered_pages[version] = {}
+    pages = _rendered_pages[version]
+
+    page = pages.get(template)
+    if page is None:
+        page = loader.render_to_string(template)
+        pages[template] = page
+    return page
+
+def page_not_found(request):
+    """The 404 handler, which displays the Page Not Found page."""
+
+    return HttpResponseNotFound(_render_once(templates.not_found))
+
+def server_error(request):
+    """The 500 handler, which displays the Server Error page."""
+
+    return HttpResponseServerError(_render_once(templates.server_error))
+
 def router_name_lookup(request):
     """Action called by the L{router_search} search field to perform
     autocomplete. Looks for the router name entered by looking at GET data, 
     and then returns an HTTP response with json data for the list of 
     L{Router}s with names that contain the current value of the name search
-    field. This json data in the HTTP response is received by javascript in
+    field, at most L{relayindex.MAX_RESULTS} of them and running routers
+    first. This json data in the HTTP response is received by javascript in
     autocomplete.js, an external autocomplete library.
 
     @type request: HttpRequest
@@ -322,8 +405,7 @@ def router_name_lookup(request):
 
             # Ignore queries shorter than length 2
             if len(value) > 2:
-                nodes = Router.objects.filter(name__icontains=value)
-                results = [ node.name for node in nodes ]
+                results = relayindex.get_index().search(value)
 
         # Creates a json object
         json = simplejson.dumps(results)
@@ -347,12 +429,12 @@ def router_fingerprint_lookup(request):
     if request.method == 'GET':
         if u'query' in request.GET:
             router_name = request.GET[u'query']
-            try:
-                router = Router.objects.get(name = router_name)
-            except Router.MultipleObjectsReturned:
+            fingerprints = relayindex.get_index().fingerprints(router_name)
+            if len(fingerprints) > 1:
                 json = simplejson.dumps('nonunique_name')
-            except Router.DoesNotExist:
+            elif not fingerprints:
                 json = simplejson.dumps('no_router')
             else:
-                json = simplejson.dumps(router.spaced_fingerprint())
+                json = simplejson.dumps(
+                    insert_fingerprint_spaces(fingerprints[0]))
             return HttpResponse(json, mimetype='application/json')